@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+'''
+##################################################################################
+## License
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/gpl-3.0.txt>.
+#
+##################################################################################
+
+End-to-end benchmark against a fleet of emulated HAA devices on localhost
+(emulator/temp-sensor/haa_fleet.py), for growing fleet sizes:
+  - discovery:  mDNS discovery of the whole fleet (Context.discoverHAA)
+  - locate:     the prescan placing every pairing (inventory probe)
+  - connect:    HAP connection + accessory database of every device (_connect_candidates)
+  - command:    latency of one characteristic read per device (the HAA setup characteristic;
+                HAP-python answers writes in a way aiohomekit cannot parse)
+  - total:      wall time of a complete `haa_manager_cli.py -i "*" <command>` run
+Every run is appended as one JSON line to the results file and compared with the
+previous run, so regressions show up.
+'''
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import configargparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.abspath(os.path.join(HERE, os.pardir))
+CLI = os.path.join(REPO, "haa_manager_cli.py")
+FLEET = os.path.join(REPO, "emulator", "temp-sensor", "haa_fleet.py")
+FLEET_START_TIMEOUT = 300
+COMPARED = ("discovery_s", "locate_s", "connect_s", "command_p50_ms", "total_s")
+
+parser = configargparse.ArgParser(default_config_files=[''])
+parser.add('--sizes', default="1,10,50,100,250,300", help='comma separated fleet sizes')
+parser.add('-c', '--concurrency', type=int, default=16, help='connections in flight, passed to the CLI')
+parser.add('--command', default='version', help='command of the end-to-end run')
+parser.add('--base-port', type=int, default=21000, help='HAP port of the first emulated device')
+parser.add('-o', '--output', default=os.path.join(HERE, "results", "fleet.jsonl"), help='results file (JSON lines)')
+parser.add('--tolerance', type=float, default=0.2, help='report phases slower than the previous run by this ratio')
+parser.add('--measure', metavar='FLEET_DIR', help=configargparse.SUPPRESS)  # internal: in-process phases
+
+
+async def measure_phases(fleet_dir: str, concurrency: int) -> dict:
+    """Run the CLI phases in-process against a running fleet; a fresh process per fleet (Context is a singleton)."""
+    sys.path.insert(0, REPO)
+    import haa_manager_cli as cli
+
+    config = cli.parser.parse_args(['--offline', '--cache-dir', fleet_dir, '-f', os.path.join(fleet_dir, "pairing.json"),
+                                    '-c', str(concurrency), '-t', '60', 'version'])
+    cli.parseArguments(config)
+    logging.getLogger().setLevel(logging.WARNING)
+    ctx = cli.Context.get()
+    log = ctx.get_logger()
+    store = ctx.get_pairing_store()
+    pids = [store.pairing_id(data) for data in store.entries().values()]
+    result = {"devices": len(pids)}
+
+    start = time.perf_counter()
+    name_to_ip = await cli._prescan_and_patch(store, log, ctx.get_inventory())
+    result["locate_s"] = time.perf_counter() - start
+    result["located"] = len(name_to_ip)
+
+    async with ctx.get_controller():
+        start = time.perf_counter()
+        await ctx.discoverHAA(expected_ids=pids)
+        result["discovery_s"] = time.perf_counter() - start
+        result["discovered"] = len(ctx.getDiscoveredHAADevices())
+
+        pair_devices = ctx.load_data(store)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):  # progress line
+            results = await cli._connect_candidates(pair_devices, name_to_ip, ctx, log, concurrency)
+        result["connect_s"] = time.perf_counter() - start
+        haaDevices = cli._build_haa_devices(results, name_to_ip, ctx, log)
+        result["connected"] = len(haaDevices)
+
+        latencies = []
+        for hd in haaDevices:
+            start = time.perf_counter()
+            await hd.pairing.get_characteristics([tuple(hd.setupChar)])
+            latencies.append((time.perf_counter() - start) * 1000)
+        if latencies:
+            latencies.sort()
+            result["command_p50_ms"] = statistics.median(latencies)
+            result["command_p95_ms"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            result["command_max_ms"] = latencies[-1]
+    return result
+
+
+@contextlib.contextmanager
+def fleet(size: int, base_port: int):
+    """Start `size` emulated devices and yield the fleet directory once they are all advertised."""
+    with tempfile.TemporaryDirectory(prefix="haa-fleet-") as fleet_dir:
+        log_path = os.path.join(fleet_dir, "fleet.log")
+        with open(log_path, 'w') as log_file:
+            proc = subprocess.Popen([sys.executable, FLEET, '-n', str(size), '--dir', fleet_dir,
+                                     '--base-port', str(base_port)],
+                                    cwd=os.path.dirname(FLEET), stdout=log_file, stderr=subprocess.STDOUT)
+        try:
+            deadline = time.monotonic() + FLEET_START_TIMEOUT
+            while True:
+                with open(log_path) as f:
+                    if "READY" in f.read():
+                        break
+                if proc.poll() is not None or time.monotonic() > deadline:
+                    with open(log_path) as f:
+                        raise RuntimeError("fleet of {} did not start:\n{}".format(size, f.read()[-2000:]))
+                time.sleep(0.1)
+            yield fleet_dir
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+def run_size(size: int, config) -> dict:
+    with fleet(size, config.base_port) as fleet_dir:
+        out = subprocess.run([sys.executable, __file__, '--measure', fleet_dir, '-c', str(config.concurrency)],
+                             capture_output=True, text=True)
+        if out.returncode != 0:
+            raise RuntimeError("measure failed:\n" + out.stderr[-2000:])
+        result = json.loads(out.stdout.strip().splitlines()[-1])
+
+        start = time.perf_counter()
+        cli = subprocess.run([sys.executable, CLI, '--offline', '--cache-dir', fleet_dir,
+                              '-f', os.path.join(fleet_dir, "pairing.json"), '-c', str(config.concurrency),
+                              '-i', '*', config.command], capture_output=True, text=True)
+        result["total_s"] = time.perf_counter() - start
+        result["total_ok"] = cli.returncode == 0
+    return {k: round(v, 4) if isinstance(v, float) else v for k, v in result.items()}
+
+
+def load_previous(path: str):
+    try:
+        with open(path) as f:
+            lines = [line for line in f if line.strip()]
+        return json.loads(lines[-1]) if lines else None
+    except (OSError, ValueError):
+        return None
+
+
+def main():
+    config = parser.parse_args()
+    if config.measure:
+        print(json.dumps(asyncio.run(measure_phases(config.measure, config.concurrency))))
+        return
+
+    results = {}
+    for size in (int(s) for s in config.sizes.split(",") if s.strip()):
+        print("fleet of {} ...".format(size), flush=True)
+        results[str(size)] = run_size(size, config)
+
+    previous = (load_previous(config.output) or {}).get("results", {})
+    header = "{:>6s} {:>11s} {:>9s} {:>10s} {:>10s} {:>9s} {:>9s} {:>9s}"
+    print(header.format("size", "discovered", "disc s", "locate s", "connect s", "cmd p50", "cmd p95", "total s"))
+    regressions = []
+    for size, r in results.items():
+        print("{:>6s} {:>11s} {:9.2f} {:10.3f} {:10.2f} {:9.1f} {:9.1f} {:9.2f}".format(
+            size, "{}/{}".format(r.get("discovered", 0), r["devices"]), r.get("discovery_s", 0),
+            r.get("locate_s", 0), r.get("connect_s", 0), r.get("command_p50_ms", 0), r.get("command_p95_ms", 0),
+            r["total_s"]))
+        old = previous.get(size, {})
+        for key in COMPARED:
+            if old.get(key) and r.get(key, 0) > old[key] * (1 + config.tolerance):
+                regressions.append("{} devices: {} {} -> {}".format(size, key, old[key], r[key]))
+        if r.get("discovered", 0) < r["devices"]:
+            # discovery of a fleet stopping before every paired device was announced
+            regressions.append("{} devices: only {} discovered".format(size, r.get("discovered", 0)))
+        if r.get("connected", 0) < r["devices"] or not r["total_ok"]:
+            regressions.append("{} devices: {} connected, CLI exit {}".format(
+                size, r.get("connected", 0), "ok" if r["total_ok"] else "failed"))
+
+    os.makedirs(os.path.dirname(os.path.abspath(config.output)), exist_ok=True)
+    with open(config.output, "a") as f:
+        f.write(json.dumps({"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "concurrency": config.concurrency,
+                            "results": results}) + "\n")
+
+    if regressions:
+        print()
+        print("\n".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
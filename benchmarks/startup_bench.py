@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+'''
+##################################################################################
+## License
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/gpl-3.0.txt>.
+#
+##################################################################################
+
+Startup benchmark: wall time and import time of every haa_manager_cli entry point
+that can run without devices or network (--help of every subcommand, the offline
+GitHub commands and the daemon client).
+Every run is appended as one JSON line to the results file and compared with the
+previous run, so start-up regressions show up.
+'''
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import configargparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CLI = os.path.join(HERE, os.pardir, "haa_manager_cli.py")
+HEAVY_MODULES = ("aiohomekit", "zeroconf", "requests", "urllib3")
+
+parser = configargparse.ArgParser(default_config_files=[''])
+parser.add('-n', '--runs', type=int, default=5, help='runs per entry point (the median is recorded)')
+parser.add('-o', '--output', default=os.path.join(HERE, "results", "startup.jsonl"), help='results file (JSON lines)')
+parser.add('--tolerance', type=float, default=0.2, help='report entries slower than the previous run by this ratio')
+
+
+def entry_points() -> dict:
+    sys.path.insert(0, os.path.dirname(CLI))
+    import haa_manager_cli
+
+    entries = {
+        "python": None,  # bare interpreter, the floor for every other entry
+        "--help": ["--help"],
+        "-v": ["-v"],
+        "latest (offline)": ["--offline", "latest"],
+        "custom (offline)": ["--offline", "custom", "--version", "0.0.0"],
+        "daemon client": ["--daemon", os.path.join(tempfile.gettempdir(), "haa-bench-nodaemon.sock"), "version"],
+    }
+    for name in haa_manager_cli.subparsers.choices:
+        entries[name + " --help"] = [name, "--help"]
+    return entries
+
+
+def run_once(argv, env) -> tuple:
+    """Returns (wall ms, import ms, heavy modules imported)."""
+    cmd = [sys.executable, "-X", "importtime"] + (["-c", "pass"] if argv is None else [CLI] + argv)
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, env=env, capture_output=True, text=True)
+    wall = (time.perf_counter() - start) * 1000
+
+    import_us = 0
+    heavy = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|", 2)
+        if not cumulative.strip().isdigit():
+            continue  # header line
+        if not name.startswith("  "):  # top level import: its cumulative time covers its children
+            import_us += int(cumulative)
+        top = name.strip().split(".")[0]
+        if top in HEAVY_MODULES:
+            heavy.add(top)
+    return wall, import_us / 1000, sorted(heavy)
+
+
+def load_previous(path: str):
+    try:
+        with open(path) as f:
+            lines = [line for line in f if line.strip()]
+        return json.loads(lines[-1]) if lines else None
+    except (OSError, ValueError):
+        return None
+
+
+def main():
+    config = parser.parse_args()
+    env = dict(os.environ, HOME=tempfile.mkdtemp(prefix="haa-bench-home-"))
+
+    results = {}
+    for name, argv in entry_points().items():
+        samples = [run_once(argv, env) for _ in range(config.runs)]
+        results[name] = {
+            "wall_ms": round(statistics.median(s[0] for s in samples), 1),
+            "import_ms": round(statistics.median(s[1] for s in samples), 1),
+            "heavy": samples[-1][2],
+        }
+
+    previous = load_previous(config.output)
+    print("{:24s} {:>9s} {:>10s}  {}".format("entry point", "wall ms", "import ms", "heavy modules"))
+    regressions = []
+    for name, r in results.items():
+        note = ""
+        old = (previous or {}).get("results", {}).get(name)
+        if old and old["wall_ms"] and r["wall_ms"] > old["wall_ms"] * (1 + config.tolerance):
+            note = "  SLOWER (was {} ms)".format(old["wall_ms"])
+            regressions.append(name)
+        print("{:24s} {:9.1f} {:10.1f}  {}{}".format(name, r["wall_ms"], r["import_ms"],
+                                                     ",".join(r["heavy"]) or "-", note))
+
+    os.makedirs(os.path.dirname(os.path.abspath(config.output)), exist_ok=True)
+    with open(config.output, "a") as f:
+        f.write(json.dumps({"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0],
+                            "results": results}) + "\n")
+
+    if regressions:
+        print("\n{} entry point(s) slower than the previous run".format(len(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
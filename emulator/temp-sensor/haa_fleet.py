@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+'''
+##################################################################################
+## License
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/gpl-3.0.txt>.
+#
+##################################################################################
+
+Fleet of emulated HAA devices: N TemperatureSensor accessories of haa_device_emulator,
+each on its own port and mDNS name (HAA-XXXXXX), all in one process sharing one
+zeroconf instance. The accessories are already paired with a generated controller
+identity and the matching pairing file is written for haa_manager_cli, together with
+an inventory so the CLI locates them without ARP (there is none on loopback):
+
+    python haa_fleet.py -n 50 --dir /tmp/fleet
+    python haa_manager_cli.py --cache-dir /tmp/fleet -f /tmp/fleet/pairing.json -i "*" version
+'''
+import asyncio
+import json
+import logging
+import os
+import signal
+import time
+import uuid
+
+import configargparse
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+from pyhap import accessory_driver
+from pyhap.accessory_driver import AccessoryDriver
+from pyhap.const import HAP_PERMISSIONS
+from zeroconf.asyncio import AsyncZeroconf
+
+from haa_device_emulator import TemperatureSensor, Model, FirmwareVersion
+
+VERSION = '17/10/2026'
+AUTHOR = 'SW Engineer Garzola Marco'
+
+BASE_PORT = 21000  # below the Linux ephemeral range: client sockets never hold these
+MAC_PREFIX = "0A:AA"
+PAIRING_FILE = "pairing.json"
+INVENTORY_FILE = "inventory.json"  # same name haa_manager_cli looks for in --cache-dir
+
+parser = configargparse.ArgParser(default_config_files=[''])
+parser.add('-v', action='version', version=VERSION + "\n" + AUTHOR)
+parser.add('-n', '--count', type=int, default=10, help='number of emulated devices')
+parser.add('--dir', required=True, help='directory for the pairing file, the inventory and the accessory states')
+parser.add('--base-port', type=int, default=BASE_PORT, help='HAP port of the first device, the others follow')
+parser.add('--address', default='127.0.0.1', help='address the devices listen on and advertise')
+parser.add('-f', '--fw', default=FirmwareVersion, help='FW Version of the emulated devices')
+parser.add('-d', '--debug', action='store_true', default=False, help='log every accessory')
+
+
+class _HAAServiceInfo(accessory_driver.AccessoryMDNSServiceInfo):
+    """HAA firmware advertises its model as md, HAP-python the display name: discovery filters on it."""
+    def _get_advert_data(self):
+        data = super()._get_advert_data()
+        data["md"] = Model
+        return data
+
+
+accessory_driver.AccessoryMDNSServiceInfo = _HAAServiceInfo
+
+
+def _hex(key) -> str:
+    if isinstance(key, ed25519.Ed25519PrivateKey):
+        raw = key.private_bytes(serialization.Encoding.Raw, serialization.PrivateFormat.Raw,
+                                serialization.NoEncryption())
+    else:
+        raw = key.public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+    return raw.hex()
+
+
+def device_mac(index: int) -> str:
+    return "{}:{:02X}:{:02X}:{:02X}:{:02X}".format(MAC_PREFIX, (index >> 24) & 0xff, (index >> 16) & 0xff,
+                                                  (index >> 8) & 0xff, index & 0xff)
+
+
+def device_name(mac: str) -> str:
+    """HAA names devices after the last 3 MAC bytes: HAA-07AA1F."""
+    return "HAA-" + mac.replace(":", "")[-6:]
+
+
+def create_fleet(config, loop, zeroconf) -> list:
+    """Create the drivers, pair them with a fresh controller identity and write pairing file + inventory."""
+    state_dir = os.path.join(config.dir, "state")
+    os.makedirs(state_dir, exist_ok=True)
+
+    ios_key = ed25519.Ed25519PrivateKey.generate()
+    ios_id = str(uuid.uuid4())
+
+    drivers = []
+    pairings = {}
+    inventory = {}
+    for i in range(config.count):
+        mac = device_mac(i + 1)
+        name = device_name(mac)
+        port = config.base_port + i
+        persist_file = os.path.join(state_dir, name + ".state")
+        if os.path.exists(persist_file):
+            os.remove(persist_file)  # keys are regenerated with the pairing file
+
+        driver = AccessoryDriver(port=port, address=config.address, mac=mac, persist_file=persist_file,
+                                 loop=loop, async_zeroconf_instance=zeroconf)
+        driver.add_accessory(accessory=TemperatureSensor(config.fw, driver, name))
+        driver.state.add_paired_client(ios_id.encode(), ios_key.public_key().public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw), HAP_PERMISSIONS.ADMIN)
+        driver.persist()
+        drivers.append(driver)
+
+        pairings[name] = {
+            "AccessoryPairingID": mac,
+            "AccessoryLTPK": _hex(driver.state.public_key),
+            "iOSPairingId": ios_id,
+            "iOSDeviceLTSK": _hex(ios_key),
+            "iOSDeviceLTPK": _hex(ios_key.public_key()),
+            "AccessoryIP": config.address,
+            "AccessoryPort": port,
+            "Connection": "IP",
+        }
+        inventory[mac.lower()] = {'ip': config.address, 'mac': '', 'port': port, 'name': name,
+                                  'fw': config.fw, 'last_seen': time.time()}
+
+    for file_name, content in ((PAIRING_FILE, pairings), (INVENTORY_FILE, inventory)):
+        with open(os.path.join(config.dir, file_name), 'w') as f:
+            json.dump(content, f, indent=1)
+    return drivers
+
+
+async def run(config) -> None:
+    loop = asyncio.get_running_loop()
+    zeroconf = AsyncZeroconf()
+    drivers = create_fleet(config, loop, zeroconf)
+
+    start = time.monotonic()
+    await asyncio.gather(*(driver.async_start() for driver in drivers))
+    # a single line on stdout, for scripts waiting on the fleet
+    print("READY {} devices on {}:{}-{} in {:.1f}s".format(len(drivers), config.address, config.base_port,
+                                                          config.base_port + len(drivers) - 1,
+                                                          time.monotonic() - start), flush=True)
+
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    await stop.wait()
+
+    # AccessoryDriver.async_stop closes the zeroconf instance: with a shared one stop by hand
+    await zeroconf.async_unregister_all_services()
+    for driver in drivers:
+        driver.aio_stop_event.set()
+        driver.http_server.async_stop()
+    await zeroconf.async_close()
+
+
+if __name__ == '__main__':
+
+    config = parser.parse_args()
+    if not config.debug:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    asyncio.run(run(config))
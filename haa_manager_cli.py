@@ -15,32 +15,101 @@ along with this program.  If not, see <http://www.gnu.org/licenses/gpl-3.0.txt>.
 #
 ##################################################################################
 '''
+# Heavy modules (aiohomekit, zeroconf, requests) are imported where they are used, so
+# --help and the GitHub commands do not pay for them. The daemon client does not even
+# import asyncio and configargparse: it runs before them.
+from __future__ import annotations
+
+import json
+import os
+import socket
+import sys
+
+# Daemon ("serve") client
+DEVICE_COMMANDS = ('reboot', 'update', 'setup', 'wifi', 'dump', 'script', 'version')
+SESSION_ENDING_COMMANDS = ('reboot', 'update', 'setup', 'wifi')
+DAEMON_COMMANDS = DEVICE_COMMANDS + ('pipeline', 'backup', 'get', 'set')
+LOCAL_COMMANDS = ('scan', 'tags', 'custom', 'latest', 'watch', 'history', 'serve')  # never sent to a daemon
+
+
+def _daemon_request(socket_path: str, argv: list) -> None:
+    """Send a command to a running "serve" daemon and print its output."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(socket_path)
+        except OSError as e:
+            import logging
+            logging.basicConfig(format='%(asctime)s,%(levelname)s %(message)s', datefmt='%H:%M:%S')
+            logging.getLogger().error("Cannot reach the daemon on {}: {}".format(socket_path, e))
+            sys.exit(1)
+        s.sendall((json.dumps({'argv': argv}) + "\n").encode())
+        while chunk := s.recv(65536):
+            sys.stdout.write(chunk.decode(errors='replace'))
+    sys.stdout.flush()
+
+
+def _strip_option(argv: list, option: str) -> list:
+    """Remove `option VALUE` / `option=VALUE` from an argv list."""
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == option:
+            skip = True
+        elif not arg.startswith(option + "="):
+            result.append(arg)
+    return result
+
+
+def _daemon_client(argv: list) -> None:
+    """
+    `--daemon SOCKET <daemon command> ...`: send the command line to the daemon and exit.
+    Returns for any other command line, which main() parses. The daemon validates the
+    request itself; --daemon set in a config file is handled by main().
+    """
+    socket_path = None
+    n = 0
+    while n < len(argv):
+        arg = argv[n]
+        if arg in ('-h', '--help', '-v'):
+            return
+        if arg == '--daemon':
+            socket_path = argv[n + 1] if n + 1 < len(argv) else None
+            n += 2
+            continue
+        if arg.startswith('--daemon='):
+            socket_path = arg[len('--daemon='):]
+        elif arg in DAEMON_COMMANDS + LOCAL_COMMANDS:  # the subcommand: the global options precede it
+            if socket_path and arg in DAEMON_COMMANDS:
+                _daemon_request(socket_path, _strip_option(argv, '--daemon'))
+                sys.exit(0)
+            return
+        n += 1
+
+
+if __name__ == "__main__":
+    _daemon_client(sys.argv[1:])
 
 import argparse
 import base64
-import subprocess
-import aiohomekit
-import requests
-import socket, os
 import signal as unixsignal
-from logging.handlers import RotatingFileHandler
 import configargparse
-import urllib.request
-import socket
-import requests
-from concurrent.futures import ThreadPoolExecutor
-import argparse
+import urllib.parse
+import io
 import asyncio
+import collections
 from collections.abc import AsyncIterator
 import contextlib
 import logging
-import sys
 import re
-from zeroconf import InterfaceChoice
-from zeroconf.asyncio import AsyncServiceBrowser, AsyncZeroconf, AsyncServiceInfo
-from aiohomekit.zeroconf import ZeroconfServiceListener
-from aiohomekit import Controller
-from aiohomekit.model.categories import Categories
+import time
+import threading
+import ipaddress
+import math
+import functools
+import mmap
+import struct
 
 
 VERSION = '23/02/2023'
@@ -58,6 +127,9 @@ HAA_CUSTOM_SERVICE = "F0000100-0218-2017-81BF-AF2B7C833922"
 HAA_CUSTOM_CONFIG_CHAR = "F0000101-0218-2017-81BF-AF2B7C833922"
 HAA_CUSTOM_ADVANCED_CONFIG_CHAR = "F0000103-0218-2017-81BF-AF2B7C833922"
 SETUP_PORT = 4567
+DISCOVERY_QUIET_SEC = 1.5  # stop mDNS discovery after this long without new announcements once all are resolved
+DISCOVERY_RESOLVE_RETRIES = 3  # a burst of announcements makes some resolutions time out: try them again
+DISCOVERY_RETRY_SEC = 1.0
 
 # GitHub repository information
 REPO_OWNER = "RavenSystem"
@@ -65,15 +137,91 @@ REPO_NAME = "esp-homekit-devices"
 HEADER_FILE_PATH = "HAA/HAA_Main/main/header.h"
 
 ALL_DEVICES_WILDCARD = "*"
+DEFAULT_CONCURRENCY = 16
+OUTPUT_FORMATS = ('text', 'jsonl')
+
+# Staged OTA rollout defaults
+ROLLOUT_MAX_INFLIGHT = 2
+ROLLOUT_MAX_FAILURE_RATE = 0.2
+ROLLOUT_DEVICE_TIMEOUT = 600  # seconds for download + flash + reboot
+ROLLOUT_POLL_INTERVAL = 10
+
+# Convergence check after reboot, wifi and update (--wait-online)
+CONVERGE_COMMANDS = ('reboot', 'wifi', 'update')
+CONVERGE_FIRST_PROBE = 3  # seconds: give the device time to go down before probing it
+CONVERGE_BACKOFF_MAX = 30
+CONVERGE_PROBE_TIMEOUT = 5
+
+# Event subscriptions ("watch")
+WATCH_CHECK_INTERVAL = 2  # seconds between checks of the session state
+WATCH_KEEPALIVE = 60  # probe a device silent for this long: a powered-off device never closes its session
+
+# OTA log collector (the UDP log HAA devices send while updating)
+OTA_LOG_PORT = 45678
+OTA_LOG_MAX_LINES = 50  # kept per device
+OTA_LOG_MAX_LINE = 512
+OTA_LOG_REPORT_INTERVAL = 10
+OTA_PROGRESS_RE = re.compile(r'(\d{1,3})\s?%')
+OTA_DONE_RE = re.compile(r'\b(complete[d]?|finished|success(ful)?)\b', re.IGNORECASE)
+OTA_FAIL_RE = re.compile(r'\b(error|fail(ed|ure)?|abort(ed)?)\b', re.IGNORECASE)
+
+# Daemon ("serve") settings, the commands it runs are defined with its client above
+RELEASE_COMMANDS = ('version', 'update')  # the commands showing or comparing the latest release
+DAEMON_SOCKET_FILE = "haa.sock"
+DAEMON_IDLE_TIMEOUT = 300
+DAEMON_RESCAN_INTERVAL = 60
+DAEMON_HTTP_HOSTS = ('127.0.0.1', 'localhost', '::1')  # Host headers accepted by --http (DNS rebinding)
+DAEMON_HTTP_POST_COMMANDS = SESSION_ENDING_COMMANDS + ('set',)  # commands that change devices need a POST
 
 FILELOGSIZE = 1024 * 1024 * 10  # 10 mb max
 
+# Local on-disk caches (setup words, ...)
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "haa_manager_cli")
+CUSTOM_COMMAND_CACHE_FILE = "custom_commands.json"
+CUSTOM_COMMAND_CACHE_TTL = 30 * 24 * 3600  # released headers never change, master might
+CUSTOM_COMMAND_FALLBACK_TTL = 24 * 3600  # the master word standing in for a tag header not published yet
+CUSTOM_COMMAND_CACHE_MAX = 64
+LATEST_RELEASE_CACHE_FILE = "latest_release.json"
+INVENTORY_FILE = "inventory.json"
+INVENTORY_PROBE_TIMEOUT = 0.5
+ACCESSORY_CACHE_FILE = "accessories.json"
+CONFIG_NUM_TIMEOUT = 2.0  # wait for the device's mDNS c# at most this long
+BACKUP_DIR = "backup"
+
+# Time-series store of characteristic values (get/watch --record, history)
+HISTORY_DIR = "history"
+HISTORY_RAW_DAYS = 7  # raw samples are downsampled to HISTORY_BUCKET aggregates after this many days
+HISTORY_DAYS = 365  # aggregates are deleted after this many days
+HISTORY_BUCKET = 300
+
+# Network scanner defaults
+SCAN_CONCURRENCY = 256
+ARP_REFRESH_INTERVAL = 0.25
+SCAN_TIMEOUT = 0.5
+SETUP_SCAN_CONCURRENCY = 2048  # the setup sweep probes one port only: one round of connects
+SETUP_SCAN_TIMEOUT = 0.8
+GITHUB_TIMEOUT = 10
+
 
 # GitHub related functions
+_github_session = None
+
+
+def get_github_session() -> requests.Session:
+    """Shared, connection-pooled HTTP session for all GitHub requests."""
+    import requests
+    global _github_session
+    if _github_session is None:
+        _github_session = requests.Session()
+        _github_session.headers.update({"Accept": "application/vnd.github+json"})
+    return _github_session
+
+
 def get_all_tags(debug=False):
     """
     Fetch and print all tags from the GitHub repository using pagination.
     """
+    import requests
     per_page = 100
     page = 1
     tags = []
@@ -85,7 +233,7 @@ def get_all_tags(debug=False):
         if debug:
             print(f"[DEBUG] Requesting: {url}")
         try:
-            response = requests.get(url)
+            response = get_github_session().get(url, timeout=GITHUB_TIMEOUT)
             response.raise_for_status()
             data = response.json()
 
@@ -113,56 +261,203 @@ def get_latest_release(debug=False):
     """
     Fetch and return the latest release tag from GitHub.
     """
-    url = f"https://api.github.com/repos/{REPO_OWNER}/{REPO_NAME}/releases/latest"
-    if debug:
-        print(f"[DEBUG] Requesting latest release from: {url}")
-    try:
-        response = requests.get(url)
-        response.raise_for_status()
-        data = response.json()
-        tag_name = data.get("tag_name")
-        if tag_name:
-            print(f"✅ Latest release tag: {tag_name}")
-            return tag_name
-        else:
-            print("⚠️ No tag_name found in latest release.")
-            return None
-    except requests.RequestException as e:
-        print(f"❌ Error fetching latest release: {e}")
+    tag_name = Context.get().get_release_resolver().resolve(debug)
+    if tag_name:
+        print(f"✅ Latest release tag: {tag_name}")
+        return tag_name
+    else:
+        print("⚠️ No latest release tag available.")
         return None
 
+
+class _LatestReleaseResolver:
+    """
+    Resolves the latest GitHub release tag at most once per run.
+    The last answer is persisted together with its ETag so that later runs only
+    make a conditional (If-None-Match) request, which GitHub answers with a cheap
+    304 that does not count against the rate limit.
+    """
+    def __init__(self, path: str, offline: bool = False):
+        self.path = path
+        self.offline = offline
+        self._lock = threading.Lock()
+        self._resolved = False
+        self._tag = None
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as f:
+                cached = json.load(f)
+            return cached if isinstance(cached, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, cached: dict) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(cached, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.getLogger().debug("latest release cache: cannot write %s: %s", self.path, e)
+
+    def _fetch(self, cached: dict, debug=False):
+        import requests
+        log = logging.getLogger()
+        url = f"https://api.github.com/repos/{REPO_OWNER}/{REPO_NAME}/releases/latest"
+        headers = {}
+        if cached.get('etag') and cached.get('tag'):
+            headers['If-None-Match'] = cached['etag']
+        if debug:
+            print(f"[DEBUG] Requesting latest release from: {url} (etag: {headers.get('If-None-Match')})")
+        try:
+            response = get_github_session().get(url, headers=headers, timeout=GITHUB_TIMEOUT)
+        except requests.RequestException as e:
+            log.warning("Error fetching latest release: %s", e)
+            return cached.get('tag')
+
+        if response.status_code == 304:
+            log.debug("latest release: not modified (%s)", cached.get('tag'))
+            cached['ts'] = time.time()
+            self._save(cached)
+            return cached.get('tag')
+
+        if response.status_code in (403, 429) and (response.headers.get('X-RateLimit-Remaining') == '0'
+                                                   or 'Retry-After' in response.headers):
+            reset = response.headers.get('X-RateLimit-Reset')
+            when = time.strftime('%H:%M:%S', time.localtime(int(reset))) if reset else "later"
+            log.warning("GitHub rate limit exceeded, retry after %s; using cached release %s",
+                        when, cached.get('tag'))
+            return cached.get('tag')
+
+        try:
+            response.raise_for_status()
+            data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            log.warning("Error fetching latest release: %s", e)
+            return cached.get('tag')
+
+        tag = data.get("tag_name") or data.get("name")
+        if tag:
+            self._save({'etag': response.headers.get('ETag'), 'tag': tag, 'ts': time.time()})
+        return tag
+
+    def resolve(self, debug=False):
+        """Return the latest release tag (or None), hitting the network at most once."""
+        with self._lock:
+            if not self._resolved:
+                cached = self._load()
+                if self.offline:
+                    self._tag = cached.get('tag')
+                else:
+                    with Context.get().get_metrics().phase('github_release'):
+                        self._tag = self._fetch(cached, debug)
+                self._resolved = True
+            return self._tag
+
 def get_custom_haa_command(version_tag="master", debug=False):
     """
     Retrieve the CUSTOM_HAA_COMMAND value from header.h for the given tag.
+    Reached from device commands too: the outcome is logged (stderr), never printed,
+    so it cannot corrupt the --output jsonl stream.
     """
+    import requests
+    log = logging.getLogger()
     url = f"https://raw.githubusercontent.com/{REPO_OWNER}/{REPO_NAME}/{version_tag}/{HEADER_FILE_PATH}"
 
     try:
-        response = requests.get(url)
+        response = get_github_session().get(url, timeout=GITHUB_TIMEOUT)
         response.raise_for_status()
     except requests.RequestException as e:
-        print(f"❌ Error fetching header file: {e}")
+        log.error("Error fetching header file: %s", e)
         return None
 
     content = response.text
 
     if debug:
-        print(f"\n📥 Fetching header file from: {url}")
-        print("[DEBUG] First 5 lines of header file:")
+        log.debug("Fetching header file from: %s", url)
         for line in content.splitlines()[:5]:
-            print(f"  {line}")
+            log.debug("  %s", line)
 
     match = re.search(r'#define\s+CUSTOM_HAA_COMMAND\s+"([^"]+)"', content)
 
     if match:
         command = match.group(1)
-        print(f"✅ CUSTOM_HAA_COMMAND found: \"{command}\"")
+        log.info('CUSTOM_HAA_COMMAND found for %s: "%s"', version_tag, command)
         return command
     else:
-        print("⚠️ CUSTOM_HAA_COMMAND not found.")
+        log.warning("CUSTOM_HAA_COMMAND not found for %s", version_tag)
         return None
 
 
+class _CustomCommandCache:
+    """
+    On-disk cache of CUSTOM_HAA_COMMAND setup words keyed by firmware version.
+    Entries expire after `ttl` seconds, fallback entries (the master word of a version
+    whose tag has no header file yet) after `fallback_ttl`; the oldest entries are
+    evicted beyond `max_entries`.
+    """
+    def __init__(self, path: str, ttl: int = CUSTOM_COMMAND_CACHE_TTL, max_entries: int = CUSTOM_COMMAND_CACHE_MAX,
+                 fallback_ttl: int = CUSTOM_COMMAND_FALLBACK_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.fallback_ttl = fallback_ttl
+        self.max_entries = max_entries
+        self._entries = None
+
+    def _load(self) -> dict:
+        if self._entries is None:
+            self._entries = {}
+            try:
+                with open(self.path) as f:
+                    raw = json.load(f)
+                if isinstance(raw, dict):
+                    self._entries = {k: v for k, v in raw.items()
+                                     if isinstance(v, dict) and v.get('word')}
+            except (OSError, ValueError):
+                pass
+        return self._entries
+
+    def _save(self) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self._entries, f, indent=1)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.getLogger().debug("custom command cache: cannot write %s: %s", self.path, e)
+
+    def get(self, version: str, allow_expired: bool = False):
+        entry = self._load().get(version)
+        if entry is None:
+            return None
+        ttl = self.fallback_ttl if entry.get('fallback') else self.ttl
+        if not allow_expired and time.time() - entry.get('ts', 0) > ttl:
+            return None
+        return entry['word']
+
+    def expires_in(self, version: str) -> float:
+        """Seconds until the entry of `version` expires, `fallback_ttl` without an entry."""
+        entry = self._load().get(version)
+        if entry is None:
+            return self.fallback_ttl
+        ttl = self.fallback_ttl if entry.get('fallback') else self.ttl
+        return entry.get('ts', 0) + ttl - time.time()
+
+    def put(self, version: str, word: str, fallback: bool = False) -> None:
+        entries = self._load()
+        entries[version] = {'word': word, 'ts': time.time()}
+        if fallback:
+            entries[version]['fallback'] = True
+        if len(entries) > self.max_entries:
+            oldest = sorted(entries, key=lambda k: entries[k].get('ts', 0))
+            for k in oldest[:len(entries) - self.max_entries]:
+                del entries[k]
+        self._save()
+
+
 parser = configargparse.ArgParser(default_config_files=[''])
 parser.add("-l", "--log", nargs=1, metavar=("log File"), default=False,
            help=" path file to save log")
@@ -171,6 +466,22 @@ parser.add('-d', '--debug', action='store_true', default=False, help='debug mode
 parser.add('-t', '--timeout', required=False, type=int, default=10, help='Number of seconds to wait')
 parser.add('-f', action='store', required=False, dest='file', help='File with the pairing data')
 parser.add('-i', action='store', required=False, dest='id', default=ALL_DEVICES_WILDCARD, help='pairID of device found online,shown on scan. wildcard "*" means all')
+parser.add('--offline', action='store_true', default=False, help='never contact GitHub, use cached data only')
+parser.add('--cache-dir', required=False, default=CACHE_DIR, help='directory for the local caches')
+parser.add('--history-dir', required=False, help='time-series store of --record (default: <cache-dir>/history)')
+parser.add('--full-scan', action='store_true', default=False, help='ignore the device inventory and scan the whole network')
+parser.add('--subnet', action='append', default=[], help='CIDR to scan for devices, can be repeated (default: local /24)')
+parser.add('--interface', action='append', default=[], help='scan the networks of this interface, can be repeated')
+parser.add('--scan-concurrency', type=int,
+           help='max connection attempts in flight while scanning (default: {}, {} for the setup mode sweep of scan)'.format(
+               SCAN_CONCURRENCY, SETUP_SCAN_CONCURRENCY))
+parser.add('--scan-rate', type=float, default=0, help='max connection attempts per second while scanning (0 = unlimited)')
+parser.add('--daemon', metavar='SOCKET', help='send the command to a "serve" daemon listening on SOCKET')
+parser.add('-c', '--concurrency', required=False, type=int, default=DEFAULT_CONCURRENCY, help='max number of devices to connect to at the same time')
+parser.add('--output', choices=OUTPUT_FORMATS, default='text', help='jsonl: one JSON record per device as soon as its discovery, connection or command completes')
+parser.add('--wait-online', type=int, default=0, metavar='SECONDS', help='after reboot, wifi or update wait up to SECONDS for every device to be back online (0 = do not wait)')
+parser.add('--timings', action='store_true', default=False, help='print the time spent in every phase of the run, with percentiles over the devices')
+parser.add('--metrics-file', metavar='PATH', help='write the phase timings of the run to PATH: Prometheus textfile if it ends with .prom, JSON otherwise')
 
 subparsers = parser.add_subparsers(dest='command', required=True, help="Commands to execute")
 
@@ -178,10 +489,18 @@ script_parser = subparsers.add_parser('script', help="Run a script action")
 script_parser.add_argument('params', nargs=argparse.REMAINDER, help="Parameters for the script")
 
 update_parser = subparsers.add_parser('update', help="Update action")
+update_parser.add_argument('--canary', type=int, default=0, help="number of devices updated first, before any wave")
+update_parser.add_argument('--wave-size', type=int, default=0, help="devices per rollout wave; 0 starts all updates at once without waiting")
+update_parser.add_argument('--max-inflight', type=int, default=ROLLOUT_MAX_INFLIGHT, help="max devices downloading firmware at the same time within a wave")
+update_parser.add_argument('--max-failure-rate', type=float, default=ROLLOUT_MAX_FAILURE_RATE, help="halt the rollout when the failed/attempted ratio exceeds this value")
+update_parser.add_argument('--update-timeout', type=int, default=ROLLOUT_DEVICE_TIMEOUT, help="seconds to wait for a device to come back on the new firmware")
+update_parser.add_argument('--watch-ota', action='store_true', default=False, help="collect the UDP update log of every device and wait until each update completed or failed")
+update_parser.add_argument('--ota-port', type=int, default=OTA_LOG_PORT, help="UDP port the devices send their update log to")
 reboot_parser = subparsers.add_parser('reboot', help="Reboot action")
 setup_parser = subparsers.add_parser('setup', help="Setup action")
 wifi_parser = subparsers.add_parser('wifi', help="WiFi action")
 dump_parser = subparsers.add_parser('dump', help="Dump action")
+dump_parser.add_argument('--out', metavar='PATH', help="write the accessory databases to PATH as compact JSON instead of printing them")
 scan_parser = subparsers.add_parser('scan', help="Scan action")
 version_parser = subparsers.add_parser('version', help="Get version action")
 
@@ -192,6 +511,550 @@ custom_parser.add_argument('--tag', help="GitHub tag or branch (default: master)
 custom_parser.add_argument('--version', help="HAA version (e.g., 12.14.6)")
 latest_parser = subparsers.add_parser('latest', help="Get the latest GitHub release tag")
 
+pipeline_parser = subparsers.add_parser('pipeline', help="Run several commands on each device over one connection")
+pipeline_parser.add_argument('commands', help="comma separated commands, e.g. version,script,dump")
+
+backup_parser = subparsers.add_parser('backup', help="Back up the scripts of the devices into a content-addressed store")
+backup_parser.add_argument('--dir', dest='backup_dir', help="backup store directory (default: <cache-dir>/backup)")
+
+get_parser = subparsers.add_parser('get', help="Read characteristics of every device")
+get_parser.add_argument('selector', help="comma separated characteristic types (e.g. CurrentTemperature,On or a UUID) or aid.iid")
+get_parser.add_argument('--record', action='store_true', help="append the numeric values to the time-series store")
+
+set_parser = subparsers.add_parser('set', help="Write characteristics of every device")
+set_parser.add_argument('assignments', help="comma separated SELECTOR=VALUE (e.g. On=false,Brightness=40 or 1.10=1)")
+set_parser.add_argument('--category', help="only devices of this HomeKit category (e.g. Switch)")
+
+watch_parser = subparsers.add_parser('watch', help="Stream the changes of characteristics of every device")
+watch_parser.add_argument('selector', help="comma separated characteristic types (e.g. CurrentTemperature,On or a UUID) or aid.iid")
+watch_parser.add_argument('--duration', type=float, default=0, help="stop after SECONDS (default: 0, until Ctrl+C)")
+watch_parser.add_argument('--record', action='store_true', help="append the numeric values to the time-series store")
+
+history_parser = subparsers.add_parser('history', help="min, max and mean of the recorded values")
+history_parser.add_argument('selector', nargs='?', help="comma separated characteristic types or aid.iid (default: all)")
+history_parser.add_argument('--since', default='24h', help="start: a duration before now (30m, 24h, 7d) or a date (default: 24h)")
+history_parser.add_argument('--until', help="end: a duration before now or a date (default: now)")
+history_parser.add_argument('--step', help="one row per STEP (e.g. 1h) instead of one for the whole range")
+
+serve_parser = subparsers.add_parser('serve', help="Run as a daemon keeping device sessions open")
+serve_parser.add_argument('--socket', help="Unix socket to listen on (default: <cache-dir>/haa.sock)")
+serve_parser.add_argument('--http', type=int, default=0, metavar='PORT', help="also accept requests on http://127.0.0.1:PORT")
+serve_parser.add_argument('--idle-timeout', type=int, default=DAEMON_IDLE_TIMEOUT, help="seconds after which an unused device session is closed")
+
+
+class _DeviceInventory:
+    """
+    Persisted last known location of every device, keyed by lowercase AccessoryPairingID:
+    {'ip', 'mac', 'port', 'name', 'fw', 'last_seen'}.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._entries = None
+
+    def _load(self) -> dict:
+        if self._entries is None:
+            self._entries = {}
+            try:
+                with open(self.path) as f:
+                    raw = json.load(f)
+                if isinstance(raw, dict):
+                    self._entries = {k: v for k, v in raw.items() if isinstance(v, dict) and v.get('ip')}
+            except (OSError, ValueError):
+                pass
+        return self._entries
+
+    def get(self, pid: str):
+        return self._load().get(pid.lower())
+
+    def update(self, pid: str, **fields) -> None:
+        entry = self._load().setdefault(pid.lower(), {})
+        entry.update({k: v for k, v in fields.items() if v is not None})
+        entry['last_seen'] = time.time()
+
+    def save(self) -> None:
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self._load(), f, indent=1)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.getLogger().debug("inventory: cannot write %s: %s", self.path, e)
+
+
+class _AccessoryCache:
+    """
+    Persisted accessory databases (the list_accessories_and_characteristics answer) keyed by
+    lowercase AccessoryPairingID: {'c#', 'accessories'}. A device changes its HAP configuration
+    number (c# in its mDNS TXT record) whenever its database changes, so an entry is valid
+    as long as the c# announced by the device is the stored one.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._entries = None
+        self._unconfirmed = {}  # pid -> accessories read before the c# of the device was heard
+        self._dirty = False
+
+    def _load(self) -> dict:
+        if self._entries is None:
+            self._entries = {}
+            try:
+                with open(self.path) as f:
+                    raw = json.load(f)
+                if isinstance(raw, dict):
+                    self._entries = {k: v for k, v in raw.items()
+                                     if isinstance(v, dict) and isinstance(v.get('accessories'), list)}
+            except (OSError, ValueError):
+                pass
+        return self._entries
+
+    def has(self, pid: str) -> bool:
+        """Whether an entry of `pid` exists, whatever its c#."""
+        return pid.lower() in self._load()
+
+    def get(self, pid: str, config_num):
+        """The cached accessories of `pid` if they belong to `config_num`, None otherwise."""
+        entry = self._load().get(pid.lower())
+        if entry is None or config_num is None or entry.get('c#') != config_num:
+            return None
+        return entry['accessories']
+
+    def put(self, pid: str, config_num, accessories: list) -> None:
+        """Store an entry; without `config_num` it is kept in memory until confirm() knows it."""
+        if config_num is None:
+            self._unconfirmed[pid.lower()] = accessories
+            return
+        self._unconfirmed.pop(pid.lower(), None)
+        self._load()[pid.lower()] = {'c#': config_num, 'accessories': accessories}
+        self._dirty = True
+
+    def confirm(self, pid: str, config_num) -> None:
+        """Store the unconfirmed entry of `pid` now that its c# is known."""
+        accessories = self._unconfirmed.pop(pid.lower(), None)
+        if accessories is not None and config_num is not None:
+            self.put(pid, config_num, accessories)
+
+    def save(self) -> None:
+        if not self._dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self._load(), f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        except OSError as e:
+            logging.getLogger().debug("accessory cache: cannot write %s: %s", self.path, e)
+
+
+class _PairingStore:
+    """
+    The pairing file, parsed once and kept in memory. The prescan patches device IPs in
+    place and only the selected pairings are handed to the controller, so no patched copy
+    of the key material is ever written to disk.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._raw = None
+
+    def entries(self) -> dict:
+        """{alias -> pairing data}, parsed on first use."""
+        if self._raw is None:
+            with open(self.path) as f:
+                raw = json.load(f)
+            if not isinstance(raw, dict):
+                raise ValueError("not a JSON object")
+            self._raw = {k: v for k, v in raw.items() if isinstance(v, dict)}
+        return self._raw
+
+    @staticmethod
+    def pairing_id(data: dict) -> str:
+        return data.get('AccessoryPairingID', '').lower()
+
+    def select(self, pairing_id: str = ALL_DEVICES_WILDCARD) -> dict:
+        """{alias -> pairing data} of the pairings matching `pairing_id` ("*" = all)."""
+        if pairing_id == ALL_DEVICES_WILDCARD:
+            return dict(self.entries())
+        pairing_id = pairing_id.lower()
+        return {alias: data for alias, data in self.entries().items() if self.pairing_id(data) == pairing_id}
+
+    def alias_of(self, pairing_id: str):
+        for alias, data in self.entries().items():
+            if self.pairing_id(data) == pairing_id.lower():
+                return alias
+        return None
+
+    def friendly_names(self) -> dict:
+        """lowercase AccessoryPairingID -> friendly name (e.g. HAA-07AA1F)."""
+        return {self.pairing_id(data): alias for alias, data in self.entries().items() if self.pairing_id(data)}
+
+    def patch_ip(self, alias: str, ip: str) -> None:
+        """Point every address-like key of a pairing at `ip`."""
+        entry = self.entries()[alias]
+        for key, val in list(entry.items()):
+            if any(x in key.lower() for x in ('ip', 'address', 'host', 'addr')):
+                entry[key] = [ip] if isinstance(val, list) else ip
+        entry.setdefault('AccessoryIP', ip)
+
+
+class _ScriptStore:
+    """
+    Content-addressed store of device scripts: every distinct script is kept once, gzipped,
+    as objects/<sha256[:2]>/<sha256>.gz; every backup run writes manifests/<time>.json
+    mapping each device to the hash of its script. Identical and unchanged scripts cost
+    nothing but a manifest line.
+    """
+    def __init__(self, path: str):
+        self.path = path
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.path, "objects", digest[:2], digest + ".gz")
+
+    def put(self, script: str) -> tuple:
+        """Store a script; returns (sha256, compressed bytes written: 0 when the blob already existed)."""
+        import gzip
+        import hashlib
+        data = script.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._blob_path(digest)
+        if os.path.exists(path):
+            return digest, 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        blob = gzip.compress(data, mtime=0)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(blob)
+        os.replace(tmp_path, path)
+        return digest, len(blob)
+
+    def get(self, digest: str) -> str:
+        import gzip
+        with open(self._blob_path(digest), 'rb') as f:
+            return gzip.decompress(f.read()).decode('utf-8')
+
+    def write_manifest(self, devices: dict) -> str:
+        """Write the manifest of one run ({device id -> entry}); returns its path."""
+        os.makedirs(os.path.join(self.path, "manifests"), exist_ok=True)
+        stem = os.path.join(self.path, "manifests", time.strftime('%Y%m%d-%H%M%S'))
+        path, n = stem + ".json", 1
+        while os.path.exists(path):
+            path, n = "{}-{}.json".format(stem, n), n + 1
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'timestamp': time.time(), 'devices': devices}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+        return path
+
+
+class _SeriesAgg:
+    """min / max / mean of the samples of one time bucket."""
+    __slots__ = ('count', 'min', 'max', 'total')
+
+    def __init__(self):
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self.total = 0.0
+
+    def add(self, value: float, count: int = 1, low: float = None, high: float = None) -> None:
+        """One sample, or an aggregate of `count` samples with mean `value`."""
+        self.count += count
+        self.total += value * count
+        self.min = min(self.min, value if low is None else low)
+        self.max = max(self.max, value if high is None else high)
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else None
+
+
+class _SeriesStore:
+    """
+    Time series of numeric characteristic values, one directory per device and characteristic
+    (<pid>/<aid>.<iid>/) with one segment file per UTC day:
+      <day>.raw  packed (ms into the day: uint32, value: float32), 8 bytes a sample, append only
+      <day>.agg  packed (s into the day: uint32, min, max, mean: float32, count: uint32), one per
+                 HISTORY_BUCKET seconds: raw days older than HISTORY_RAW_DAYS are downsampled to it
+    Aggregates older than HISTORY_DAYS are deleted, by the first append of a series on a new day
+    and by compact() for all series once a day. Segments are read through mmap, located by
+    binary search on the time field: a query touches only the samples in its range.
+    <pid>/series.json names the device and the type of every series.
+    """
+    RAW = struct.Struct('<If')
+    AGG = struct.Struct('<IfffI')
+    FORMATS = ('bool', 'uint8', 'uint16', 'uint32', 'uint64', 'int', 'float')  # the characteristics it keeps
+
+    def __init__(self, path: str):
+        self.path = path
+        self._files = {}  # (pid, aid, iid) -> [day, open .raw segment]
+        self._index = {}  # pid -> series.json content
+
+    def _device_dir(self, pid: str) -> str:
+        return os.path.join(self.path, pid.lower().replace(':', ''))
+
+    def _series_dir(self, pid: str, aid: int, iid: int) -> str:
+        return os.path.join(self._device_dir(pid), "{}.{}".format(aid, iid))
+
+    def _load_index(self, pid: str) -> dict:
+        if pid not in self._index:
+            try:
+                with open(os.path.join(self._device_dir(pid), "series.json")) as f:
+                    self._index[pid] = json.load(f)
+            except (OSError, ValueError):
+                self._index[pid] = {'id': pid, 'name': None, 'series': {}}
+        return self._index[pid]
+
+    def describe(self, pid: str, name: str, aid: int, iid: int, type_: str, char_name: str) -> None:
+        """Record the device name and characteristic type of a series (written when it changes)."""
+        index = self._load_index(pid)
+        entry = {'type': type_, 'name': char_name}
+        key = "{}.{}".format(aid, iid)
+        if index.get('name') == name and index['series'].get(key) == entry:
+            return
+        index['name'] = name
+        index['series'][key] = entry
+        os.makedirs(self._device_dir(pid), exist_ok=True)
+        path = os.path.join(self._device_dir(pid), "series.json")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+
+    def append(self, pid: str, aid: int, iid: int, ts: float, value) -> bool:
+        """Append one sample; False for values that are not numbers."""
+        if isinstance(value, bool):
+            value = float(value)
+        elif not isinstance(value, (int, float)):
+            return False
+        day, ms = divmod(int(ts * 1000), 86400000)
+        key = (pid, aid, iid)
+        current = self._files.get(key)
+        if current is None or current[0] != day:
+            if current is not None:
+                current[1].close()
+            series_dir = self._series_dir(pid, aid, iid)
+            os.makedirs(series_dir, exist_ok=True)
+            self._compact_series(series_dir, day)
+            current = self._files[key] = [day, open(os.path.join(series_dir, "{}.raw".format(day)), 'ab')]
+        current[1].write(self.RAW.pack(ms, value))
+        current[1].flush()
+        return True
+
+    def close(self) -> None:
+        for _, f in self._files.values():
+            f.close()
+        self._files.clear()
+
+    def compact(self, now: float = None) -> None:
+        """
+        Downsample and expire the segments of every series, including those no longer appended
+        to (removed devices or characteristics). Runs at most once per UTC day.
+        """
+        today = int(time.time() if now is None else now) // 86400
+        marker = os.path.join(self.path, "compacted")
+        try:
+            with open(marker) as f:
+                if int(f.read().strip()) >= today:
+                    return
+        except (OSError, ValueError):
+            pass
+        if not os.path.isdir(self.path):
+            return
+        for device in os.listdir(self.path):
+            device_dir = os.path.join(self.path, device)
+            if not os.path.isdir(device_dir):
+                continue
+            for series in os.listdir(device_dir):
+                series_dir = os.path.join(device_dir, series)
+                if os.path.isdir(series_dir):
+                    self._compact_series(series_dir, today)
+        with open(marker, 'w') as f:
+            f.write(str(today))
+
+    def _compact_series(self, series_dir: str, today: int) -> None:
+        """Downsample the raw segments older than HISTORY_RAW_DAYS, drop what is older than HISTORY_DAYS."""
+        for entry in os.listdir(series_dir):
+            stem, _, ext = entry.partition('.')
+            if not stem.isdigit():
+                continue
+            day = int(stem)
+            path = os.path.join(series_dir, entry)
+            if day <= today - HISTORY_DAYS:
+                os.remove(path)
+            elif ext == 'raw' and day <= today - HISTORY_RAW_DAYS:
+                buckets = collections.defaultdict(_SeriesAgg)
+                for ms, value in self._records(path, self.RAW):
+                    buckets[ms // 1000 // HISTORY_BUCKET * HISTORY_BUCKET].add(value)
+                agg_path = os.path.join(series_dir, "{}.agg".format(day))
+                with open(agg_path + ".tmp", 'wb') as f:
+                    for start in sorted(buckets):
+                        b = buckets[start]
+                        f.write(self.AGG.pack(start, b.min, b.max, b.mean, b.count))
+                os.replace(agg_path + ".tmp", agg_path)
+                os.remove(path)
+
+    @staticmethod
+    def _records(path: str, rec: struct.Struct, start: int = 0, end: int = None):
+        """The records of a segment whose time field is in [start, end), read through mmap."""
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            n = size // rec.size  # a torn last record (crash while appending) is ignored
+            if n == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                def lower_bound(key):
+                    lo, hi = 0, n
+                    while lo < hi:
+                        mid = (lo + hi) // 2
+                        if rec.unpack_from(mm, mid * rec.size)[0] < key:
+                            lo = mid + 1
+                        else:
+                            hi = mid
+                    return lo
+                first = lower_bound(start) if start > 0 else 0
+                last = lower_bound(end) if end is not None else n
+                for i in range(first, last):
+                    yield rec.unpack_from(mm, i * rec.size)
+
+    def devices(self) -> list:
+        """Pairing ids with a series.json."""
+        if not os.path.isdir(self.path):
+            return []
+        pids = []
+        for entry in sorted(os.listdir(self.path)):
+            path = os.path.join(self.path, entry, "series.json")
+            if os.path.exists(path):
+                with contextlib.suppress(OSError, ValueError), open(path) as f:
+                    index = json.load(f)
+                    self._index[index['id']] = index
+                    pids.append(index['id'])
+        return pids
+
+    def index(self, pid: str) -> dict:
+        """series.json of a device: {'id', 'name', 'series': {"aid.iid" -> {'type', 'name'}}}."""
+        return self._load_index(pid)
+
+    def query(self, pid: str, aid: int, iid: int, since: float, until: float, step: float = None) -> list:
+        """[(bucket start, _SeriesAgg)] of the samples in [since, until), one bucket when `step` is None."""
+        series_dir = self._series_dir(pid, aid, iid)
+        buckets = collections.defaultdict(_SeriesAgg)
+
+        def bucket(ts):
+            return since if not step else since + max(0.0, (ts - since) // step) * step
+
+        since_ms, until_ms = int(since * 1000), int(until * 1000)  # the time keys of append()
+        for day in range(since_ms // 86400000, (until_ms - 1) // 86400000 + 1):
+            start, end = max(0, since_ms - day * 86400000), min(86400000, until_ms - day * 86400000)
+            raw = os.path.join(series_dir, "{}.raw".format(day))
+            agg = os.path.join(series_dir, "{}.agg".format(day))
+            if os.path.exists(raw):
+                for ms, value in self._records(raw, self.RAW, start, end):
+                    buckets[bucket(day * 86400 + ms / 1000)].add(value)
+            elif os.path.exists(agg):
+                for sec, low, high, mean, count in self._records(agg, self.AGG, math.ceil(start / 1000),
+                                                                 math.ceil(end / 1000)):
+                    buckets[bucket(day * 86400 + sec)].add(mean, count, low, high)
+        return sorted(buckets.items())
+
+
+def _percentile(values: list, q: float) -> float:
+    """Nearest-rank percentile of sorted `values`."""
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+class _PhaseTimer:
+    """
+    Wall time of the phases of a run (scan, ARP matching, load_data, pair-verify,
+    GitHub requests, put_characteristics, ...), per device when the phase belongs to one.
+    Feeds the --timings table and the --metrics-file report.
+    """
+    def __init__(self):
+        self.start = time.monotonic()
+        self.samples = {}  # phase -> [(seconds, device id or None)]
+        self.devices = {}  # device id -> {phase -> seconds}
+        self._lock = threading.Lock()  # GitHub requests are timed in worker threads
+
+    @contextlib.contextmanager
+    def phase(self, name: str, device: str = None):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - start, device)
+
+    def add(self, name: str, seconds: float, device: str = None) -> None:
+        with self._lock:
+            self.samples.setdefault(name, []).append((seconds, device))
+            if device is not None:
+                phases = self.devices.setdefault(device, {})
+                phases[name] = phases.get(name, 0.0) + seconds
+
+    def summary(self) -> dict:
+        """phase -> {count, sum, p50, p90, p99, max, slowest}, in seconds."""
+        result = {}
+        for name, samples in self.samples.items():
+            values = sorted(s for s, _ in samples)
+            slowest = max(samples, key=lambda s: s[0])
+            result[name] = {'count': len(values), 'sum': sum(values), 'p50': _percentile(values, 0.5),
+                            'p90': _percentile(values, 0.9), 'p99': _percentile(values, 0.99),
+                            'max': values[-1], 'slowest': slowest[1]}
+        return result
+
+    def table(self) -> str:
+        lines = ["{:24s} {:>6s} {:>9s} {:>9s} {:>9s} {:>9s} {:>9s}  {}".format(
+            "phase (ms)", "count", "total", "p50", "p90", "p99", "max", "slowest")]
+        for name, s in sorted(self.summary().items(), key=lambda i: -i[1]['sum']):
+            lines.append("{:24s} {:6d} {:9.1f} {:9.1f} {:9.1f} {:9.1f} {:9.1f}  {}".format(
+                name, s['count'], *(s[k] * 1000 for k in ('sum', 'p50', 'p90', 'p99', 'max')), s['slowest'] or ''))
+        lines.append("{:24s} {:6s} {:9.1f}".format("run", "", (time.monotonic() - self.start) * 1000))
+        return "\n".join(lines)
+
+    def report(self, command: str) -> dict:
+        return {'command': command, 'timestamp': time.time(), 'duration': time.monotonic() - self.start,
+                'phases': self.summary(), 'devices': self.devices}
+
+    def prometheus(self, command: str) -> str:
+        def esc(v):
+            return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        report = self.report(command)
+        cmd = esc(command)
+        lines = ["# HELP haa_phase_duration_seconds Wall time of a phase of the last haa_manager_cli run.",
+                 "# TYPE haa_phase_duration_seconds summary"]
+        for name, s in sorted(report['phases'].items()):
+            labels = 'command="{}",phase="{}"'.format(cmd, esc(name))
+            for quantile, key in (('0.5', 'p50'), ('0.9', 'p90'), ('0.99', 'p99')):
+                lines.append('haa_phase_duration_seconds{{{},quantile="{}"}} {:.6f}'.format(labels, quantile, s[key]))
+            lines.append('haa_phase_duration_seconds_sum{{{}}} {:.6f}'.format(labels, s['sum']))
+            lines.append('haa_phase_duration_seconds_count{{{}}} {}'.format(labels, s['count']))
+        lines += ["# HELP haa_device_phase_duration_seconds Wall time of a phase for one device.",
+                  "# TYPE haa_device_phase_duration_seconds gauge"]
+        for device, phases in sorted(report['devices'].items()):
+            for name, seconds in sorted(phases.items()):
+                lines.append('haa_device_phase_duration_seconds{{command="{}",device="{}",phase="{}"}} {:.6f}'.format(
+                    cmd, esc(device), esc(name), seconds))
+        lines += ["# HELP haa_run_duration_seconds Wall time of the last haa_manager_cli run.",
+                  "# TYPE haa_run_duration_seconds gauge",
+                  'haa_run_duration_seconds{{command="{}"}} {:.6f}'.format(cmd, report['duration']),
+                  "# HELP haa_run_timestamp_seconds End time of the last haa_manager_cli run.",
+                  "# TYPE haa_run_timestamp_seconds gauge",
+                  'haa_run_timestamp_seconds{{command="{}"}} {:.0f}'.format(cmd, report['timestamp'])]
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str, command: str) -> None:
+        """Write the report atomically: Prometheus textfile for *.prom, JSON otherwise."""
+        if path.endswith('.prom'):
+            content = self.prometheus(command)
+        else:
+            content = json.dumps(self.report(command), indent=1)
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
 
 def get_local_ip():
     try:
@@ -202,6 +1065,7 @@ def get_local_ip():
         return "127.0.0.1"
 
 def homekitCategoryToString(category : int) -> str :
+    from aiohomekit.model.categories import Categories
     if category == Categories.OTHER :
         return "Other"
     if category == Categories.BRIDGE:
@@ -293,13 +1157,31 @@ def versionCompare(v1, v2):
 # ---------------------------------------------------------------------------
 
 class _RawHAPListener:
-    """Zeroconf listener that only records (type, name) tuples without any I/O."""
+    """
+    Zeroconf listener that only records (type, name) tuples without any I/O.
+    Every callback added with add_listener(callback) is called as `callback(type_, name)` after
+    every add/update so a waiter can react immediately; waiters (discovery, the convergence
+    watcher) may overlap, each removes its own callback with remove_listener.
+    """
     def __init__(self):
         self.pending = []
+        self._listeners = []
+
+    def add_listener(self, callback) -> None:
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback) -> None:
+        with contextlib.suppress(ValueError):
+            self._listeners.remove(callback)
+
+    def _notify(self, type_, name):
+        for callback in list(self._listeners):  # zeroconf thread: a waiter may remove itself meanwhile
+            callback(type_, name)
 
     def add_service(self, zc, type_, name):
         logging.getLogger().debug("[mDNS] add_service  type=%s  name=%s", type_, name)
         self.pending.append((type_, name))
+        self._notify(type_, name)
 
     def remove_service(self, zc, type_, name):
         logging.getLogger().debug("[mDNS] remove_service  name=%s", name)
@@ -309,6 +1191,7 @@ class _RawHAPListener:
         logging.getLogger().debug("[mDNS] update_service  name=%s", name)
         if (type_, name) not in self.pending:
             self.pending.append((type_, name))
+        self._notify(type_, name)
 
 
 class _HAPInfo:
@@ -316,8 +1199,13 @@ class _HAPInfo:
     def __init__(self, info: AsyncServiceInfo, props: dict):
         self.id = props.get('id', '').lower()
         self.model = props.get('md', '')
+        try:
+            self.config_num = int(props.get('c#', ''))
+        except ValueError:
+            self.config_num = None
         self.name = info.name          # full mDNS name, e.g. "MyDev._hap._tcp.local."
         self.addresses = info.parsed_addresses()
+        from aiohomekit.model.categories import Categories
         try:
             self.category = Categories(int(props.get('ci', 0)))
         except Exception:
@@ -330,12 +1218,16 @@ class _HAPDiscovery:
         self.description = _HAPInfo(info, props)
 
 
+NOT_HAA = object()  # _resolveHAP result of a service that is not an HAA device: never resolved again
+
+
 class _PairingInfo:
     """Fallback description built from aiohomekit pairing data when mDNS has no TXT."""
     def __init__(self, pairing_id: str, pairing, category=None):
         self.id = pairing_id
         self.model = ''
         self.name = pairing_id  # no mDNS name available
+        from aiohomekit.model.categories import Categories
         self.category = category if category is not None else Categories.OTHER
         pd = getattr(pairing, '_pairing_data', {})
         addr = pd.get('AccessoryIP', pd.get('AccessoryAddress', pd.get('Address', None)))
@@ -356,83 +1248,95 @@ class _PairingDiscovery:
 # ---------------------------------------------------------------------------
 
 
+class _Characteristic:
+    """One characteristic of an accessory database."""
+    __slots__ = ('aid', 'iid', 'type', 'value', 'format', 'perms', 'description')
+
+    def __init__(self, aid, iid, type_, value, format_, perms, description):
+        self.aid = aid
+        self.iid = iid
+        self.type = type_
+        self.value = value
+        self.format = format_
+        self.perms = perms
+        self.description = description
+
+
+class _Service:
+    """One service of an accessory database with its characteristics."""
+    __slots__ = ('aid', 'iid', 'type', 'characteristics')
+
+    def __init__(self, aid, iid, type_):
+        self.aid = aid
+        self.iid = iid
+        self.type = type_
+        self.characteristics = []
+
+
+class _AccessoryDB:
+    """
+    Compact view of list_accessories_and_characteristics(), built in a single pass.
+    `index` maps (service type, characteristic type) to the first matching _Characteristic;
+    types are upper-case UUIDs.
+    """
+    __slots__ = ('aids', 'services', 'index', 'config_num')
+
+    def __init__(self, data: list, config_num: int = None):
+        self.config_num = config_num
+        self.aids = []
+        self.services = []
+        self.index = {}
+        for accessory in data:
+            aid = accessory['aid']
+            self.aids.append(aid)
+            for service in accessory.get('services', []):
+                srv = _Service(aid, service.get('iid'), service.get('type', '').upper())
+                for c in service.get('characteristics', []):
+                    ch = _Characteristic(int(c.get('aid', aid)), int(c['iid']), c.get('type', '').upper(),
+                                         c.get('value', ''), c.get('format'), tuple(c.get('perms', ())),
+                                         c.get('description', ''))
+                    srv.characteristics.append(ch)
+                    self.index.setdefault((srv.type, ch.type), ch)
+                self.services.append(srv)
+
+    def find(self, service_type: str, char_type: str):
+        return self.index.get((service_type.upper(), char_type.upper()))
+
+    def value(self, service_type: str, char_type: str):
+        ch = self.find(service_type, char_type)
+        return ch.value if ch is not None else None
+
+
 class HAADevice:
+    # firmware version -> setup word, resolved at most once per run
+    _customCommandMemo = {}  # version -> (setup word, time.monotonic() it expires at)
+
     def __init__(self, zcinfo, data, pairing):
         self.pairing = pairing
         self.info = zcinfo
-        self.data = data
+        self.data = data if isinstance(data, _AccessoryDB) else _AccessoryDB(data)
         self.fwversion = self._getfwversion()
         self.name = self._getname()
         self.manufacturer = self._getManufacturer()
         self.setupChar = self._getCustomSetupService()
         self.advsetupChar = self._getAdvancedCustomSetupService()
-        if self.manufacturer != self._getManufacturer():
-            sys.exit(-1)
 
     def _getCustomSetupService(self):
-        for accessory in self.data:
-            aid = accessory['aid']
-            for service in accessory['services']:
-                s_type = service['type']
-                s_iid = service['iid']
-                if s_type == HAA_CUSTOM_SERVICE:
-                    for characteristic in service['characteristics']:
-                        if characteristic.get('type') == HAA_CUSTOM_CONFIG_CHAR:
-                            value = characteristic.get('value', '')
-                            return [int(characteristic.get('aid')), int(characteristic.get('iid'))]
-        return None
+        ch = self.data.find(HAA_CUSTOM_SERVICE, HAA_CUSTOM_CONFIG_CHAR)
+        return [ch.aid, ch.iid] if ch is not None else None
 
     def _getAdvancedCustomSetupService(self):
-        for accessory in self.data:
-            aid = accessory['aid']
-            for service in accessory['services']:
-                s_type = service['type']
-                s_iid = service['iid']
-                if s_type == HAA_CUSTOM_SERVICE:
-                    for characteristic in service['characteristics']:
-                        if characteristic.get('type') == HAA_CUSTOM_ADVANCED_CONFIG_CHAR:
-                            value = characteristic.get('value', '')
-                            return [int(characteristic.get('aid')), int(characteristic.get('iid'))]
-        return None
+        ch = self.data.find(HAA_CUSTOM_SERVICE, HAA_CUSTOM_ADVANCED_CONFIG_CHAR)
+        return [ch.aid, ch.iid] if ch is not None else None
 
     def _getfwversion(self):
-        for accessory in self.data:
-            aid = accessory['aid']
-            for service in accessory['services']:
-                s_type = service['type']
-                s_iid = service['iid']
-                if s_type == SERVICE_INFO_TYPE:
-                    for characteristic in service['characteristics']:
-                        if characteristic.get('type') == SERVICE_INFO_CHAR_FW_REV:
-                            value = characteristic.get('value', '')
-                            return value
-        return None
+        return self.data.value(SERVICE_INFO_TYPE, SERVICE_INFO_CHAR_FW_REV)
 
     def _getManufacturer(self):
-        for accessory in self.data:
-            aid = accessory['aid']
-            for service in accessory['services']:
-                s_type = service['type']
-                s_iid = service['iid']
-                if s_type == SERVICE_INFO_TYPE:
-                    for characteristic in service['characteristics']:
-                        if characteristic.get('type') == SERVICE_INFO_CHAR_MANUF:
-                            value = characteristic.get('value', '')
-                            return value
-        return None
+        return self.data.value(SERVICE_INFO_TYPE, SERVICE_INFO_CHAR_MANUF)
 
     def _getname(self):
-        for accessory in self.data:
-            aid = accessory['aid']
-            for service in accessory['services']:
-                s_type = service['type']
-                s_iid = service['iid']
-                if s_type == SERVICE_INFO_TYPE:
-                    for characteristic in service['characteristics']:
-                        if characteristic.get('type') == SERVICE_INFO_CHAR_NAME:
-                            value = characteristic.get('value', '')
-                            return value
-        return None
+        return self.data.value(SERVICE_INFO_TYPE, SERVICE_INFO_CHAR_NAME)
 
     def getId(self) -> str:
         return self.info.description.id
@@ -478,87 +1382,117 @@ class HAADevice:
         enc = base64.b64encode(str.encode("utf-8"))
         return enc.decode('utf-8')
 
+    def homekitData(self) -> list:
+        """The services and characteristics printed by dumpHomekitData, as plain data."""
+        return [{'aid': service.aid, 'iid': service.iid, 'type': service.type,
+                 'characteristics': [{'iid': c.iid, 'type': c.type, 'description': c.description,
+                                      'perms': list(c.perms), 'value': c.value}
+                                     for c in service.characteristics]}
+                for service in self.data.services]
+
     def dumpHomekitData(self):
-        for accessory in self.data:
-            aid = accessory['aid']
-            for service in accessory['services']:
-                s_type = service['type']
-                s_iid = service['iid']
-                print('{aid}.{iid}: #{stype}#'.format(aid=aid, iid=s_iid, stype=s_type))
-
-                for characteristic in service['characteristics']:
-                    c_iid = characteristic['iid']
-                    value = characteristic.get('value', '')
-                    c_type = characteristic['type']
-                    c_format = characteristic['format']
-                    perms = ','.join(characteristic['perms'])
-                    desc = characteristic.get('description', '')
-
-                    print('  {aid}.{iid}: ({description}) #{ctype}# [{perms}]'.format(aid=aid,
-                                                                                      iid=c_iid,
-                                                                                      ctype=c_type,
-                                                                                      perms=perms,
-                                                                                      description=desc))
-                    print('    Value: {value}'.format(value=value))
+        for service in self.data.services:
+            aid = service.aid
+            print('{aid}.{iid}: #{stype}#'.format(aid=aid, iid=service.iid, stype=service.type))
+
+            for characteristic in service.characteristics:
+                perms = ','.join(characteristic.perms)
+                print('  {aid}.{iid}: ({description}) #{ctype}# [{perms}]'.format(aid=aid,
+                                                                                  iid=characteristic.iid,
+                                                                                  ctype=characteristic.type,
+                                                                                  perms=perms,
+                                                                                  description=characteristic.description))
+                print('    Value: {value}'.format(value=characteristic.value))
+
+    async def _putCharacteristics(self, characteristics):
+        with Context.get().get_metrics().phase('put_characteristics', self.getId()):
+            return await self.pairing.put_characteristics(characteristics)
 
     async def configReboot(self):
         characteristics = [(self.setupChar[0], self.setupChar[1], self._getWordToReboot())]
-        results = await self.pairing.put_characteristics(characteristics)
+        results = await self._putCharacteristics(characteristics)
 
     async def configEnterSetup(self):
         characteristics = [(self.setupChar[0], self.setupChar[1], self._getWordToEnterSetup())]
-        results = await self.pairing.put_characteristics(characteristics)
+        results = await self._putCharacteristics(characteristics)
 
     async def configStartUpdate(self):
         characteristics = [(self.setupChar[0], self.setupChar[1], self._getWordToStartUpdate())]
-        results = await self.pairing.put_characteristics(characteristics)
+        results = await self._putCharacteristics(characteristics)
 
     async def configWifiReconnection(self):
         characteristics = [(self.setupChar[0], self.setupChar[1], self._getWordToWifiReconnection())]
-        results = await self.pairing.put_characteristics(characteristics)
+        results = await self._putCharacteristics(characteristics)
 
     async def getConfigScript(self):
         if not self.advsetupChar:
             return None
         characteristics = [(self.advsetupChar[0], self.advsetupChar[1], self._getWordToReadScript())]
-        results = await self.pairing.put_characteristics(characteristics)
-        results = await self.pairing.get_characteristics([(self.advsetupChar[0], self.advsetupChar[1])])
+        results = await self._putCharacteristics(characteristics)
+        with Context.get().get_metrics().phase('get_characteristics', self.getId()):
+            results = await self.pairing.get_characteristics([(self.advsetupChar[0], self.advsetupChar[1])])
         script = results.get((self.advsetupChar[0], self.advsetupChar[1]), {}).get('value', None)
         if script:
             return base64.b64decode(script).decode("utf-8")
         else:
             return None
 
+    async def refreshFwVersion(self, timeout: float = 5.0):
+        """Re-read the accessory database from the device and return the current FW version."""
+        _reset_pairing_connection(self.pairing)
+        data = await asyncio.wait_for(self.pairing.list_accessories_and_characteristics(), timeout=timeout)
+        self.data = _AccessoryDB(data)
+        self.fwversion = self._getfwversion()
+        return self.fwversion
+
     @staticmethod
     def getCustomCommand(version: str) -> str:
         """
         Get custom command for a specific HAA version.
-        First checks local mapping, then tries to fetch from GitHub if not found.
+        First checks the in-process memo and the on-disk cache, then tries to fetch
+        from GitHub if not found (unless running --offline). The master word standing in
+        for a missing tag header is kept for CUSTOM_COMMAND_FALLBACK_TTL only, the memo
+        entries expire like the cache entries (the serve daemon lives for days).
         """
-        try:
-            tag_name = f"HAA_{version}"
-            command = get_custom_haa_command(tag_name, False)
+        version = str(version)
+        memo = HAADevice._customCommandMemo
+        if version in memo and time.monotonic() < memo[version][1]:
+            return memo[version][0]
+
+        ctx = Context.get()
+        cache = ctx.get_custom_command_cache()
+        offline = ctx.is_offline()
+        command = cache.get(version, allow_expired=offline)
+        ttl = cache.expires_in(version)
+        if command is None and not offline:
+            fallback = False
+            try:
+                tag_name = f"HAA_{version}"
+                with ctx.get_metrics().phase('github_custom_command'):
+                    command = get_custom_haa_command(tag_name, False)
+                    if not command:
+                        command = get_custom_haa_command("master", False)
+                        fallback = True
+            except Exception as e:
+                ctx.get_logger().error(f"Error getting command from GitHub: {e}")
+                sys.exit(-1)
             if command:
-                return command
+                cache.put(version, command, fallback)
+                ttl = cache.expires_in(version)
             else:
-                command = get_custom_haa_command("master", False)
-                if command:
-                    return command
-        except Exception as e:
-            Context.get().get_logger().error(f"Error getting command from GitHub: {e}")
-            sys.exit(-1)
+                # GitHub unreachable: a stale entry is still better than the default
+                command = cache.get(version, allow_expired=True)
+                ttl = cache.fallback_ttl
 
-        return CUSTOM_HAA_COMMAND
+        if not command:
+            command = CUSTOM_HAA_COMMAND
+        memo[version] = (command, time.monotonic() + ttl)
+        return command
 
     @staticmethod
     def getLastRelease() -> str:
         try:
-            tag = get_latest_release(False)
-            if tag:
-                return tag
-            else:
-                response = requests.get("https://api.github.com/repos/RavenSystem/esp-homekit-devices/releases/latest")
-                return response.json()["name"]
+            return Context.get().get_release_resolver().resolve() or ""
         except Exception as e:
             return ""
 
@@ -566,6 +1500,7 @@ class HAADevice:
     def isInSetupMode(ip) -> bool:
         try:
             if ip != "":
+                import urllib.request
                 url = "http://{}:{}".format(ip, SETUP_PORT)
                 status_code = urllib.request.urlopen(url, timeout=0.8).getcode()
                 return status_code == 200
@@ -595,20 +1530,36 @@ class Context:
             Context.__instance.logger = None
             Context.__instance.timeout = None
             Context.__instance.discoveredDevices = []
+            Context.__instance.discoveryWaiters = {}  # device id -> [future]
+            Context.__instance.discoveryTask = None
             Context.__instance.pairingfile = None
             Context.__instance.zeroConf = None
             Context.__instance.controller = None
             Context.__instance._hap_listener = None
-
-    def load_data(self, file):
-        try:
-            Context.__instance.controller.load_data(file)
-            return Context.__instance.controller.pairings
-        except Exception:
-            raise SystemExit
+            Context.__instance.customCommandCache = None
+            Context.__instance.releaseResolver = None
+            Context.__instance.inventory = None
+            Context.__instance.accessoryCache = None
+            Context.__instance.pairingStore = None
+            Context.__instance.metrics = None
+
+    def load_data(self, store, pairing_id=ALL_DEVICES_WILDCARD):
+        """Hand the selected pairings of the store to the controller; returns the controller pairings."""
+        controller = Context.__instance.controller
+        with self.get_metrics().phase('load_data'):
+            for alias, data in store.select(pairing_id).items():
+                try:
+                    controller.load_pairing(alias, dict(data))
+                except Exception as e:
+                    self.get_logger().error("Skipped pairing %s: %s", alias, e)
+        return controller.pairings
 
     @contextlib.asynccontextmanager
     async def get_controller(self) -> AsyncIterator[Controller]:
+        from zeroconf import InterfaceChoice
+        from zeroconf.asyncio import AsyncServiceBrowser, AsyncZeroconf
+        from aiohomekit import Controller
+
         # Bind to all interfaces so we receive mDNS on every NIC (eth0, wlan0, …)
         zeroconf = AsyncZeroconf(interfaces=InterfaceChoice.All)
         controller = Controller(async_zeroconf_instance=zeroconf)
@@ -630,44 +1581,134 @@ class Context:
                 yield controller
             await browser.async_cancel()
 
-    async def discoverHAA(self, doPrint: bool = False) -> int:
+    async def _resolveHAP(self, type_: str, name: str):
+        """
+        Resolve one mDNS service; registers and returns its _HAPDiscovery if it is an HAA device.
+        Returns None if the resolution timed out (worth another try), NOT_HAA otherwise.
+        """
         log = self.get_logger()
+        from zeroconf.asyncio import AsyncServiceInfo
+        log.debug("[disc] resolving: %s", name)
+        try:
+            info = AsyncServiceInfo(type_, name)
+            ok = await info.async_request(self.zeroConf.zeroconf, 3000)
+            if not ok:
+                log.debug("[disc] async_request timeout for %s", name)
+                return None
+            props = {
+                (k.decode() if isinstance(k, bytes) else k):
+                (v.decode() if isinstance(v, bytes) else str(v) if v is not None else '')
+                for k, v in (info.properties or {}).items()
+            }
+            model = props.get('md', '')
+            addrs = info.parsed_addresses()
+            log.debug("[disc] %s  md='%s'  addrs=%s", name, model, addrs)
+            # Accept if model matches OR if name starts with "HAA-" (empty md during boot)
+            short_name = name.split('._hap')[0]
+            if model.startswith(HAA_MANUFACTURER) or (not model and short_name.upper().startswith('HAA-')):
+                disc = _HAPDiscovery(info, props)
+                self._addHAADevice(disc)
+                return disc
+            log.debug("[disc] skip (not HAA): %s  md='%s'", name, model)
+        except Exception as e:
+            log.debug("[disc] error resolving %s: %s", name, e)
+        return NOT_HAA
 
-        # Wait for mDNS browser to collect service announcements
-        log.debug("[disc] sleeping %ds for mDNS...", self.get_timeout_sec())
-        await asyncio.sleep(self.get_timeout_sec())
-
-        pending = list(self._hap_listener.pending)
-        log.debug("[disc] mDNS listener collected %d service(s)", len(pending))
-        if not pending:
-            print("[disc] WARNING: mDNS browser found 0 HAP services. "
-                  "Check that the Pi is on the same network/VLAN as the devices "
-                  "and that mDNS/Bonjour is not blocked by a firewall or router.")
-
-        for type_, name in pending:
-            log.debug("[disc] resolving: %s", name)
-            try:
-                info = AsyncServiceInfo(type_, name)
-                ok = await info.async_request(self.zeroConf.zeroconf, 3000)
-                if not ok:
-                    log.debug("[disc] async_request timeout for %s", name)
-                    continue
-                props = {
-                    (k.decode() if isinstance(k, bytes) else k):
-                    (v.decode() if isinstance(v, bytes) else str(v) if v is not None else '')
-                    for k, v in (info.properties or {}).items()
-                }
-                model = props.get('md', '')
-                addrs = info.parsed_addresses()
-                log.debug("[disc] %s  md='%s'  addrs=%s", name, model, addrs)
-                # Accept if model matches OR if name starts with "HAA-" (empty md during boot)
-                short_name = name.split('._hap')[0]
-                if model.startswith(HAA_MANUFACTURER) or (not model and short_name.upper().startswith('HAA-')):
-                    self._addHAADevice(_HAPDiscovery(info, props))
+    async def discoverHAA(self, doPrint: bool = False, expected_ids=None, records: _RecordStream = None) -> int:
+        """
+        Resolve mDNS services concurrently as the browser reports them.
+        Returns once no new announcement arrived for DISCOVERY_QUIET_SEC and all
+        resolutions are done, with `expected_ids` as soon as every one of them has been
+        seen, at the latest after the -t timeout. A resolution that timed out is tried
+        again, up to DISCOVERY_RESOLVE_RETRIES times: a burst of announcements of a large
+        fleet makes some of them time out. With `records` every HAA device is reported
+        as soon as it is resolved.
+        """
+        log = self.get_logger()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+
+        deadline = started + self.get_timeout_sec()
+        expected = {i.lower() for i in expected_ids or []}
+        seen_ids = set()
+        tasks = {}
+        failed = {}  # name -> (attempts, loop time of the last failure)
+        wakeup = asyncio.Event()
+        last_announce = loop.time()
+
+        def on_done(task, name):
+            if task.cancelled():
+                return
+            disc = task.result()
+            if disc is None:
+                failed[name] = (failed.get(name, (0, 0))[0] + 1, loop.time())
+                wakeup.set()
+                return
+            failed.pop(name, None)
+            if disc is not NOT_HAA and disc.description.id not in seen_ids:
+                seen_ids.add(disc.description.id)
+                if records is not None:
+                    d = disc.description
+                    records.emit('discovery', d.id, loop.time() - started, name=d.name.split('._hap')[0],
+                                 ip=d.addresses[0] if d.addresses else None, model=d.model,
+                                 category=homekitCategoryToString(d.category))
+            wakeup.set()
+
+        on_change = lambda type_, name: loop.call_soon_threadsafe(wakeup.set)
+        self._hap_listener.add_listener(on_change)
+        try:
+            while True:
+                wakeup.clear()
+                now = loop.time()
+                retry_at = math.inf
+                for type_, name in list(self._hap_listener.pending):
+                    if name in tasks:
+                        attempts, failed_at = failed.get(name, (0, 0))
+                        if not attempts or attempts > DISCOVERY_RESOLVE_RETRIES or not tasks[name].done():
+                            continue
+                        if now < failed_at + DISCOVERY_RETRY_SEC:
+                            retry_at = min(retry_at, failed_at + DISCOVERY_RETRY_SEC)
+                            continue
+                        log.debug("[disc] resolving again (%d): %s", attempts, name)
+                    else:
+                        last_announce = now  # a retry is no new announcement
+                    task = asyncio.create_task(self._resolveHAP(type_, name))
+                    task.add_done_callback(functools.partial(on_done, name=name))
+                    tasks[name] = task
+
+                if expected and expected <= seen_ids:
+                    log.debug("[disc] all %d expected device(s) seen", len(expected))
+                    break
+                if now >= deadline:
+                    if expected:
+                        log.debug("[disc] %d expected device(s) not seen", len(expected - seen_ids))
+                    break
+                if (all(t.done() for t in tasks.values()) and retry_at == math.inf
+                        and now - last_announce >= DISCOVERY_QUIET_SEC):
+                    log.debug("[disc] no new announcements for %.1fs", DISCOVERY_QUIET_SEC)
+                    if expected:
+                        log.debug("[disc] %d expected device(s) not seen", len(expected - seen_ids))
+                    break
                 else:
-                    log.debug("[disc] skip (not HAA): %s  md='%s'", name, model)
-            except Exception as e:
-                log.debug("[disc] error resolving %s: %s", name, e)
+                    wait = min(deadline, retry_at, last_announce + DISCOVERY_QUIET_SEC) - now
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(wakeup.wait(), max(0.05, wait))
+        finally:
+            self._hap_listener.remove_listener(on_change)
+            for task in tasks.values():
+                task.cancel()
+
+        log.debug("[disc] mDNS listener collected %d service(s)", len(tasks))
+        if not tasks:
+            warning = ("[disc] WARNING: mDNS browser found 0 HAP services. "
+                       "Check that the Pi is on the same network/VLAN as the devices "
+                       "and that mDNS/Bonjour is not blocked by a firewall or router.")
+            if doPrint:
+                print(warning)
+            elif records is not None:
+                log.warning(warning)
+            else:
+                log.debug(warning)
 
         log.debug("[disc] HAA devices found: %d", len(Context.__instance.discoveredDevices))
 
@@ -681,37 +1722,66 @@ class Context:
 
         return len(Context.__instance.discoveredDevices)
 
-    def discoverHAAInSetupMode(self, ip4=None):
-        if not ip4:
-            ip4 = get_local_ip()
-        Context.get().get_logger().debug(f"My IP: {ip4}")
-        base_ip = ".".join(ip4.split(".")[:3])
-        timeout = 0.8
-
-        def scan_ip(ip):
-            try:
-                with socket.create_connection((ip, SETUP_PORT), timeout):
-                    return ip
-            except (socket.timeout, socket.error):
-                return None
-
-        ip_range = [f"{base_ip}.{i}" for i in range(1, 255)]
-        devices_in_setup = []
-
-        with ThreadPoolExecutor(max_workers=20) as executor:
-            results = executor.map(scan_ip, ip_range)
+    async def discoverHAAInSetupMode(self, scanner, records: _RecordStream = None, after=None) -> int:
+        """
+        Sweep the scanner networks for the setup web server, printing devices as they answer.
+        The text output starts once the awaitable `after` (a concurrent mDNS discovery printing
+        its own list) is done, the sweep itself does not wait for it.
+        """
+        Context.get().get_logger().debug("Setup mode scan: %s", scanner.describe())
 
-        for ip in results:
-            if ip:
-                devices_in_setup.append(ip)
+        async def header():
+            if after is not None:
+                await after
+            print("Devices in Setup Mode:", flush=True)
 
-        print("Devices in Setup Mode:")
-        for device_ip in devices_in_setup:
-            url = f"http://{device_ip}:4567"
-            print(f"{device_ip:16} URL: {url}")
+        found = 0
+        printed = asyncio.ensure_future(header()) if records is None else None
+        start = time.monotonic()
+        try:
+            async for device_ip, _ in scanner.scan([SETUP_PORT]):
+                url = f"http://{device_ip}:{SETUP_PORT}"
+                if records is None:
+                    await printed
+                    print(f"{device_ip:16} URL: {url}", flush=True)
+                else:
+                    records.emit('setup_mode', None, time.monotonic() - start, ip=device_ip, url=url)
+                found += 1
+            if printed is not None:
+                await printed
+        finally:
+            if printed is not None:
+                printed.cancel()
+        return found
 
     def _addHAADevice(self, device):
-        Context.__instance.discoveredDevices.append(device)
+        """Register a resolved device; a new resolution replaces the previous one (its c# may have changed)."""
+        devices = Context.__instance.discoveredDevices
+        for n, d in enumerate(devices):
+            if d.description.id == device.description.id:
+                devices[n] = device
+                break
+        else:
+            devices.append(device)
+        if Context.__instance.accessoryCache is not None:
+            Context.__instance.accessoryCache.confirm(device.description.id, device.description.config_num)
+        for waiter in Context.__instance.discoveryWaiters.pop(device.description.id, []):
+            if not waiter.done():
+                waiter.set_result(device)
+
+    async def waitDiscoveredHAADevice(self, id: str, timeout: float):
+        """The discovery of device `id`, waiting up to `timeout` for the running discoveryTask to resolve it."""
+        device = self.getDiscovereHAADeviceById(id)
+        task = Context.__instance.discoveryTask
+        if device is not None or task is None or task.done():
+            return device
+        waiter = asyncio.get_running_loop().create_future()
+        Context.__instance.discoveryWaiters.setdefault(id, []).append(waiter)
+        try:
+            await asyncio.wait({waiter, task}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+        return self.getDiscovereHAADeviceById(id)
 
     def getDiscoveredHAADevices(self) -> []:
         return Context.__instance.discoveredDevices
@@ -737,6 +1807,53 @@ class Context:
     def get_timeout_sec(self) -> int:
         return Context.__instance.timeout
 
+    def is_offline(self) -> bool:
+        config = Context.__instance.config
+        return bool(config and getattr(config, 'offline', False))
+
+    def get_cache_dir(self) -> str:
+        config = Context.__instance.config
+        return getattr(config, 'cache_dir', None) or CACHE_DIR
+
+    def get_custom_command_cache(self) -> _CustomCommandCache:
+        if Context.__instance.customCommandCache is None:
+            path = os.path.join(self.get_cache_dir(), CUSTOM_COMMAND_CACHE_FILE)
+            Context.__instance.customCommandCache = _CustomCommandCache(path)
+        return Context.__instance.customCommandCache
+
+    def get_accessory_cache(self) -> _AccessoryCache:
+        if Context.__instance.accessoryCache is None:
+            path = os.path.join(self.get_cache_dir(), ACCESSORY_CACHE_FILE)
+            Context.__instance.accessoryCache = _AccessoryCache(path)
+        return Context.__instance.accessoryCache
+
+    def get_pairing_store(self) -> _PairingStore:
+        if Context.__instance.pairingStore is None:
+            store = _PairingStore(Context.__instance.pairingfile)
+            try:
+                store.entries()
+            except (OSError, ValueError) as e:
+                self.get_logger().error("Cannot read pairing file {}: {}".format(store.path, e))
+                raise SystemExit(-1)
+            Context.__instance.pairingStore = store
+        return Context.__instance.pairingStore
+
+    def get_inventory(self) -> _DeviceInventory:
+        if Context.__instance.inventory is None:
+            Context.__instance.inventory = _DeviceInventory(os.path.join(self.get_cache_dir(), INVENTORY_FILE))
+        return Context.__instance.inventory
+
+    def get_metrics(self) -> _PhaseTimer:
+        if Context.__instance.metrics is None:
+            Context.__instance.metrics = _PhaseTimer()
+        return Context.__instance.metrics
+
+    def get_release_resolver(self) -> _LatestReleaseResolver:
+        if Context.__instance.releaseResolver is None:
+            path = os.path.join(self.get_cache_dir(), LATEST_RELEASE_CACHE_FILE)
+            Context.__instance.releaseResolver = _LatestReleaseResolver(path, offline=self.is_offline())
+        return Context.__instance.releaseResolver
+
     def sighandler(self, signum, frame):
         print('\r\nYou pressed Ctrl+C! Game Over...')
         sys.exit(0)
@@ -744,8 +1861,12 @@ class Context:
 
 def parseArguments(config: argparse.Namespace) -> None:
     ctx = Context.get()
+    ctx.config = config
     ctx.logger = logging.getLogger()
     ctx.timeout = config.timeout
+    ctx.pairingfile = config.file
+    if config.id != ALL_DEVICES_WILDCARD:
+        config.id = config.id.lower()  # aiohomekit keys pairings by lowercase AccessoryPairingID
 
     if config.command == 'scan' and config.id and config.id != ALL_DEVICES_WILDCARD:
         ctx.logger.error("scan mode and ID are not allowed together")
@@ -762,6 +1883,7 @@ def parseArguments(config: argparse.Namespace) -> None:
                             format='%(asctime)s,%(levelname)s %(message)s',
                             datefmt='%H:%M:%S',
                             level=log_level)
+        from logging.handlers import RotatingFileHandler
         handler = RotatingFileHandler(config.log[0], maxBytes=FILELOGSIZE, backupCount=5)
         ctx.logger.addHandler(handler)
     else:
@@ -795,7 +1917,7 @@ def _read_arp_cache(log) -> dict:
     """Read OS ARP cache from /proc/net/arp. Returns dict: MAC (lowercase) -> IP."""
     mac_to_ip = {}
     try:
-        with open('/proc/net/arp', 'r') as f:
+        with Context.get().get_metrics().phase('arp_read'), open('/proc/net/arp', 'r') as f:
             next(f)  # skip header line
             for line in f:
                 parts = line.split()
@@ -810,178 +1932,519 @@ def _read_arp_cache(log) -> dict:
     return mac_to_ip
 
 
-def _load_friendly_names(pairing_file: str) -> dict:
-    """Read pairing JSON. Returns dict: lowercase AccessoryPairingID -> friendly name (e.g. HAA-07AA1F)."""
-    import json
-    result = {}
+async def _probe_tcp_port(ip: str, port: int, timeout: float = INVENTORY_PROBE_TIMEOUT) -> bool:
+    """Quick TCP connect: True when something is listening at ip:port."""
     try:
-        with open(pairing_file) as f:
-            raw = json.load(f)
-        for name, data in raw.items():
-            if isinstance(data, dict):
-                pid = data.get('AccessoryPairingID', '').lower()
-                if pid:
-                    result[pid] = name
-    except Exception:
-        pass
-    return result
+        _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout=timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    with contextlib.suppress(Exception):
+        await writer.wait_closed()
+    return True
 
 
-def _prescan_and_patch(pairing_file: str, log) -> tuple:
+async def _probe_inventory(raw: dict, inventory: _DeviceInventory, log) -> dict:
     """
-    Read the pairing JSON, nmap-scan for HAP ports, ARP-match device MACs,
-    write a patched temp JSON with correct IPs so aiohomekit always reads
-    the right IP from disk — not a stale cached value.
-    Returns: (patched_file_path, {AccessoryPairingID_lower -> ip})
-    Falls back to (original_file, {}) on any error.
+    Probe the last known location of every device of the pairing file.
+    A device is confirmed when its HAP port answers and, if the ARP cache knows the IP,
+    the MAC is still the one recorded in the inventory (DHCP may hand the IP to another device).
+    Returns: {JSON top-level key -> {'ip', 'name', 'mac', 'port'}}
     """
-    import json as _json, tempfile, os as _os
-    try:
-        import nmap as nmap_lib
-    except ImportError:
-        log.debug("python-nmap not installed (pip install python-nmap)")
-        return pairing_file, {}
+    known = {}
+    for json_key, data in raw.items():
+        if not isinstance(data, dict):
+            continue
+        entry = inventory.get(data.get('AccessoryPairingID', ''))
+        port = data.get('AccessoryPort') or (entry or {}).get('port')
+        if entry and port:
+            known[json_key] = (entry, int(port))
 
-    try:
-        with open(pairing_file) as f:
-            raw = _json.load(f)
-    except Exception as e:
-        log.debug("prescan: cannot read pairing file: %s", e)
-        return pairing_file, {}
+    if not known:
+        return {}
 
-    # Collect HAP ports directly from the raw JSON
-    ports_set = set()
-    for json_key, data in raw.items():
-        if isinstance(data, dict):
-            port = data.get('AccessoryPort')
-            if port:
-                ports_set.add(int(port))
+    alive = await asyncio.gather(*(_probe_tcp_port(e['ip'], port) for e, port in known.values()))
+    arp_ip_to_mac = {ip: mac for mac, ip in _read_arp_cache(log).items()}
 
-    if not ports_set:
-        log.debug("prescan: no AccessoryPort found")
-        return pairing_file, {}
+    found = {}
+    for (json_key, (entry, port)), ok in zip(known.items(), alive):
+        if not ok:
+            log.debug("inventory: %s not at %s:%d anymore", json_key, entry['ip'], port)
+            continue
+        arp_mac = arp_ip_to_mac.get(entry['ip'])
+        if arp_mac and entry.get('mac') and arp_mac != entry['mac']:
+            log.debug("inventory: %s ip %s now belongs to %s", json_key, entry['ip'], arp_mac)
+            continue
+        found[json_key] = {'ip': entry['ip'], 'name': json_key, 'mac': entry.get('mac') or arp_mac or '', 'port': port}
+        log.debug("inventory: %-20s  %s  (cached)", json_key, entry['ip'])
+    return found
+
+
+def _scan_networks(subnets: list, interfaces: list, log) -> list:
+    """
+    Networks to sweep: every --subnet CIDR plus the IPv4 networks of every --interface.
+    Defaults to the /24 of the local IP when neither is given.
+    """
+    networks = []
+    for cidr in subnets or []:
+        try:
+            networks.append(ipaddress.ip_network(cidr, strict=False))
+        except ValueError as e:
+            log.error("invalid subnet %s: %s", cidr, e)
+    if interfaces:
+        import ifaddr
+        adapters = {a.nice_name: a for a in ifaddr.get_adapters()}
+        adapters.update({a.name: a for a in adapters.values()})
+        for name in interfaces:
+            adapter = adapters.get(name)
+            if adapter is None:
+                log.error("unknown interface %s", name)
+                continue
+            for ip in adapter.ips:
+                if isinstance(ip.ip, str):  # IPv4 only, IPv6 addresses are tuples
+                    networks.append(ipaddress.ip_network(f"{ip.ip}/{ip.network_prefix}", strict=False))
+    if not networks:
+        local_ip = get_local_ip()
+        networks.append(ipaddress.ip_network(".".join(local_ip.split(".")[:3]) + ".0/24"))
+    return networks
 
-    local_ip = get_local_ip()
-    subnet = ".".join(local_ip.split(".")[:3]) + ".0/24"
-    ports_csv = ",".join(str(p) for p in sorted(ports_set))
-    log.info("nmap: scanning %s  ports [%s] ...", subnet, ports_csv)
 
+def _fd_budget(wanted: int) -> int:
+    """
+    Number of sockets that can be opened at once: raise the soft RLIMIT_NOFILE
+    towards the hard limit if needed and keep some descriptors in reserve.
+    """
+    reserve = 64
     try:
-        nm = nmap_lib.PortScanner()
-        nm.scan(hosts=subnet, ports=ports_csv, arguments='-sT -T4 --open')
-    except Exception as e:
-        log.debug("nmap scan error: %s", e)
-        return pairing_file, {}
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != resource.RLIM_INFINITY and soft < wanted + reserve:
+            target = wanted + reserve if hard == resource.RLIM_INFINITY else min(hard, wanted + reserve)
+            with contextlib.suppress(ValueError, OSError):
+                resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+                soft = target
+        if soft != resource.RLIM_INFINITY:
+            return max(1, min(wanted, soft - reserve))
+    except ImportError:
+        pass
+    return wanted
 
-    nmap_ips: set = set()
-    for host in nm.all_hosts():
-        if 'tcp' in nm[host]:
-            for pdata in nm[host]['tcp'].values():
-                if pdata['state'] == 'open':
-                    nmap_ips.add(host)
 
-    log.info("nmap: found %d host(s) with HAP port(s) open", len(nmap_ips))
+class _RateLimiter:
+    """Spaces out events to at most `rate` per second (0 = unlimited)."""
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self._next = 0.0
 
-    # nmap TCP connects populate the OS ARP cache — read it now
-    arp_cache = _read_arp_cache(log)
-    arp_cache = {mac: ip for mac, ip in arp_cache.items() if ip in nmap_ips}
-    log.debug("ARP cache filtered to nmap IPs: %d entries", len(arp_cache))
+    async def wait(self) -> None:
+        if not self.interval:
+            return
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._next)
+        self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
 
-    # MAC suffix matching: JSON key "HAA-07AA1F" → last 6 hex → match ARP MAC.
-    # HAA device names encode the last 3 WiFi MAC bytes: HAA-07AA1F <-> xx:xx:xx:07:aa:1f
-    json_name_to_ip: dict = {}   # JSON top-level key  -> ip
-    pid_info: dict = {}          # AccessoryPairingID (lower) -> {'ip', 'name', 'mac'}
 
-    for json_key, data in raw.items():
-        if not isinstance(data, dict):
-            continue
-        suffix = json_key.split('-')[-1].lower()   # "07aa1f" from "HAA-07AA1F"
-        if len(suffix) != 6:
-            continue
-        for mac, ip in arp_cache.items():
-            if mac.replace(':', '').endswith(suffix):
-                json_name_to_ip[json_key] = ip
-                pid = data.get('AccessoryPairingID', '').lower()
-                if pid:
-                    pid_info[pid] = {'ip': ip, 'name': json_key, 'mac': mac}
-                log.info("ARP match: %-20s  %s  (via %s)", json_key, ip, mac)
-                break
+class _TCPScanner:
+    """
+    asyncio TCP-connect scanner over a set of networks.
+    scan() is an async generator yielding (ip, port) as soon as each open port answers.
+    """
+    def __init__(self, networks: list, concurrency: int = SCAN_CONCURRENCY, rate: float = 0,
+                 timeout: float = SCAN_TIMEOUT):
+        self.networks = networks
+        self.concurrency = _fd_budget(max(1, concurrency))
+        self.rate = rate
+        self.timeout = timeout
+
+    def hosts(self):
+        seen = set()
+        for net in self.networks:
+            for ip in (net.hosts() if net.num_addresses > 1 else [net.network_address]):
+                if ip not in seen:
+                    seen.add(ip)
+                    yield str(ip)
+
+    def describe(self) -> str:
+        return ", ".join(str(n) for n in self.networks)
+
+    async def scan(self, ports: list):
+        queue = asyncio.Queue()
+        targets = ((ip, port) for ip in self.hosts() for port in ports)
+        limiter = _RateLimiter(self.rate)
+
+        running = self.concurrency
+
+        async def worker():
+            nonlocal running
+            try:
+                for ip, port in targets:
+                    await limiter.wait()
+                    if await _probe_tcp_port(ip, port, self.timeout):
+                        queue.put_nowait((ip, port))
+            finally:
+                running -= 1
+                if not running:
+                    queue.put_nowait(None)
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            while (item := await queue.get()) is not None:
+                yield item
+        finally:
+            for w in workers:
+                w.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
 
-    unmatched = [n for n in raw if isinstance(raw[n], dict) and n not in json_name_to_ip]
-    if unmatched:
-        log.info("No ARP match for: %s", ", ".join(sorted(unmatched)))
 
-    if not json_name_to_ip:
-        return pairing_file, {}
+def _normalize_mac(mac) -> str:
+    """"AA:BB-cc.dd:ee:ff" -> "aabbccddeeff"; empty string if it is not a MAC address."""
+    hexdigits = re.sub(r'[^0-9a-f]', '', str(mac or '').lower())
+    return hexdigits if len(hexdigits) == 12 else ''
 
-    # Build patched JSON: update ALL address-like keys for matched devices
-    patched = {}
+
+class _MacMatcher:
+    """
+    Maps a host found on the network (ip, mac) to its pairing file entry with hash lookups:
+      1. full MAC hints: the MAC recorded in the inventory or any "*mac*" key of the entry
+      2. the last 3 MAC bytes encoded in the HAA name: HAA-07AA1F <-> xx:xx:xx:07:aa:1f;
+         entries sharing a suffix are told apart by their stored AccessoryIP
+      3. the stored AccessoryIP, for entries with neither a MAC hint nor an HAA name
+    """
+    def __init__(self, raw: dict, json_keys: list, inventory: _DeviceInventory = None, log=None):
+        self.by_mac = {}
+        self.by_suffix = {}
+        self.by_ip = {}
+        self.ip_only = set()
+        self.keys = []
+        for json_key in json_keys:
+            data = raw[json_key]
+            hints = [v for k, v in data.items() if 'mac' in k.lower() and isinstance(v, str)]
+            entry = inventory.get(data.get('AccessoryPairingID', '')) if inventory is not None else None
+            if entry and entry.get('mac'):
+                hints.append(entry['mac'])
+            macs = {m for m in map(_normalize_mac, hints) if m}
+            for mac in macs:
+                self.by_mac.setdefault(mac, json_key)
+
+            suffix = json_key.split('-')[-1].lower()
+            has_suffix = len(suffix) == 6 and all(c in '0123456789abcdef' for c in suffix)
+            if has_suffix:
+                self.by_suffix.setdefault(suffix, []).append(json_key)
+
+            ip = data.get('AccessoryIP')
+            if ip:
+                self.by_ip.setdefault(ip, []).append(json_key)
+                if not macs and not has_suffix:
+                    self.ip_only.add(json_key)
+
+            if macs or has_suffix or ip:
+                self.keys.append(json_key)
+
+        self.ambiguous = {sfx: keys for sfx, keys in self.by_suffix.items() if len(keys) > 1}
+        if log:
+            for sfx, keys in self.ambiguous.items():
+                log.warning("MAC suffix %s is shared by %s: matching them by stored IP only", sfx, ", ".join(keys))
+
+    def match(self, ip: str, mac: str):
+        """Return (json_key, how) for the host, or (None, None)."""
+        mac = _normalize_mac(mac)
+        if mac:
+            json_key = self.by_mac.get(mac)
+            if json_key:
+                return json_key, "mac"
+            keys = self.by_suffix.get(mac[-6:])
+            if keys and len(keys) == 1:
+                return keys[0], "suffix"
+            if keys:
+                at_ip = [k for k in keys if k in self.by_ip.get(ip, ())]
+                if len(at_ip) == 1:
+                    return at_ip[0], "suffix+ip"
+                return None, None
+        at_ip = [k for k in self.by_ip.get(ip, ()) if k in self.ip_only]
+        if len(at_ip) == 1:
+            return at_ip[0], "stored ip"
+        return None, None
+
+
+async def _scan_locate(raw: dict, json_keys: list, scanner: _TCPScanner, log,
+                       inventory: _DeviceInventory = None) -> dict:
+    """
+    Sweep the scanner networks for HAP ports and ARP-match the MACs of the given pairing entries.
+    Open hosts are matched as they are found and the sweep stops once every entry is located.
+    Returns: {JSON top-level key -> {'ip', 'name', 'mac', 'port'}}
+    """
+    # Collect HAP ports directly from the raw JSON
+    ports_set = set()
     for json_key, data in raw.items():
-        if not isinstance(data, dict) or json_key not in json_name_to_ip:
-            patched[json_key] = data
-            continue
-        ip = json_name_to_ip[json_key]
-        entry = dict(data)
-        for key, val in list(entry.items()):
-            if any(x in key.lower() for x in ('ip', 'address', 'host', 'addr')):
-                entry[key] = [ip] if isinstance(val, list) else ip
-        entry.setdefault('AccessoryIP', ip)
-        patched[json_key] = entry
+        if isinstance(data, dict):
+            port = data.get('AccessoryPort')
+            if port:
+                ports_set.add(int(port))
+
+    if not ports_set:
+        log.debug("prescan: no AccessoryPort found")
+        return {}
+
+    matcher = _MacMatcher(raw, json_keys, inventory, log)
+    remaining = set(matcher.keys)
+    if not remaining:
+        return {}
+
+    ports_csv = ",".join(str(p) for p in sorted(ports_set))
+    log.info("scan: %s  ports [%s] for %d device(s) ...", scanner.describe(), ports_csv, len(remaining))
+
+    found = {}
+    open_hosts = set()
+    ip_to_mac = {}
+    metrics = Context.get().get_metrics()
+    unresolved = []  # (ip, port) waiting for the next ARP cache read
+    last_arp_read = 0.0
+
+    def match(ip, port):
+        mac = ip_to_mac.get(ip, '')
+        with metrics.phase('arp_match'):
+            json_key, how = matcher.match(ip, mac)
+        if json_key is None:
+            return
+        if json_key in remaining:
+            found[json_key] = {'ip': ip, 'name': json_key, 'mac': mac, 'port': port}
+            remaining.discard(json_key)
+            log.info("ARP match: %-20s  %s  (via %s %s)", json_key, ip, how, mac)
+        elif json_key in found and found[json_key]['ip'] != ip:
+            log.warning("%s also matches %s (%s), keeping %s", json_key, ip, mac, found[json_key]['ip'])
+
+    async with contextlib.aclosing(scanner.scan(sorted(ports_set))) as stream:
+        async for ip, port in stream:
+            if ip in open_hosts:
+                continue
+            open_hosts.add(ip)
+            unresolved.append((ip, port))
+            # our TCP connect populated the OS ARP cache: re-read it for new IPs,
+            # but not more often than ARP_REFRESH_INTERVAL on a big neighbor table
+            now = time.monotonic()
+            if ip not in ip_to_mac and now - last_arp_read >= ARP_REFRESH_INTERVAL:
+                ip_to_mac = {i: m for m, i in _read_arp_cache(log).items()}
+                last_arp_read = now
+            still_unresolved = []
+            for host in unresolved:
+                if host[0] in ip_to_mac:
+                    match(*host)
+                else:
+                    still_unresolved.append(host)
+            unresolved = still_unresolved
+            if not remaining:
+                log.debug("scan: all devices located, stopping early")
+                break
 
-    fd, tmp_path = tempfile.mkstemp(suffix='.json', prefix='haa_pairing_')
-    with _os.fdopen(fd, 'w') as f:
-        _json.dump(patched, f)
+    if unresolved and remaining:
+        ip_to_mac = {i: m for m, i in _read_arp_cache(log).items()}
+        for host in unresolved:
+            match(*host)
 
-    log.debug("prescan: patched pairing JSON -> %s", tmp_path)
-    return tmp_path, pid_info
+    log.info("scan: found %d host(s) with HAP port(s) open", len(open_hosts))
+    return found
 
 
-# HomeKit short UUID (first 8 hex chars) → device Categories
+async def _prescan_and_patch(store: _PairingStore, log, inventory: _DeviceInventory = None,
+                             scanner: _TCPScanner = None, pairing_id: str = ALL_DEVICES_WILDCARD) -> dict:
+    """
+    Locate the selected devices and patch their IPs into the in-memory pairing store,
+    so aiohomekit connects to the right IP — not a stale value from the pairing file.
+    Devices still at the location recorded in the inventory are confirmed with a quick
+    TCP probe; only the remaining ones need the network sweep + ARP MAC matching.
+    Returns: {AccessoryPairingID_lower -> {'ip', 'name', 'mac', 'port'}}
+    """
+    raw = store.select(pairing_id)
+
+    json_name_to_info: dict = {}   # JSON top-level key -> {'ip', 'name', 'mac', 'port'}
+    if inventory is not None:
+        with Context.get().get_metrics().phase('inventory_probe'):
+            json_name_to_info = await _probe_inventory(raw, inventory, log)
+        if json_name_to_info:
+            log.info("inventory: %d device(s) at their last known location", len(json_name_to_info))
+
+    missing = [n for n in raw if n not in json_name_to_info]
+    if missing and scanner is not None:
+        with Context.get().get_metrics().phase('network_scan'):
+            json_name_to_info.update(await _scan_locate(raw, missing, scanner, log, inventory))
+
+    unmatched = [n for n in missing if n not in json_name_to_info]
+    if unmatched:
+        log.info("No ARP match for: %s", ", ".join(sorted(unmatched)))
+
+    pid_info: dict = {}          # AccessoryPairingID (lower) -> {'ip', 'name', 'mac', 'port'}
+    for json_key, info in json_name_to_info.items():
+        store.patch_ip(json_key, info['ip'])
+        pid = store.pairing_id(raw[json_key])
+        if pid:
+            pid_info[pid] = info
+    return pid_info
+
+
+# HomeKit short UUID (first 8 hex chars) → device Categories member name
 _SHORT_UUID_TO_CATEGORY = {
-    '00000040': Categories.FAN,
-    '00000041': Categories.GARAGE,
-    '00000043': Categories.LIGHTBULB,
-    '00000044': Categories.DOOR_LOCK,
-    '00000049': Categories.OUTLET,
-    '0000004A': Categories.THERMOSTAT,
-    '0000007E': Categories.SENSOR,
-    '00000085': Categories.SECURITY_SYSTEM,
-    '0000008B': Categories.DOOR,
-    '0000008C': Categories.WINDOW_COVERING,
-    '0000008D': Categories.WINDOW,
-    '00000096': Categories.SWITCH,
-    '000000BB': Categories.AIR_PURIFIER,
-    '000000BC': Categories.HUMIDIFIER,
-    '000000CF': Categories.SPRINKLER,
-    '000000D7': Categories.FAUCET,
-    '000000D8': Categories.TELEVISION,
+    '00000040': 'FAN',
+    '00000041': 'GARAGE',
+    '00000043': 'LIGHTBULB',
+    '00000044': 'DOOR_LOCK',
+    '00000049': 'OUTLET',
+    '0000004A': 'THERMOSTAT',
+    '0000007E': 'SENSOR',
+    '00000085': 'SECURITY_SYSTEM',
+    '0000008B': 'DOOR',
+    '0000008C': 'WINDOW_COVERING',
+    '0000008D': 'WINDOW',
+    '00000096': 'SWITCH',
+    '000000BB': 'AIR_PURIFIER',
+    '000000BC': 'HUMIDIFIER',
+    '000000CF': 'SPRINKLER',
+    '000000D7': 'FAUCET',
+    '000000D8': 'TELEVISION',
 }
 
 # Suffix shared by all standard Apple HomeKit service UUIDs
 _HAP_APPLE_SUFFIX = '-0000-1000-8000-0026BB765291'
 
 
-def _infer_category_from_data(data: list) -> Categories:
+def _infer_category_from_data(db: _AccessoryDB) -> Categories:
     """
-    Infer the HAP category from list_accessories_and_characteristics() data.
+    Infer the HAP category from the accessory database.
     >1 accessories → BRIDGE; otherwise scan non-info standard service types.
     """
-    if len(data) > 1:
+    from aiohomekit.model.categories import Categories
+    if len(db.aids) > 1:
         return Categories.BRIDGE
-    for accessory in data:
-        for service in accessory.get('services', []):
-            stype = service.get('type', '').upper()
-            if stype == SERVICE_INFO_TYPE.upper():
-                continue
-            if not stype.endswith(_HAP_APPLE_SUFFIX.upper()):
-                continue  # skip custom/vendor services (e.g. HAA_CUSTOM_SERVICE)
-            short = stype.split('-')[0]
-            cat = _SHORT_UUID_TO_CATEGORY.get(short)
-            if cat:
-                return cat
+    for service in db.services:
+        stype = service.type
+        if stype == SERVICE_INFO_TYPE.upper():
+            continue
+        if not stype.endswith(_HAP_APPLE_SUFFIX.upper()):
+            continue  # skip custom/vendor services (e.g. HAA_CUSTOM_SERVICE)
+        short = stype.split('-')[0]
+        cat = _SHORT_UUID_TO_CATEGORY.get(short)
+        if cat:
+            return Categories[cat]
     return Categories.OTHER
 
 
+def _normalize_char_name(name: str) -> str:
+    return re.sub(r'[^0-9a-z]', '', str(name).lower())
+
+
+class _CharSelector:
+    """
+    Selects characteristics of an accessory database by type or position. Each comma separated
+    term is an `aid.iid`, a UUID (short "11" or full), an Apple name ("CurrentTemperature"),
+    an aiohomekit name ("CURRENT_TEMPERATURE") or the description a device gives a characteristic.
+    """
+    _names = None  # normalized name -> type UUID, built once from aiohomekit's table
+
+    def __init__(self, selector: str):
+        self.positions = set()  # (aid, iid)
+        self.types = set()
+        self.terms = set()  # normalized names matched against the device descriptions
+        for term in (t.strip() for t in selector.split(',')):
+            if not term:
+                continue
+            m = re.fullmatch(r'(\d+)\.(\d+)', term)
+            if m:
+                self.positions.add((int(m.group(1)), int(m.group(2))))
+                continue
+            uuid = self._type_of(term)
+            if uuid:
+                self.types.add(uuid)
+            self.terms.add(_normalize_char_name(term))
+
+    @classmethod
+    def _type_of(cls, term: str):
+        if re.fullmatch(r'[0-9A-Fa-f]{1,8}', term):
+            return term.upper().rjust(8, '0') + _HAP_APPLE_SUFFIX
+        if re.fullmatch(r'[0-9A-Fa-f]{8}(-[0-9A-Fa-f]{4}){3}-[0-9A-Fa-f]{12}', term):
+            return term.upper()
+        if cls._names is None:
+            from aiohomekit.model.characteristics.data import characteristics
+            cls._names = {}
+            for uuid, info in characteristics.items():
+                cls._names[_normalize_char_name(info['name'])] = uuid.upper()
+                cls._names[_normalize_char_name(info['description'])] = uuid.upper()
+        return cls._names.get(_normalize_char_name(term))
+
+    @staticmethod
+    def name_of(ch: _Characteristic) -> str:
+        from aiohomekit.model.characteristics.data import characteristics
+        info = characteristics.get(ch.type)
+        return info['description'] if info else (ch.description or ch.type)
+
+    def matches(self, aid: int, iid: int, type_: str, description: str) -> bool:
+        return ((aid, iid) in self.positions or type_ in self.types
+                or bool(description) and _normalize_char_name(description) in self.terms)
+
+    def select(self, db: _AccessoryDB, perm: str = 'pr') -> list:
+        """The matching characteristics of `db` with permission `perm` (readable by default), in database order."""
+        return [ch for srv in db.services for ch in srv.characteristics
+                if perm in ch.perms and self.matches(ch.aid, ch.iid, ch.type, ch.description)]
+
+
+def _parse_char_writes(assignments: str) -> list:
+    """set: "SELECTOR=VALUE,..." -> [(_CharSelector, value text)]; raises ValueError."""
+    writes = []
+    for term in (t.strip() for t in assignments.split(',')):
+        if not term:
+            continue
+        selector, sep, value = term.partition('=')
+        if not sep or not selector.strip():
+            raise ValueError('"{}" is not SELECTOR=VALUE'.format(term))
+        writes.append((_CharSelector(selector.strip()), value.strip()))
+    if not writes:
+        raise ValueError("nothing to set")
+    return writes
+
+
+def _char_value(ch: _Characteristic, text: str):
+    """The value `text` converted to the format of `ch`; raises ValueError."""
+    if ch.format == 'bool':
+        if text.lower() in ('1', 'true', 'on', 'yes'):
+            return True
+        if text.lower() in ('0', 'false', 'off', 'no'):
+            return False
+        raise ValueError('"{}" is not a bool'.format(text))
+    if ch.format in ('uint8', 'uint16', 'uint32', 'uint64', 'int'):
+        return int(text)  # decimal only: "08" is 8, not a bad octal literal
+    if ch.format == 'float':
+        return float(text)
+    return text
+
+
+class _RecordStream:
+    """
+    --output jsonl: one JSON object per line and per device, written as soon as the
+    discovery, connection or command of that device completes. Times are in ms,
+    `elapsed_ms` counting from the start of the run; `error` is the exception type.
+    """
+    def __init__(self):
+        self.start = time.monotonic()
+
+    def emit(self, event: str, pair_id: str, duration: float = None, error=None, **fields) -> None:
+        record = {
+            'event': event,
+            'id': pair_id,
+            'ok': error is None,
+            'error': error if error is None or isinstance(error, str) else type(error).__name__,
+            'duration_ms': None if duration is None else round(duration * 1000, 1),
+            'elapsed_ms': round((time.monotonic() - self.start) * 1000, 1),
+        }
+        record.update(fields)
+        print(json.dumps(record, default=str), flush=True)
+
+
+def _record_stream(config):
+    """A _RecordStream for --output jsonl, None for the text output."""
+    return _RecordStream() if getattr(config, 'output', 'text') == 'jsonl' else None
+
+
 def _reset_pairing_connection(pairing) -> None:
     """
     Clear aiohomekit's cached connection so the next call opens a fresh TCP session.
@@ -1006,96 +2469,610 @@ def _reset_pairing_connection(pairing) -> None:
             pass
 
 
-async def _try_connect_pairing(k: str, v, name_to_ip: dict, ctx, log):
+def _known_config_number(ctx, k: str, v):
+    """The HAP configuration number (c#) of the device if already heard on mDNS, None otherwise."""
+    description = getattr(v, 'description', None)  # aiohomekit's own browser may know it already
+    if description is None:
+        disc = ctx.getDiscovereHAADeviceById(k)
+        description = disc.description if disc is not None else None
+    return getattr(description, 'config_num', None)
+
+
+async def _config_number(ctx, k: str, v):
+    """The HAP configuration number (c#) the device announces on mDNS, None if not heard in time."""
+    config_num = _known_config_number(ctx, k, v)
+    if config_num is None and getattr(v, 'description', None) is None:
+        disc = await ctx.waitDiscoveredHAADevice(k, CONFIG_NUM_TIMEOUT)
+        config_num = disc.description.config_num if disc is not None else None
+    return config_num
+
+
+async def _refresh_fw_value(v, data: _AccessoryDB) -> None:
+    """A cached database may predate a firmware update that kept c#: re-read the version only."""
+    ch = data.find(SERVICE_INFO_TYPE, SERVICE_INFO_CHAR_FW_REV)
+    if ch is not None:
+        result = await v.get_characteristics([(ch.aid, ch.iid)])
+        ch.value = result.get((ch.aid, ch.iid), {}).get('value', ch.value)
+
+
+async def _try_connect_pairing(k: str, v, name_to_ip: dict, ctx, log, errors: dict = None, use_cache: bool = True):
     """
     HAP connection for one pairing.
-    IP is already correct in the pairing object: _prescan_and_patch wrote it
-    into the JSON before aiohomekit loaded it.
-    Returns (k, v, zc_dev, data) or None.
+    IP is already correct in the pairing object: _prescan_and_patch patched it
+    into the pairing store before aiohomekit loaded it.
+    The accessory database comes from the _AccessoryCache when the device still announces
+    the c# it was cached with; otherwise it is read from the device and cached.
+    Returns (k, v, zc_dev, data) or None; the reason of a failure is stored in `errors`.
     """
+    errors = {} if errors is None else errors
     dev_info = name_to_ip.get(k)
     if not dev_info:
         log.debug("%s: no ARP match — skipping", k)
+        errors[k] = "NotLocated"
         return None
 
     arp_ip = dev_info['ip']
     log.debug("%s (%s): trying %s", dev_info['name'], k, arp_ip)
     _reset_pairing_connection(v)
+    metrics = ctx.get_metrics()
+    cache = ctx.get_accessory_cache()
+    # the c# lookup waits for mDNS: run it while pair-verify is in progress, only to validate a cached entry
+    config_num = asyncio.create_task(_config_number(ctx, k, v)) if use_cache and cache.has(k) else None
+
+    async def fetch():
+        # list_accessories_and_characteristics connects on demand: pair-verify first to time both
+        ensure_connected = getattr(v, '_ensure_connected', None)
+        if ensure_connected is not None:
+            with metrics.phase('pair_verify', k):
+                await ensure_connected()
+        if config_num is not None:
+            cnum = await config_num
+            cached = cache.get(k, cnum)
+            if cached is not None:
+                with metrics.phase('accessory_cache', k):
+                    data = _AccessoryDB(cached, cnum)
+                    await _refresh_fw_value(v, data)
+                log.debug("%s: accessory database from cache (c# %s)", k, cnum)
+                return data
+        with metrics.phase('list_accessories', k):
+            accessories = await v.list_accessories_and_characteristics()
+        # no wait for mDNS: the entry of a device whose c# is not known yet is confirmed once it is resolved
+        cnum = _known_config_number(ctx, k, v)
+        cache.put(k, cnum, accessories)
+        return _AccessoryDB(accessories, cnum)
+
     try:
-        data = await asyncio.wait_for(v.list_accessories_and_characteristics(), timeout=5.0)
+        data = await asyncio.wait_for(fetch(), timeout=5.0)
         inferred_cat = _infer_category_from_data(data)
         zc = ctx.getDiscovereHAADeviceById(k) or _PairingDiscovery(k, v, category=inferred_cat)
         return (k, v, zc, data)
     except Exception as e:
         log.debug("%s (%s): failed -> %s: %s", dev_info['name'], arp_ip, type(e).__name__, e)
+        errors[k] = type(e).__name__
+    finally:
+        if config_num is not None:
+            config_num.cancel()
 
     log.debug("%s NOT online (IP: %s)", dev_info['name'], arp_ip)
     return None
 
 
-async def _run_device_command(config, log) -> None:
-    """Runs all device-related commands inside a single controller context."""
-    ctx = Context.get()
+async def _connect_candidates(candidates: dict, name_to_ip: dict, ctx, log, concurrency: int,
+                              records: _RecordStream = None, use_cache: bool = True) -> list:
+    """
+    Connect to all candidate pairings with at most `concurrency` connections in flight.
+    Wall time is bounded by the slowest device rather than the sum of all of them.
+    `use_cache` = False reads every accessory database from its device.
+    Returns the _try_connect_pairing results in the same order as `candidates`.
+    """
+    total = len(candidates)
+    sem = asyncio.Semaphore(max(1, concurrency))
+    done = 0
+    errors = {}
+
+    async def connect_one(k, v):
+        nonlocal done
+        async with sem:
+            start = time.monotonic()
+            result = await _try_connect_pairing(k, v, name_to_ip, ctx, log, errors, use_cache)
+        done += 1
+        dev_info = name_to_ip.get(k)
+        if records is not None:
+            dev_info = dev_info or {}
+            records.emit('connect', k, time.monotonic() - start, errors.get(k), name=dev_info.get('name'),
+                         ip=dev_info.get('ip'), mac=dev_info.get('mac'), port=dev_info.get('port'),
+                         fw=result[3].value(SERVICE_INFO_TYPE, SERVICE_INFO_CHAR_FW_REV) if result else None)
+            return result
+        if dev_info:
+            desc = f"{dev_info['name']}  {dev_info['ip']}  {dev_info['mac']}"
+        else:
+            desc = f"{k}  (no match)"
+        state = "ok" if result else "offline"
+        print(f"\rConnecting ({done}/{total}): {desc} {state}", end='\033[K', flush=True)
+        return result
 
-    log.info("Last release: {}".format(HAADevice.getLastRelease()))
+    results = await asyncio.gather(*(connect_one(k, v) for k, v in candidates.items()))
+    if records is None:
+        print()  # newline after progress
+    return list(results)
+
+
+def _release_version(tag):
+    """Extract the dotted version from a release tag, e.g. "HAA_12.14.6" -> "12.14.6"."""
+    if not tag:
+        return None
+    m = re.search(r'(\d+(?:\.\d+)+)', str(tag))
+    return m.group(1) if m else tag
+
+
+def _is_new_firmware(fw, old_version, target_version) -> bool:
+    """True when `fw` is the target version, or any version but `old_version` when the target is unknown."""
+    if not fw:
+        return False
+    if target_version:
+        return _is_same_version(fw, target_version)
+    return fw != old_version
 
-    # Pre-scan BEFORE aiohomekit loads the pairings: patch the JSON with correct IPs
-    # so aiohomekit reads the right IP from disk, not a stale cached value.
-    patched_file, name_to_ip = await asyncio.to_thread(_prescan_and_patch, config.file, log)
-    try:
-      async with ctx.get_controller():
-        pair_devices = ctx.load_data(patched_file)
 
-        if config.command == 'scan':
-            ctx.discoverHAAInSetupMode()
+def _is_same_version(v1, v2) -> bool:
+    try:
+        return versionCompare(v1, v2) == 0
+    except Exception:
+        return v1 == v2
+
+
+class _OTAProgress:
+    """Update state of one device, as told by its UDP log."""
+    __slots__ = ('device', 'state', 'percent', 'lines', 'partial', 'bytes', 'started', 'first_log', 'finished')
+
+    def __init__(self, device: HAADevice):
+        self.device = device
+        self.state = 'waiting'  # -> running -> done | failed
+        self.percent = None
+        self.lines = collections.deque(maxlen=OTA_LOG_MAX_LINES)
+        self.partial = ''
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.first_log = None
+        self.finished = None
+
+    def feed(self, text: str) -> None:
+        self.bytes += len(text)
+        if self.first_log is None:
+            self.first_log = time.monotonic()
+        *lines, self.partial = (self.partial + text).split('\n')
+        self.partial = self.partial[-OTA_LOG_MAX_LINE:]
+        for line in lines:
+            line = line.strip()[:OTA_LOG_MAX_LINE]
+            if line:
+                self._line(line)
+
+    def _line(self, line: str) -> None:
+        self.lines.append(line)
+        if self.finished is not None:
             return
+        self.state = 'running'
+        m = OTA_PROGRESS_RE.search(line)
+        if m and int(m.group(1)) <= 100:
+            self.percent = int(m.group(1))
+        if OTA_FAIL_RE.search(line):
+            self.finish('failed')
+        elif OTA_DONE_RE.search(line):
+            self.finish('done')
 
-        if config.id != ALL_DEVICES_WILDCARD and config.id not in pair_devices:
-            log.error('"{}" is not a known paired device'.format(config.id))
-            sys.exit(-1)
+    def finish(self, state: str) -> None:
+        if self.finished is None:
+            self.state = state
+            self.finished = time.monotonic()
 
-        candidates = {
-            k: v for k, v in pair_devices.items()
-            if config.id == ALL_DEVICES_WILDCARD or k == config.id
-        }
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    def last_line(self) -> str:
+        return self.lines[-1] if self.lines else ''
+
+
+class _OTALogCollector(asyncio.DatagramProtocol):
+    """
+    Listens on the UDP log port (what `nc -kulnw0 45678` shows) and splits the stream by
+    source IP into one _OTAProgress per watched device. Only the last OTA_LOG_MAX_LINES
+    lines of each device are kept; datagrams from other hosts are counted and dropped.
+    """
+    def __init__(self, log, port: int = OTA_LOG_PORT):
+        self.log = log
+        self.port = port
+        self.transport = None
+        self.by_ip = {}  # source IP -> _OTAProgress
+        self.ignored = 0
+        self._changed = asyncio.Event()
+
+    async def start(self) -> bool:
+        loop = asyncio.get_running_loop()
+        try:
+            self.transport, _ = await loop.create_datagram_endpoint(lambda: self, local_addr=('0.0.0.0', self.port),
+                                                                    allow_broadcast=True)
+        except OSError as e:
+            self.log.warning("OTA log: cannot listen on UDP port {}: {}".format(self.port, e))
+            return False
+        self.log.debug("OTA log: listening on UDP port %d", self.port)
+        return True
+
+    def close(self) -> None:
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def watch(self, hd: HAADevice) -> _OTAProgress:
+        progress = _OTAProgress(hd)
+        self.by_ip[hd.getIpAddress()] = progress
+        return progress
+
+    def progress(self, hd: HAADevice):
+        return self.by_ip.get(hd.getIpAddress())
 
-        total = len(candidates)
-        results = []
-        for i, (k, v) in enumerate(candidates.items(), 1):
-            dev_info = name_to_ip.get(k)
-            if dev_info:
-                desc = f"{dev_info['name']}  {dev_info['ip']}  {dev_info['mac']}"
+    def datagram_received(self, data: bytes, addr) -> None:
+        progress = self.by_ip.get(addr[0])
+        if progress is None:
+            self.ignored += 1
+            return
+        state = progress.state
+        progress.feed(data.decode('utf-8', errors='replace'))
+        if progress.state != state:
+            self._changed.set()
+
+    def finished(self) -> bool:
+        return all(p.finished is not None for p in self.by_ip.values())
+
+    def report(self) -> None:
+        for p in self.by_ip.values():
+            if p.finished is None:
+                percent = "" if p.percent is None else " {}%".format(p.percent)
+                self.log.info("OTA {}({}): {}{} {}".format(p.device.getId(), p.device.getName(), p.state, percent,
+                                                           p.last_line()))
+
+    async def wait(self, timeout: float) -> dict:
+        """Wait until every watched device completed or failed; the others time out. Returns ip -> _OTAProgress."""
+        deadline = time.monotonic() + timeout
+        next_report = time.monotonic() + OTA_LOG_REPORT_INTERVAL
+        while not self.finished() and time.monotonic() < deadline:
+            self._changed.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._changed.wait(), timeout=min(next_report, deadline) - time.monotonic())
+            if time.monotonic() >= next_report:
+                self.report()
+                next_report = time.monotonic() + OTA_LOG_REPORT_INTERVAL
+        for p in self.by_ip.values():
+            p.finish('timeout')
+        return self.by_ip
+
+
+class _RolloutScheduler:
+    """
+    Staged OTA rollout: a canary group first, then waves of `wave_size` devices with
+    at most `max_inflight` updates running at once. A wave starts only when every device
+    of the previous one is back online on the target firmware (or has timed out), and the
+    rollout halts once the failure rate exceeds `max_failure_rate`.
+    """
+    def __init__(self, devices: list, target_version, canary: int, wave_size: int, max_inflight: int,
+                 max_failure_rate: float, timeout: int, log, poll_interval: int = ROLLOUT_POLL_INTERVAL,
+                 records: _RecordStream = None, ota: _OTALogCollector = None):
+        self.devices = devices
+        self.target_version = target_version
+        self.canary = max(0, canary)
+        self.wave_size = wave_size if wave_size > 0 else len(devices)
+        self.max_inflight = max(1, max_inflight)
+        self.max_failure_rate = max_failure_rate
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.log = log
+        self.records = records
+        self.ota = ota
+        self.results = {}  # device id -> (ok, elapsed seconds, fw version)
+
+    def _waves(self) -> list:
+        waves = []
+        rest = list(self.devices)
+        if self.canary:
+            waves.append(rest[:self.canary])
+            rest = rest[self.canary:]
+        while rest:
+            waves.append(rest[:self.wave_size])
+            rest = rest[self.wave_size:]
+        return waves
+
+    async def _wait_for_version(self, hd: HAADevice, old_version, deadline: float, progress: _OTAProgress = None):
+        """
+        Poll the device until it reports the target FW version (or any new one when unknown).
+        Gives up early when its update log (`progress`) reports a failure.
+        """
+        fw = None
+        while time.monotonic() < deadline:
+            await asyncio.sleep(self.poll_interval)
+            if progress is not None and progress.state == 'failed':
+                self.log.error("{}({}) update log: {}".format(hd.getId(), hd.getName(), progress.last_line()))
+                return False, fw
+            try:
+                fw = await hd.refreshFwVersion()
+            except Exception as e:
+                self.log.debug("%s not back yet: %s: %s", hd.getName(), type(e).__name__, e)
+                continue
+            if _is_new_firmware(fw, old_version, self.target_version):
+                return True, fw
+        return False, fw
+
+    async def _update_one(self, hd: HAADevice, sem: asyncio.Semaphore):
+        async with sem:
+            old_version = hd.getFwVersion()
+            start = time.monotonic()
+            self.log.info("UPDATE Device: {}({})        Id: {:20s} Ip: {:20s}".format(hd.getId(), hd.getName(), hd.getId(), hd.getIpAddress()))
+            error = None
+            progress = self.ota.watch(hd) if self.ota is not None else None
+            try:
+                await hd.configStartUpdate()
+                ok, fw = await self._wait_for_version(hd, old_version, start + self.timeout, progress)
+                if not ok:
+                    error = "UpdateFailed" if progress is not None and progress.state == 'failed' else "UpdateTimeout"
+            except Exception as e:
+                self.log.debug("%s update error: %s: %s", hd.getName(), type(e).__name__, e)
+                ok, fw, error = False, None, e
+            elapsed = time.monotonic() - start
+            self.results[hd.getId()] = (ok, elapsed, fw)
+            Context.get().get_metrics().add('ota_update', elapsed, hd.getId())
+            if self.records is not None:
+                self.records.emit('rollout', hd.getId(), elapsed, error, name=hd.getName(),
+                                  old_fw=old_version, fw=fw)
+            if ok:
+                self.log.info("UPDATED Device: {}({}) {} -> {} in {:.0f}s".format(hd.getId(), hd.getName(), old_version, fw, elapsed))
             else:
-                desc = f"{k}  (no match)"
-            print(f"\rConnecting ({i}/{total}): {desc}...", end='\033[K', flush=True)
-            result = await _try_connect_pairing(k, v, name_to_ip, ctx, log)
-            results.append(result)
-        print()  # newline after progress
+                self.log.error("UPDATE FAILED Device: {}({}) still on {} after {:.0f}s".format(hd.getId(), hd.getName(), fw or old_version, elapsed))
+
+    def _failure_rate(self) -> float:
+        if not self.results:
+            return 0.0
+        failed = sum(1 for ok, _, _ in self.results.values() if not ok)
+        return failed / len(self.results)
+
+    async def run(self) -> dict:
+        start = time.monotonic()
+        waves = self._waves()
+        sem = asyncio.Semaphore(self.max_inflight)
+        for n, wave in enumerate(waves, 1):
+            label = "Canary" if self.canary and n == 1 else "Wave {}/{}".format(n, len(waves))
+            self.log.info("{}: updating {} device(s)".format(label, len(wave)))
+            await asyncio.gather(*(self._update_one(hd, sem) for hd in wave))
+            rate = self._failure_rate()
+            if rate > self.max_failure_rate and n < len(waves):
+                skipped = sum(len(w) for w in waves[n:])
+                self.log.error("Rollout HALTED: failure rate {:.0%} > {:.0%}, {} device(s) not updated".format(
+                    rate, self.max_failure_rate, skipped))
+                break
+        done = sum(1 for ok, _, _ in self.results.values() if ok)
+        self.log.info("Rollout finished: {}/{} device(s) updated in {:.0f}s".format(
+            done, len(self.devices), time.monotonic() - start))
+        return self.results
+
 
-        haaDevices = []
-        for result in results:
-            if result is None:
+class _ConvergenceWatcher:
+    """
+    --wait-online: after reboot, wifi or update, wait until every device answers on HAP
+    again (on a new firmware after an update). All devices are watched concurrently
+    within one global deadline; each is probed with exponential backoff, and an mDNS
+    announcement of the device triggers its next probe at once.
+    """
+    def __init__(self, ctx, timeout: float, log, records: _RecordStream = None):
+        self.ctx = ctx
+        self.timeout = timeout
+        self.log = log
+        self.records = records
+        self.wakeups = {}  # device id -> asyncio.Event
+        self._resolving = set()
+
+    def _on_mdns(self, type_: str, name: str) -> None:
+        if name in self._resolving:
+            return
+        self._resolving.add(name)
+        task = asyncio.create_task(self.ctx._resolveHAP(type_, name))
+
+        def resolved(t):
+            self._resolving.discard(name)
+            disc = None if t.cancelled() else t.result()
+            wakeup = self.wakeups.get(disc.description.id) if disc not in (None, NOT_HAA) else None
+            if wakeup is not None:
+                self.log.debug("%s announced itself on mDNS", name)
+                wakeup.set()
+
+        task.add_done_callback(resolved)
+
+    async def _watch(self, hd: HAADevice, command: str, sent_at: float, deadline: float, old_version, target_version):
+        """Returns (ok, fw): ok once the device answers (with a new firmware after an update)."""
+        wakeup = self.wakeups[hd.getId()]
+        delay = CONVERGE_FIRST_PROBE - (time.monotonic() - sent_at)
+        fw = None
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False, fw
+            wakeup.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(wakeup.wait(), max(0.0, min(delay, remaining)))
+            delay = min(max(delay, 1) * 2, CONVERGE_BACKOFF_MAX)
+            try:
+                fw = await hd.refreshFwVersion(timeout=max(0.1, min(CONVERGE_PROBE_TIMEOUT, deadline - time.monotonic())))
+            except Exception as e:
+                self.log.debug("%s not back yet: %s: %s", hd.getName(), type(e).__name__, e)
                 continue
-            k, v, zc, data = result
-            for accessory in data:
-                for service in accessory['services']:
-                    if service['type'] != SERVICE_INFO_TYPE:
-                        continue
-                    for char in service['characteristics']:
-                        if char.get('type') == SERVICE_INFO_CHAR_NAME:
-                            device_name = char.get('value', '')
-                            haaDev = HAADevice(zc, data, v)
-                            if haaDev.manufacturer and haaDev.manufacturer.startswith(HAA_MANUFACTURER):
-                                log.debug("haa device {} ({}) handled ...".format(k, device_name))
-                                haaDevices.append(haaDev)
-                            break
-                    break
+            if command != 'update' or _is_new_firmware(fw, old_version, target_version):
+                return True, fw
+            self.log.debug("%s back on %s, waiting for the new firmware", hd.getName(), fw)
+
+    async def _watch_one(self, hd: HAADevice, command: str, sent_at: float, deadline: float, target_version) -> tuple:
+        old_version = hd.getFwVersion()
+        ok, fw = await self._watch(hd, command, sent_at, deadline, old_version, target_version)
+        elapsed = time.monotonic() - sent_at
+        Context.get().get_metrics().add('wait_online', elapsed, hd.getId())
+        if ok:
+            self.log.info("BACK ONLINE Device: {}({}) after {} in {:.1f}s, fw: {}".format(
+                hd.getId(), hd.getName(), command, elapsed, fw))
+        else:
+            self.log.error("NOT BACK Device: {}({}) {:.0f}s after {}".format(hd.getId(), hd.getName(), elapsed, command))
+        if self.records is not None:
+            self.records.emit('online', hd.getId(), elapsed, None if ok else "NotBackOnline", command=command,
+                              name=hd.getName(), old_fw=old_version, fw=fw)
+        return ok, elapsed, fw
+
+    async def run(self, sent: list) -> dict:
+        """`sent`: [(HAADevice, command, time.monotonic() when it was sent)]. Returns id -> (ok, elapsed, fw)."""
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + self.timeout
+        target_version = _release_version(HAADevice.getLastRelease()) if any(c == 'update' for _, c, _ in sent) else None
+        self.wakeups = {hd.getId(): asyncio.Event() for hd, _, _ in sent}
+        self.log.info("Waiting up to {}s for {} device(s) to be back online..".format(self.timeout, len(sent)))
+        listener = self.ctx._hap_listener
+        if listener is not None:
+            on_change = lambda type_, name: loop.call_soon_threadsafe(self._on_mdns, type_, name)
+            listener.add_listener(on_change)
+        try:
+            results = await asyncio.gather(*(self._watch_one(hd, command, sent_at, deadline, target_version)
+                                             for hd, command, sent_at in sent))
+        finally:
+            if listener is not None:
+                listener.remove_listener(on_change)
+        return {hd.getId(): result for (hd, _, _), result in zip(sent, results)}
+
+
+def _pipeline_commands(config) -> list:
+    """Commands to run on every device: the subcommand itself or the list given to "pipeline"."""
+    if config.command != 'pipeline':
+        return [config.command]
+    return [c.strip() for c in config.commands.split(',') if c.strip()]
+
+
+def _check_pipeline(commands: list) -> str:
+    """Return an error message if the pipeline cannot be run, None otherwise."""
+    if not commands:
+        return "empty pipeline"
+    for n, command in enumerate(commands):
+        if command not in DEVICE_COMMANDS:
+            return '"{}" cannot be used in a pipeline (allowed: {})'.format(command, ", ".join(DEVICE_COMMANDS))
+        if command in SESSION_ENDING_COMMANDS and n != len(commands) - 1:
+            return '"{}" drops the device session and must be the last command'.format(command)
+    return None
 
+
+def _make_scanner(config) -> _TCPScanner:
+    return _TCPScanner(_scan_networks(config.subnet, config.interface, Context.get().get_logger()),
+                       config.scan_concurrency or SCAN_CONCURRENCY, config.scan_rate)
+
+
+def _build_haa_devices(results: list, name_to_ip: dict, ctx, log) -> list:
+    """Turn _try_connect_pairing results into HAADevices, recording them in the inventory."""
+    haaDevices = []
+    cache = ctx.get_accessory_cache()
+    for result in results:
+        if result is None:
+            continue
+        k, v, zc, data = result
+        if data.config_num is None:  # read before its c# was heard: the discovery may know it by now
+            data.config_num = _known_config_number(ctx, k, v)
+        if data.find(SERVICE_INFO_TYPE, SERVICE_INFO_CHAR_NAME) is None:
+            continue
+        haaDev = HAADevice(zc, data, v)
+        if haaDev.manufacturer and haaDev.manufacturer.startswith(HAA_MANUFACTURER):
+            log.debug("haa device {} ({}) handled ...".format(k, haaDev.name))
+            haaDevices.append(haaDev)
+            dev_info = name_to_ip.get(k, {})
+            ctx.get_inventory().update(k, ip=dev_info.get('ip'), mac=dev_info.get('mac'),
+                                       port=dev_info.get('port'), name=dev_info.get('name'),
+                                       fw=haaDev.getFwVersion())
+
+    ctx.get_inventory().save()
+    cache.save()
+    return haaDevices
+
+
+async def _run_on_device(command: str, hd: HAADevice, config, log, staged_rollout: bool, to_update: list,
+                         ota: _OTALogCollector = None) -> dict:
+    """
+    Run a single command on one device; staged updates are queued in `to_update`,
+    direct ones are watched by `ota` when given.
+    Returns the result fields of the --output jsonl record; the text output prints them.
+    """
+    text = getattr(config, 'output', 'text') == 'text'
+    if command == "reboot":
+        log.info("REBOOT Device: {}({})        Id: {:20s} Ip: {:20s}".format(hd.getId(), hd.getName(), hd.getId(), hd.getIpAddress()))
+        await hd.configReboot()
+    elif command == "update":
+        device_fw = hd.getFwVersion()
+        latest_tag = HAADevice.getLastRelease()
+        latest_ver = _release_version(latest_tag)
+
+        needs_update = True
+        if device_fw and latest_ver:
+            needs_update = not _is_same_version(device_fw, latest_ver)
+
+        if needs_update and staged_rollout:
+            log.info("Device {}({}) fw: {} -> Latest release: {}".format(hd.getId(), hd.getName(), device_fw, latest_tag))
+            to_update.append(hd)
+            return {'fw': device_fw, 'latest': latest_tag, 'action': 'staged'}
+        elif needs_update:
+            log.info("UPDATE Device: {}({})        Id: {:20s} Ip: {:20s}".format(hd.getId(), hd.getName(), hd.getId(), hd.getIpAddress()))
+            log.info("Device fw: {} -> Latest release: {}".format(device_fw, latest_tag))
+            if ota is None:
+                log.info("use: nc -kulnw0 45678")
+            else:
+                ota.watch(hd)
+            await hd.configStartUpdate()
+            return {'fw': device_fw, 'latest': latest_tag, 'action': 'update'}
+        else:
+            log.info("SKIP UPDATE: Device {} ({}) already at latest version {}".format(hd.getId(), hd.getName(), device_fw))
+            return {'fw': device_fw, 'latest': latest_tag, 'action': 'skip'}
+    elif command == "wifi":
+        log.info("WIFI RECONNECTION Device: {}({})        Id: {:20s} Ip: {:20s}".format(hd.getId(), hd.getName(), hd.getId(), hd.getIpAddress()))
+        await hd.configWifiReconnection()
+    elif command == "setup":
+        log.info("SETUP Device: {}({})        Id: {:20s} Ip: {:20s}".format(hd.getId(), hd.getName(), hd.getId(), hd.getIpAddress()))
+        log.info("http://{}:4567".format(hd.getIpAddress()))
+        await hd.configEnterSetup()
+        return {'url': "http://{}:{}".format(hd.getIpAddress(), SETUP_PORT)}
+    elif command == "dump":
+        log.info("DUMP Device: {}({})        Id: {:20s} Ip: {:20s}".format(hd.getId(), hd.getName(), hd.getId(), hd.getIpAddress()))
+        if getattr(config, 'out', None):
+            return {'c#': hd.data.config_num}
+        if text:
+            hd.dumpHomekitData()
+            return {}
+        return {'services': hd.homekitData()}
+    elif command == "script":
+        if getattr(config, 'params', None):
+            if text:
+                print(f"Running script with parameters: {config.params}")
+            return {'params': config.params}
+        else:
+            log.info("Script Device: {}({})        Id: {:20s} Ip: {:20s}".format(hd.getId(), hd.getName(), hd.getId(), hd.getIpAddress()))
+            script = await hd.getConfigScript()
+            if text:
+                print(script)
+                print()
+            return {'script': script}
+    elif command == "version":
+        log.info("Device: {}({})       Version: {:20s}".format(hd.getId(), hd.getName(), hd.getFwVersion()))
+        return {'fw': hd.getFwVersion()}
+    return {}
+
+
+async def _execute_command(config, haaDevices: list, log, records: _RecordStream = None) -> None:
+    """
+    Run config.command (or every command of a pipeline) on every connected HAA device.
+    With `records` every command is reported as soon as it completes and a failing device
+    is skipped instead of ending the run.
+    """
+    if records is None:
         print("")
-        log.info("{} Devices Match".format(len(haaDevices)))
+    log.info("{} Devices Match".format(len(haaDevices)))
 
-        # Emit PairId lines so external parsers (e.g. HA push script) can extract
-        # ip, mac, name, category without needing mDNS discovery.
+    # Emit PairId lines so external parsers (e.g. HA push script) can extract
+    # ip, mac, name, category without needing mDNS discovery.
+    if records is None:
         for hd in haaDevices:
             print("PairId: {:20s} Ip: {:20s} Name: {:20s} Category: {:20s}".format(
                 hd.getId(),
@@ -1103,60 +3080,832 @@ async def _run_device_command(config, log) -> None:
                 hd.getName(),
                 homekitCategoryToString(hd.getCategory())))
 
-        for hd in haaDevices:
-            if config.command == "reboot":
-                log.info("REBOOT Device: {}({})        Id: {:20s} Ip: {:20s}".format(hd.getId(), hd.getName(), hd.getId(), hd.getIpAddress()))
-                await hd.configReboot()
-            elif config.command == "update":
-                device_fw = hd.getFwVersion()
-                latest_tag = HAADevice.getLastRelease()
-
-                latest_ver = None
-                if latest_tag:
-                    m = re.search(r'(\d+(?:\.\d+)+)', str(latest_tag))
-                    latest_ver = m.group(1) if m else latest_tag
-
-                needs_update = True
-                if device_fw and latest_ver:
-                    try:
-                        same_version = (versionCompare(device_fw, latest_ver) == 0)
-                        needs_update = not same_version
-                    except Exception:
-                        needs_update = (device_fw != latest_ver)
+    commands = _pipeline_commands(config)
+    staged_rollout = "update" in commands and (getattr(config, 'canary', 0) > 0 or getattr(config, 'wave_size', 0) > 0)
+    to_update = []
 
-                if needs_update:
-                    log.info("UPDATE Device: {}({})        Id: {:20s} Ip: {:20s}".format(hd.getId(), hd.getName(), hd.getId(), hd.getIpAddress()))
-                    log.info("Device fw: {} -> Latest release: {}".format(device_fw, latest_tag))
-                    log.info("use: nc -kulnw0 45678")
-                    await hd.configStartUpdate()
-                else:
-                    log.info("SKIP UPDATE: Device {} ({}) already at latest version {}".format(hd.getId(), hd.getName(), device_fw))
-            elif config.command == "wifi":
-                log.info("WIFI RECONNECTION Device: {}({})        Id: {:20s} Ip: {:20s}".format(hd.getId(), hd.getName(), hd.getId(), hd.getIpAddress()))
-                await hd.configWifiReconnection()
-            elif config.command == "setup":
-                log.info("SETUP Device: {}({})        Id: {:20s} Ip: {:20s}".format(hd.getId(), hd.getName(), hd.getId(), hd.getIpAddress()))
-                log.info("http://{}:4567".format(hd.getIpAddress()))
-                await hd.configEnterSetup()
-            elif config.command == "dump":
-                log.info("DUMP Device: {}({})        Id: {:20s} Ip: {:20s}".format(hd.getId(), hd.getName(), hd.getId(), hd.getIpAddress()))
-                hd.dumpHomekitData()
-            elif config.command == "script":
-                if config.params:
-                    print(f"Running script with parameters: {config.params}")
-                else:
-                    log.info("Script Device: {}({})        Id: {:20s} Ip: {:20s}".format(hd.getId(), hd.getName(), hd.getId(), hd.getIpAddress()))
-                    script = await hd.getConfigScript()
-                    print(script)
-                    print()
-            elif config.command == "version":
-                log.info("Device: {}({})       Version: {:20s}".format(hd.getId(), hd.getName(), hd.getFwVersion()))
+    if commands == ['backup']:
+        await _backup_scripts(config, haaDevices, log, records)
+        return
+    if commands == ['get']:
+        await _read_characteristics(config, haaDevices, log, records)
+        return
+    if commands == ['set']:
+        await _write_characteristics(config, haaDevices, log, records)
+        return
+
+    ota = None
+    if "update" in commands and getattr(config, 'watch_ota', False):
+        ota = _OTALogCollector(log, config.ota_port)
+        if not await ota.start():
+            ota = None
+    try:
+        sent = await _run_commands(config, commands, haaDevices, log, records, staged_rollout, to_update, ota)
+        if "dump" in commands and getattr(config, 'out', None):
+            await _write_dump(config.out, haaDevices, log)
+        if ota is not None and not staged_rollout and ota.by_ip:
+            log.info("Waiting for {} update(s)..".format(len(ota.by_ip)))
+            _report_ota(await ota.wait(config.update_timeout), log, records)
+        if sent and getattr(config, 'wait_online', 0) > 0:
+            await _ConvergenceWatcher(Context.get(), config.wait_online, log, records).run(sent)
     finally:
-        if patched_file != config.file:
+        if ota is not None:
+            ota.close()
+
+
+async def _backup_scripts(config, haaDevices: list, log, records: _RecordStream = None) -> dict:
+    """backup: read the script of every device concurrently and store it in the _ScriptStore."""
+    store = _ScriptStore(config.backup_dir or os.path.join(Context.get().get_cache_dir(), BACKUP_DIR))
+    sem = asyncio.Semaphore(max(1, config.concurrency))
+    manifest = {}
+    written = 0
+
+    async def backup_one(hd):
+        nonlocal written
+        entry = {'name': hd.getName(), 'ip': hd.getIpAddress(), 'fw': hd.getFwVersion()}
+        start = time.monotonic()
+        error = None
+        async with sem:
+            try:
+                script = await hd.getConfigScript()
+            except Exception as e:
+                log.debug("%s script read error: %s: %s", hd.getName(), type(e).__name__, e)
+                script, error = None, e
+        if script is None:
+            error = error or "NoScript"
+            entry['error'] = error if isinstance(error, str) else type(error).__name__
+            log.error("BACKUP FAILED Device: {}({}): {}".format(hd.getId(), hd.getName(), entry['error']))
+        else:
+            entry['sha256'], size = store.put(script)
+            written += size
+            log.info("BACKUP Device: {}({}) {} {}".format(hd.getId(), hd.getName(), entry['sha256'][:12],
+                                                          "new" if size else "unchanged"))
+        manifest[hd.getId()] = entry
+        if records is not None:
+            records.emit('backup', hd.getId(), time.monotonic() - start, error, **entry)
+
+    await asyncio.gather(*(backup_one(hd) for hd in haaDevices))
+    path = store.write_manifest(manifest)
+    saved = sum(1 for e in manifest.values() if 'sha256' in e)
+    log.info("Backup: {}/{} script(s), {} new byte(s), manifest {}".format(saved, len(manifest), written, path))
+    return manifest
+
+
+async def _read_characteristics(config, haaDevices: list, log, records: _RecordStream = None) -> dict:
+    """
+    get: read the selected characteristics of every device concurrently, one get_characteristics
+    request per device. Returns {pairId -> [(aid, iid, name, value)]}.
+    """
+    selector = _CharSelector(config.selector)
+    metrics = Context.get().get_metrics()
+    sem = asyncio.Semaphore(max(1, config.concurrency))
+    store = _series_store(config)
+    rows = {}
+
+    async def read_one(hd):
+        chars = selector.select(hd.data)
+        if not chars:
+            log.debug("%s: no characteristic matches %s", hd.getName(), config.selector)
+            if records is not None:
+                records.emit('get', hd.getId(), 0, "no matching characteristic", name=hd.getName(), values=[])
+            return
+        start = time.monotonic()
+        error = None
+        async with sem:
+            try:
+                with metrics.phase('get_characteristics', hd.getId()):
+                    results = await hd.pairing.get_characteristics([(ch.aid, ch.iid) for ch in chars])
+            except Exception as e:
+                log.error("GET FAILED Device: {}({}): {}: {}".format(hd.getId(), hd.getName(), type(e).__name__, e))
+                results, error = {}, e
+        values = []
+        now = time.time()
+        for ch in chars:
+            res = results.get((ch.aid, ch.iid), {})
+            if 'status' in res and res['status'] != 0:
+                value = "status {}".format(res['status'])
+            else:
+                value = res.get('value')
+            values.append((ch.aid, ch.iid, _CharSelector.name_of(ch), value))
+            if store is not None and ch.format in _SeriesStore.FORMATS and 'value' in res:
+                store.describe(hd.getId(), hd.getName(), ch.aid, ch.iid, ch.type, values[-1][2])
+                store.append(hd.getId(), ch.aid, ch.iid, now, value)
+        rows[hd.getId()] = values
+        if records is not None:
+            records.emit('get', hd.getId(), time.monotonic() - start, error, name=hd.getName(),
+                         values=[{'aid': a, 'iid': i, 'type': n, 'value': v} for a, i, n, v in values])
+
+    await asyncio.gather(*(read_one(hd) for hd in haaDevices))
+    if store is not None:
+        store.close()
+    if records is None:
+        names = {hd.getId(): hd.getName() for hd in haaDevices}
+        lines = [(pid, names[pid], "{}.{}".format(a, i), n, "-" if v is None else str(v))
+                 for pid in sorted(rows, key=lambda p: names[p]) for a, i, n, v in rows[pid]]
+        widths = [max(len(line[col]) for line in lines) for col in range(4)] if lines else []
+        for line in lines:
+            print("  ".join(f.ljust(w) for f, w in zip(line, widths)) + "  " + line[4])
+    log.info("Read {} characteristic(s) on {}/{} device(s)".format(
+        sum(len(v) for v in rows.values()), len(rows), len(haaDevices)))
+    return rows
+
+
+async def _write_characteristics(config, haaDevices: list, log, records: _RecordStream = None) -> dict:
+    """
+    set: write the assignments to every device (of --category) concurrently, all the writes
+    of a device in one put_characteristics request. Returns {pairId -> error or None}.
+    """
+    writes = _parse_char_writes(config.assignments)
+    if getattr(config, 'category', None):
+        category = _normalize_char_name(config.category)
+        haaDevices = [hd for hd in haaDevices
+                      if category in (_normalize_char_name(homekitCategoryToString(hd.getCategory())),
+                                      _normalize_char_name(getattr(hd.getCategory(), 'name', '')))]
+        log.info("{} device(s) of category {}".format(len(haaDevices), config.category))
+    sem = asyncio.Semaphore(max(1, config.concurrency))
+    outcome = {}
+
+    async def write_one(hd):
+        values = {}
+        try:
+            for selector, text in writes:
+                for ch in selector.select(hd.data, 'pw'):
+                    values[(ch.aid, ch.iid)] = _char_value(ch, text)
+        except ValueError as e:
+            log.error("SET FAILED Device: {}({}): {}".format(hd.getId(), hd.getName(), e))
+            outcome[hd.getId()] = e
+            if records is not None:
+                records.emit('set', hd.getId(), 0, e, name=hd.getName())
+            return
+        if not values:
+            log.debug("%s: no writable characteristic matches %s", hd.getName(), config.assignments)
+            outcome[hd.getId()] = "no matching characteristic"
+            if records is not None:
+                records.emit('set', hd.getId(), 0, outcome[hd.getId()], name=hd.getName())
+            return
+        start = time.monotonic()
+        error = None
+        async with sem:
             try:
-                os.unlink(patched_file)
-            except Exception:
+                results = await hd._putCharacteristics([(aid, iid, v) for (aid, iid), v in values.items()])
+            except Exception as e:
+                results, error = {}, e
+        failed = {"{}.{}".format(*k): r.get('description', r.get('status')) for k, r in (results or {}).items()
+                  if r.get('status', 0) != 0}
+        if error is None and failed:
+            error = "Status"
+        outcome[hd.getId()] = error
+        if error is None:
+            log.info("SET Device: {}({}) {} characteristic(s)".format(hd.getId(), hd.getName(), len(values)))
+        else:
+            log.error("SET FAILED Device: {}({}): {}".format(hd.getId(), hd.getName(), failed or
+                                                              "{}: {}".format(type(error).__name__, error)))
+        if records is not None:
+            records.emit('set', hd.getId(), time.monotonic() - start, error, name=hd.getName(),
+                         values={"{}.{}".format(aid, iid): v for (aid, iid), v in values.items()}, failed=failed)
+
+    await asyncio.gather(*(write_one(hd) for hd in haaDevices))
+    log.info("Set on {}/{} device(s)".format(sum(1 for e in outcome.values() if e is None), len(outcome)))
+    return outcome
+
+
+def _series_store(config):
+    """The _SeriesStore for --record, None without it."""
+    if not getattr(config, 'record', False):
+        return None
+    return _open_series_store(config)
+
+
+def _open_series_store(config) -> _SeriesStore:
+    """The _SeriesStore of --history-dir, compacted once a day."""
+    store = _SeriesStore(config.history_dir or os.path.join(Context.get().get_cache_dir(), HISTORY_DIR))
+    try:
+        store.compact()
+    except OSError as e:
+        Context.get().get_logger().warning("history: cannot compact %s: %s", store.path, e)
+    return store
+
+
+def _parse_duration(text: str) -> float:
+    """Seconds of "90", "90s", "30m", "24h", "7d" or "2w"; raises ValueError."""
+    m = re.fullmatch(r'(\d+(?:\.\d+)?)([smhdw]?)', text.strip())
+    if not m:
+        raise ValueError('"{}" is not a duration'.format(text))
+    return float(m.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}[m.group(2)]
+
+
+def _parse_time(text: str, now: float) -> float:
+    """A duration before `now` or an ISO date ("2026-10-01", "2026-10-01T12:00", local time); raises ValueError."""
+    from datetime import datetime
+    try:
+        return now - _parse_duration(text)
+    except ValueError:
+        return datetime.fromisoformat(text).timestamp()
+
+
+def _show_history(config, log, records: _RecordStream = None) -> None:
+    """history: min, max and mean of every recorded series matching the selector, from the _SeriesStore."""
+    store = _open_series_store(config)
+    selector = _CharSelector(config.selector) if config.selector else None
+    now = time.time()
+    try:
+        since = _parse_time(config.since, now)
+        until = _parse_time(config.until, now) if config.until else now
+        step = _parse_duration(config.step) if config.step else None
+    except ValueError as e:
+        log.error(e)
+        sys.exit(1)
+
+    lines = []
+    for pid in store.devices():
+        if config.id != ALL_DEVICES_WILDCARD and pid != config.id:
+            continue
+        index = store.index(pid)
+        for key, meta in sorted(index['series'].items()):
+            aid, iid = map(int, key.split('.'))
+            if selector is not None and not selector.matches(aid, iid, meta['type'], meta['name']):
+                continue
+            buckets = store.query(pid, aid, iid, since, until, step)
+            if records is not None:
+                records.emit('history', pid, name=index['name'], aid=aid, iid=iid, type=meta['name'], buckets=[
+                    {'start': round(start, 3), 'count': b.count, 'min': round(b.min, 3), 'max': round(b.max, 3),
+                     'mean': round(b.mean, 3)} for start, b in buckets])
+                continue
+            for start, b in buckets:
+                lines.append((pid, index['name'] or '', key, meta['name'],
+                              time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start)), str(b.count),
+                              "{:g}".format(round(b.min, 3)), "{:g}".format(round(b.max, 3)),
+                              "{:g}".format(round(b.mean, 3))))
+    if records is None:
+        header = ("PairId", "Name", "aid.iid", "Characteristic", "From", "Count", "Min", "Max", "Mean")
+        widths = [max(len(line[col]) for line in lines + [header]) for col in range(len(header))]
+        for line in [header] + lines:
+            print("  ".join(f.ljust(w) for f, w in zip(line, widths)).rstrip())
+
+
+class _CharWatcher:
+    """
+    watch: subscribe to the HAP events of the selected characteristics on every device and
+    print every change as it arrives, with its timestamp. aiohomekit restores a session that
+    dropped for a moment by itself (and subscribes again); the current values are then read
+    to cover the gap. A device still disconnected at the next check, or that does not answer
+    the probe after WATCH_KEEPALIVE seconds of silence, is connected again through
+    _try_connect_pairing with exponential backoff and subscribed again; its accessory
+    database is read again, a reboot may have changed it.
+    """
+    def __init__(self, ctx, config, pair_devices: dict, name_to_ip: dict, log, records: _RecordStream = None):
+        self.ctx = ctx
+        self.config = config
+        self.pair_devices = pair_devices
+        self.name_to_ip = name_to_ip
+        self.log = log
+        self.records = records
+        self.selector = _CharSelector(config.selector)
+        self.store = _series_store(config)
+        self.last_seen = {}  # device id -> time.monotonic() of the last event
+        self._relocated = {}  # device id -> time.monotonic() of the last prescan
+        self._catch_up = set()
+
+    async def _resume(self, hd: HAADevice, names: dict) -> None:
+        self.log.info("WATCH RESUMED Device: {}({})".format(hd.getId(), hd.getName()))
+        if self.records is not None:
+            self.records.emit('reconnect', hd.getId(), name=hd.getName(), ts=round(time.time(), 3))
+        with contextlib.suppress(Exception):
+            self._on_event(hd, names, await hd.pairing.get_characteristics(list(names)))
+
+    def _on_event(self, hd: HAADevice, names: dict, event: dict) -> None:
+        """aiohomekit listener: {(aid, iid): {'value': ...}}, called in the event loop."""
+        if not event:
+            # aiohomekit restored the session on its own
+            task = asyncio.create_task(self._resume(hd, names))
+            self._catch_up.add(task)
+            task.add_done_callback(self._catch_up.discard)
+            return
+        ts = time.time()
+        self.last_seen[hd.getId()] = time.monotonic()
+        for (aid, iid), res in event.items():
+            name = names.get((aid, iid))
+            if name is None or 'value' not in res:
+                continue
+            if self.records is not None:
+                self.records.emit('change', hd.getId(), name=hd.getName(), ts=round(ts, 3), aid=aid, iid=iid,
+                                  type=name, value=res['value'])
+            else:
+                print("{}.{:03d}  {}  {}  {}.{}  {}  {}".format(time.strftime('%H:%M:%S', time.localtime(ts)),
+                                                            int(ts * 1000) % 1000, hd.getId(), hd.getName(),
+                                                            aid, iid, name, res['value']), flush=True)
+            if self.store is not None:
+                self.store.append(hd.getId(), aid, iid, ts, res['value'])
+
+    async def _subscribe(self, hd: HAADevice):
+        """
+        Subscribe to the selected characteristics of `hd` and report their current values.
+        Returns the (aid, iid) to probe the session with, None when no characteristic matches.
+        """
+        chars = self.selector.select(hd.data, 'ev')
+        if not chars:
+            self.log.debug("%s: no characteristic with events matches %s", hd.getName(), self.config.selector)
+            return None
+        names = {(ch.aid, ch.iid): _CharSelector.name_of(ch) for ch in chars}
+        if self.store is not None:
+            for ch in (ch for ch in chars if ch.format in _SeriesStore.FORMATS):
+                self.store.describe(hd.getId(), hd.getName(), ch.aid, ch.iid, ch.type, names[(ch.aid, ch.iid)])
+        hd.pairing.dispatcher_connect(lambda event: self._on_event(hd, names, event))
+        with self.ctx.get_metrics().phase('subscribe', hd.getId()):
+            status = await hd.pairing.subscribe(list(names))
+        failed = ["{}.{}".format(*k) for k, r in (status or {}).items() if r.get('status', 0) != 0]
+        if failed:
+            self.log.warning("{}: no events for {}".format(hd.getName(), ", ".join(failed)))
+        self.log.info("WATCH Device: {}({}) {} characteristic(s)".format(hd.getId(), hd.getName(),
+                                                                          len(names) - len(failed)))
+        # the stream starts from the current values
+        self._on_event(hd, names, await hd.pairing.get_characteristics(list(names)))
+        return chars[0].aid, chars[0].iid
+
+    async def _until_dropped(self, hd: HAADevice, probe: tuple) -> None:
+        """Return once the session of `hd` is gone."""
+        pid = hd.getId()
+        while hd.pairing.is_connected:
+            await asyncio.sleep(WATCH_CHECK_INTERVAL)
+            if time.monotonic() - self.last_seen.get(pid, 0) < WATCH_KEEPALIVE:
+                continue
+            try:
+                await asyncio.wait_for(hd.pairing.get_characteristics([probe]), CONVERGE_PROBE_TIMEOUT)
+            except Exception as e:
+                self.log.debug("%s keepalive failed: %s: %s", hd.getName(), type(e).__name__, e)
+                return
+            self.last_seen[pid] = time.monotonic()
+
+    async def _relocate(self, pid: str) -> None:
+        """The device may have a new IP: re-run the prescan for it (at most every DAEMON_RESCAN_INTERVAL)."""
+        if time.monotonic() - self._relocated.get(pid, 0) < DAEMON_RESCAN_INTERVAL:
+            return
+        self._relocated[pid] = time.monotonic()
+        store = self.ctx.get_pairing_store()
+        name_to_ip = await _prescan_and_patch(store, self.log, self.ctx.get_inventory(), _make_scanner(self.config), pid)
+        alias = store.alias_of(pid)
+        if pid in name_to_ip and alias:
+            self.pair_devices[pid] = self.ctx.controller.load_pairing(alias, dict(store.entries()[alias]))
+            self.name_to_ip[pid] = name_to_ip[pid]
+
+    async def _reconnect(self, pid: str) -> HAADevice:
+        delay = CONVERGE_FIRST_PROBE
+        while True:
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, CONVERGE_BACKOFF_MAX)
+            pairing = self.pair_devices[pid]
+            result = await _try_connect_pairing(pid, pairing, self.name_to_ip, self.ctx, self.log, use_cache=False)
+            devices = _build_haa_devices([result], self.name_to_ip, self.ctx, self.log)
+            if devices:
+                return devices[0]
+            # a failed pairing keeps reconnecting on its own: replace it
+            with contextlib.suppress(Exception):
+                await pairing.close()
+            self.pair_devices[pid] = _reload_pairing(self.ctx.controller, pairing)
+            await self._relocate(pid)
+
+    async def _watch(self, hd: HAADevice) -> None:
+        pid = hd.getId()
+        while True:
+            try:
+                probe = await self._subscribe(hd)
+                if probe is None:
+                    return
+                await self._until_dropped(hd, probe)
+            except Exception as e:
+                self.log.debug("%s: %s: %s", hd.getName(), type(e).__name__, e)
+            self.log.warning("WATCH LOST Device: {}({})".format(pid, hd.getName()))
+            lost = time.monotonic()
+            if self.records is not None:
+                self.records.emit('disconnect', pid, name=hd.getName(), ts=round(time.time(), 3))
+            with contextlib.suppress(Exception):
+                await hd.pairing.close()
+            self.pair_devices[pid] = _reload_pairing(self.ctx.controller, hd.pairing)
+            hd = await self._reconnect(pid)
+            self.ctx.get_metrics().add('reconnect', time.monotonic() - lost, pid)
+            self.log.info("WATCH RECONNECTED Device: {}({}) after {:.1f}s".format(pid, hd.getName(),
+                                                                                   time.monotonic() - lost))
+            if self.records is not None:
+                self.records.emit('reconnect', pid, time.monotonic() - lost, name=hd.getName(), ts=round(time.time(), 3))
+
+    async def run(self, haaDevices: list) -> None:
+        """Watch every device until Ctrl+C, or for --duration seconds."""
+        watching = asyncio.gather(*(self._watch(hd) for hd in haaDevices))
+        try:
+            if self.config.duration > 0:
+                await asyncio.wait_for(watching, self.config.duration)
+            else:
+                await watching
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if self.store is not None:
+                self.store.close()
+        self.log.info("Watch ended")
+
+
+async def _write_dump(path: str, haaDevices: list, log) -> None:
+    """
+    dump --out: the accessory databases as one compact JSON object, in the _AccessoryCache format.
+    dump reads every database from its device, which stores it in the _AccessoryCache: the entries
+    come from there, a device without a c# (not cached) is read again.
+    """
+    cache = Context.get().get_accessory_cache()
+    dump = {}
+    for hd in haaDevices:
+        accessories = cache.get(hd.getId(), hd.data.config_num)
+        if accessories is None:
+            accessories = await hd.pairing.list_accessories_and_characteristics()
+        dump[hd.getId()] = {'c#': hd.data.config_num, 'name': hd.getName(), 'accessories': accessories}
+    try:
+        with open(path, 'w') as f:
+            json.dump(dump, f, separators=(',', ':'))
+    except OSError as e:
+        log.error("Cannot write {}: {}".format(path, e))
+        return
+    log.info("Dumped {} device(s) to {}".format(len(dump), path))
+
+
+def _report_ota(progress: dict, log, records: _RecordStream = None) -> None:
+    """Outcome of every update watched by _OTALogCollector.wait."""
+    metrics = Context.get().get_metrics()
+    for p in progress.values():
+        hd = p.device
+        metrics.add('ota_log', p.elapsed(), hd.getId())
+        if p.state == 'done':
+            log.info("UPDATED Device: {}({}) in {:.0f}s".format(hd.getId(), hd.getName(), p.elapsed()))
+        else:
+            log.error("UPDATE {} Device: {}({}) after {:.0f}s: {}".format(p.state.upper(), hd.getId(), hd.getName(),
+                                                                        p.elapsed(), p.last_line()))
+        if records is not None:
+            records.emit('ota', hd.getId(), p.elapsed(), None if p.state == 'done' else "Update" + p.state.capitalize(),
+                         name=hd.getName(), ip=hd.getIpAddress(), percent=p.percent, log=list(p.lines))
+
+
+async def _run_commands(config, commands: list, haaDevices: list, log, records: _RecordStream,
+                        staged_rollout: bool, to_update: list, ota: _OTALogCollector) -> list:
+    """
+    The device loop of _execute_command, then the staged rollout of the queued updates.
+    Returns [(HAADevice, command, send time)] of the reboot, wifi and direct update commands sent.
+    """
+    metrics = Context.get().get_metrics()
+    sent = []
+    for hd in haaDevices:
+        for command in commands:
+            start = time.monotonic()
+            try:
+                with metrics.phase('command:' + command, hd.getId()):
+                    fields = await _run_on_device(command, hd, config, log, staged_rollout, to_update, ota)
+            except Exception as e:
+                if records is None:
+                    raise
+                log.error("{} failed on {}({}): {}: {}".format(command, hd.getId(), hd.getName(), type(e).__name__, e))
+                records.emit('command', hd.getId(), time.monotonic() - start, e, command=command, name=hd.getName())
+                break
+            if command in CONVERGE_COMMANDS and fields.get('action', 'update') == 'update':
+                sent.append((hd, command, time.monotonic()))
+            if records is not None:
+                records.emit('command', hd.getId(), time.monotonic() - start, command=command, name=hd.getName(),
+                             ip=hd.getIpAddress(), category=homekitCategoryToString(hd.getCategory()), **fields)
+
+    if to_update:
+        if ota is None:
+            log.info("use: nc -kulnw0 45678")
+        scheduler = _RolloutScheduler(to_update, _release_version(HAADevice.getLastRelease()),
+                                      config.canary, config.wave_size, config.max_inflight,
+                                      config.max_failure_rate, config.update_timeout, log, records=records, ota=ota)
+        await scheduler.run()
+    return sent
+
+
+async def _run_scan(config, log) -> None:
+    """
+    scan: mDNS discovery of the HAA devices alongside the setup mode sweep. No HAP prescan needed.
+    The discovery stops after DISCOVERY_QUIET_SEC without announcements: an offline paired device
+    does not hold the scan for the -t timeout.
+    """
+    ctx = Context.get()
+    records = _record_stream(config)
+    async with ctx.get_controller():
+        pair_devices = ctx.load_data(ctx.get_pairing_store())
+
+        async def discover():
+            log.info("Discovering HAA devices in the network..")
+            with ctx.get_metrics().phase('mdns_discovery'):
+                await ctx.discoverHAA(doPrint=records is None, records=records)
+            online = getOnlineDevs(pair_devices, ctx.getDiscoveredHAADevices())
+            log.info("Found {}/{} devices online..".format(len(online), len(pair_devices)))
+            if records is None:
+                print()
+
+        discovery = asyncio.create_task(discover())
+        scanner = _TCPScanner(_scan_networks(config.subnet, config.interface, log),
+                              config.scan_concurrency or SETUP_SCAN_CONCURRENCY, config.scan_rate,
+                              SETUP_SCAN_TIMEOUT)
+        try:
+            with ctx.get_metrics().phase('setup_mode_scan'):
+                await ctx.discoverHAAInSetupMode(scanner, records, after=discovery)
+            await discovery
+        finally:
+            discovery.cancel()
+
+
+async def _run_device_command(config, log) -> None:
+    """Runs all device-related commands inside a single controller context."""
+    ctx = Context.get()
+
+    if config.command == 'scan':
+        await _run_scan(config, log)
+        return
+
+    # Resolve the latest release in the background while the network is being scanned
+    release_task = None
+    if set(_pipeline_commands(config)) & set(RELEASE_COMMANDS):
+        release_task = asyncio.create_task(asyncio.to_thread(HAADevice.getLastRelease))
+
+    store = ctx.get_pairing_store()
+    selected = ALL_DEVICES_WILDCARD if config.command == 'serve' else config.id
+    if not store.select(selected):
+        log.error('"{}" is not a known paired device'.format(config.id))
+        sys.exit(-1)
+
+    # Pre-scan BEFORE aiohomekit loads the pairings: patch the correct IPs into the
+    # pairing store so aiohomekit connects to the right IP, not a stale one.
+    inventory = None if config.full_scan else ctx.get_inventory()
+    name_to_ip = await _prescan_and_patch(store, log, inventory, _make_scanner(config), selected)
+    async with ctx.get_controller():
+        pair_devices = ctx.load_data(store, selected)
+
+        if config.command == 'serve':
+            await _DeviceServer(config, pair_devices, name_to_ip, log).run()
+            return
+
+        candidates = {
+            k: v for k, v in pair_devices.items()
+            if config.id == ALL_DEVICES_WILDCARD or k == config.id
+        }
+        # mDNS discovery in the background: the c# of each device validates its cached accessory database
+        ctx.discoveryTask = asyncio.create_task(ctx.discoverHAA(expected_ids=candidates.keys()))
+
+        records = _record_stream(config)
+        # dump shows the current values: always read the database from the device
+        results = await _connect_candidates(candidates, name_to_ip, ctx, log, config.concurrency, records,
+                                            use_cache='dump' not in _pipeline_commands(config))
+        try:
+            if release_task is not None:
+                log.info("Last release: {}".format(await release_task))
+
+            haaDevices = _build_haa_devices(results, name_to_ip, ctx, log)
+            if config.command == 'watch':
+                await _CharWatcher(ctx, config, pair_devices, name_to_ip, log, records).run(haaDevices)
+                return
+            await _execute_command(config, haaDevices, log, records)
+        finally:
+            ctx.discoveryTask.cancel()
+            ctx.get_accessory_cache().save()  # with the databases confirmed by a late mDNS resolution
+
+
+# ---------------------------------------------------------------------------
+# Resident daemon ("serve") and its client
+# ---------------------------------------------------------------------------
+
+def _reload_pairing(controller, pairing):
+    """Replace a closed aiohomekit pairing (which cannot reconnect) with a fresh one."""
+    for alias, p in list(controller.aliases.items()):
+        if p is pairing:
+            return controller.load_pairing(alias, dict(pairing.pairing_data))
+    return pairing
+
+
+class _DeviceServer:
+    """
+    Resident daemon: keeps the controller, the zeroconf browser and the verified HAP
+    sessions open and runs device commands received over a Unix socket (one JSON line
+    {"argv": [...]}) or local HTTP (GET /<command>?id=<pairId>). Requests are served one
+    at a time; sessions unused for --idle-timeout seconds are closed.
+    """
+    def __init__(self, config, pair_devices: dict, name_to_ip: dict, log):
+        self.config = config
+        self.pair_devices = pair_devices
+        self.name_to_ip = name_to_ip
+        self.log = log
+        self.sessions = {}  # pairing id -> [HAADevice, last used]
+        self._lock = asyncio.Lock()
+        self._last_scan = time.monotonic()
+        self._resolving = set()
+
+    def _on_mdns(self, type_: str, name: str) -> None:
+        """Resolve every announcement: the current c# of a device validates its cached accessory database."""
+        if name in self._resolving:
+            return
+        self._resolving.add(name)
+        task = asyncio.create_task(Context.get()._resolveHAP(type_, name))
+        task.add_done_callback(lambda t: self._resolving.discard(name))
+
+    async def _relocate(self, missing: set) -> None:
+        """Re-run the prescan for devices without a known location (at most every DAEMON_RESCAN_INTERVAL)."""
+        if time.monotonic() - self._last_scan < DAEMON_RESCAN_INTERVAL:
+            return
+        self._last_scan = time.monotonic()
+        ctx = Context.get()
+        store = ctx.get_pairing_store()
+        for pid in missing:
+            name_to_ip = await _prescan_and_patch(store, self.log, ctx.get_inventory(), _make_scanner(self.config), pid)
+            alias = store.alias_of(pid)
+            if pid in name_to_ip and alias:
+                self.pair_devices[pid] = ctx.controller.load_pairing(alias, dict(store.entries()[alias]))
+                self.name_to_ip[pid] = name_to_ip[pid]
+
+    async def _devices(self, req, records: _RecordStream = None) -> list:
+        ctx = Context.get()
+        wanted = [k for k in self.pair_devices if req.id == ALL_DEVICES_WILDCARD or k == req.id]
+        missing = {k for k in wanted if k not in self.name_to_ip}
+        if missing:
+            await self._relocate(missing)
+
+        cold = {k: self.pair_devices[k] for k in wanted if k not in self.sessions}
+        if cold:
+            results = await _connect_candidates(cold, self.name_to_ip, ctx, self.log, req.concurrency, records,
+                                                use_cache='dump' not in _pipeline_commands(req))
+            for hd in _build_haa_devices(results, self.name_to_ip, ctx, self.log):
+                self.sessions[hd.getId()] = [hd, 0]
+
+        devices = []
+        now = time.monotonic()
+        for k in wanted:
+            if k in self.sessions:
+                self.sessions[k][1] = now
+                devices.append(self.sessions[k][0])
+        return devices
+
+    async def _evict(self, pid: str) -> None:
+        entry = self.sessions.pop(pid, None)
+        if entry is None:
+            return
+        pairing = entry[0].pairing
+        with contextlib.suppress(Exception):
+            await pairing.close()
+        self.pair_devices[pid] = _reload_pairing(Context.get().controller, pairing)
+
+    async def _evict_idle(self) -> None:
+        idle_timeout = self.config.idle_timeout
+        while True:
+            await asyncio.sleep(max(1, min(60, idle_timeout / 2)))
+            now = time.monotonic()
+            async with self._lock:
+                for pid, (hd, last_used) in list(self.sessions.items()):
+                    if now - last_used > idle_timeout:
+                        self.log.debug("serve: closing idle session %s", pid)
+                        await self._evict(pid)
+
+    async def handle(self, argv: list) -> tuple:
+        """Run one request; returns (ok, text output)."""
+        buf = io.StringIO()
+        handler = logging.StreamHandler(buf)
+        handler.setFormatter(logging.Formatter('%(asctime)s,%(levelname)s %(message)s', datefmt='%H:%M:%S'))
+        ok = False
+        async with self._lock:
+            root = logging.getLogger()
+            root.addHandler(handler)
+            try:
+                with contextlib.redirect_stdout(buf), contextlib.redirect_stderr(buf):
+                    req = parser.parse_args(argv)
+                    records = _record_stream(req)
+                    if records is not None:
+                        root.removeHandler(handler)  # the reply carries the records only
+                    if req.id != ALL_DEVICES_WILDCARD:
+                        req.id = req.id.lower()
+                    if req.command not in DAEMON_COMMANDS:
+                        self.log.error('"{}" is not supported by the daemon'.format(req.command))
+                    elif req.command == 'pipeline' and _check_pipeline(_pipeline_commands(req)):
+                        self.log.error(_check_pipeline(_pipeline_commands(req)))
+                    elif req.id != ALL_DEVICES_WILDCARD and req.id not in self.pair_devices:
+                        self.log.error('"{}" is not a known paired device'.format(req.id))
+                    else:
+                        if req.command == 'update':
+                            # the daemon lives for days: look for a new release on every update
+                            Context.get().releaseResolver = None
+                        devices = await self._devices(req, records)
+                        await _execute_command(req, devices, self.log, records)
+                        if set(_pipeline_commands(req)) & set(SESSION_ENDING_COMMANDS):
+                            # the device is going to drop the session
+                            for hd in devices:
+                                await self._evict(hd.getId())
+                        ok = True
+            except SystemExit:
                 pass
+            except Exception as e:
+                self.log.error("request failed: %s: %s", type(e).__name__, e)
+            finally:
+                root.removeHandler(handler)
+        return ok, buf.getvalue()
+
+    async def _on_unix_client(self, reader, writer) -> None:
+        try:
+            request = json.loads(await reader.readline())
+            _, output = await self.handle([str(a) for a in request.get('argv', [])])
+            writer.write(output.encode())
+            await writer.drain()
+        except Exception as e:
+            self.log.debug("serve: bad request: %s", e)
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _http_refusal(method: str, headers: dict, command: str, params: list):
+        """
+        The error status for a request web pages could forge, None when it may run.
+        Browsers send Origin on cross-origin requests and the attacker's host name in Host after
+        DNS rebinding; commands that change devices must be POSTed, which a link or image cannot do.
+        """
+        if method not in ('GET', 'POST'):
+            return "405 Method Not Allowed"
+        if 'origin' in headers:
+            return "403 Forbidden"
+        host = headers.get('host', '')
+        hostname = urllib.parse.urlsplit('//' + host).hostname if host else None
+        if hostname not in DAEMON_HTTP_HOSTS:
+            return "403 Forbidden"
+        commands = [c.strip() for c in params[0].split(',')] if command == 'pipeline' and params else [command]
+        if method != 'POST' and set(commands) & set(DAEMON_HTTP_POST_COMMANDS):
+            return "405 Method Not Allowed"
+        return None
+
+    async def _on_http_client(self, reader, writer) -> None:
+        try:
+            request_line = (await reader.readline()).decode('latin-1')
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            if headers.get('content-length', '').isdigit():
+                await reader.readexactly(int(headers['content-length']))  # the body is not used
+            parts = request_line.split(' ')
+            method, target = (parts[0], parts[1]) if len(parts) >= 3 else ('', '/')
+            url = urllib.parse.urlsplit(target)
+            query = urllib.parse.parse_qs(url.query)
+            command, params = url.path.strip('/'), query.get('param', [])
+            status = self._http_refusal(method, headers, command, params)
+            if status is None:
+                ok, output = await self.handle(['-i', query.get('id', [ALL_DEVICES_WILDCARD])[0], command] + params)
+                status = "200 OK" if ok else "400 Bad Request"
+            else:
+                self.log.warning("serve: refused %s %s: %s", method, url.path, status)
+                output = status + "\n"
+            body = output.encode()
+            writer.write("HTTP/1.1 {}\r\nContent-Type: text/plain; charset=utf-8\r\n"
+                         "Content-Length: {}\r\nConnection: close\r\n\r\n".format(status, len(body)).encode() + body)
+            await writer.drain()
+        except Exception as e:
+            self.log.debug("serve: bad http request: %s", e)
+        finally:
+            writer.close()
+
+    async def run(self) -> None:
+        socket_path = self.config.socket or os.path.join(Context.get().get_cache_dir(), DAEMON_SOCKET_FILE)
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(socket_path)
+        servers = [await asyncio.start_unix_server(self._on_unix_client, path=socket_path)]
+        os.chmod(socket_path, 0o600)
+        self.log.info("serve: listening on {}".format(socket_path))
+        if self.config.http:
+            servers.append(await asyncio.start_server(self._on_http_client, '127.0.0.1', self.config.http))
+            self.log.info("serve: listening on http://127.0.0.1:{}".format(self.config.http))
+
+        ctx = Context.get()
+        loop = asyncio.get_running_loop()
+        on_change = lambda type_, name: loop.call_soon_threadsafe(self._on_mdns, type_, name)
+        ctx._hap_listener.add_listener(on_change)
+        # the devices announced before the daemon started
+        ctx.discoveryTask = asyncio.create_task(ctx.discoverHAA(expected_ids=self.pair_devices.keys()))
+        evictor = asyncio.create_task(self._evict_idle())
+        try:
+            await asyncio.gather(*(srv.serve_forever() for srv in servers))
+        finally:
+            evictor.cancel()
+            ctx.discoveryTask.cancel()
+            ctx._hap_listener.remove_listener(on_change)
+            ctx.get_accessory_cache().save()
+            for pid in list(self.sessions):
+                await self._evict(pid)
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(socket_path)
+
+
+def _report_metrics(config, log) -> None:
+    """--timings table on stderr (stdout may carry --output jsonl) and --metrics-file report."""
+    metrics = Context.get().get_metrics()
+    if config.timings:
+        print(metrics.table(), file=sys.stderr)
+    if config.metrics_file:
+        try:
+            metrics.write(config.metrics_file, config.command)
+        except OSError as e:
+            log.error("Cannot write metrics to {}: {}".format(config.metrics_file, e))
 
 
 async def main(argv: list[str] | None = None) -> None:
@@ -1183,10 +3932,33 @@ async def main(argv: list[str] | None = None) -> None:
             print(f"Custom command for version {config.version}: {command}")
         elif config.tag:
             print(f"🔍 Looking up CUSTOM_HAA_COMMAND for tag: {config.tag}")
-            get_custom_haa_command(config.tag, config.debug)
+            command = get_custom_haa_command(config.tag, config.debug)
+            print(f"✅ CUSTOM_HAA_COMMAND: \"{command}\"" if command else "⚠️ CUSTOM_HAA_COMMAND not found.")
         else:
             print("🔍 Looking up CUSTOM_HAA_COMMAND for latest master")
-            get_custom_haa_command("master", config.debug)
+            command = get_custom_haa_command("master", config.debug)
+            print(f"✅ CUSTOM_HAA_COMMAND: \"{command}\"" if command else "⚠️ CUSTOM_HAA_COMMAND not found.")
+        return
+
+    if config.command == 'pipeline':
+        error = _check_pipeline(_pipeline_commands(config))
+        if error:
+            log.error(error)
+            sys.exit(1)
+
+    if config.command == 'history':
+        _show_history(config, log, _record_stream(config))
+        return
+
+    if config.command == 'set':
+        try:
+            _parse_char_writes(config.assignments)
+        except ValueError as e:
+            log.error(e)
+            sys.exit(1)
+
+    if config.daemon and config.command in DAEMON_COMMANDS:
+        _daemon_request(config.daemon, _strip_option(sys.argv[1:], '--daemon'))
         return
 
     # For device commands, -f is required
@@ -1194,7 +3966,10 @@ async def main(argv: list[str] | None = None) -> None:
         log.error("File with pairing data is required for this command")
         sys.exit(1)
 
-    await _run_device_command(config, log)
+    try:
+        await _run_device_command(config, log)
+    finally:
+        _report_metrics(config, log)
 
 
 def sync_main():
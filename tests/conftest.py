@@ -0,0 +1,57 @@
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+CLI = os.path.join(REPO, "haa_manager_cli.py")
+FLEET = os.path.join(REPO, "emulator", "temp-sensor", "haa_fleet.py")
+FLEET_BASE_PORT = 22000  # away from the default 21000 of a fleet started by hand
+FLEET_START_TIMEOUT = 120
+sys.path.insert(0, REPO)  # import haa_manager_cli
+
+
+def start_fleet(fleet_dir: str, size: int, base_port: int = FLEET_BASE_PORT) -> subprocess.Popen:
+    """Start `size` emulated devices writing their pairing file and inventory into `fleet_dir`; wait until advertised."""
+    log_path = os.path.join(fleet_dir, "fleet.log")
+    with open(log_path, 'w') as log_file:
+        proc = subprocess.Popen([sys.executable, FLEET, '-n', str(size), '--dir', fleet_dir,
+                                 '--base-port', str(base_port)],
+                                cwd=os.path.dirname(FLEET), stdout=log_file, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + FLEET_START_TIMEOUT
+    while True:
+        with open(log_path) as f:
+            if "READY" in f.read():
+                return proc
+        if proc.poll() is not None or time.monotonic() > deadline:
+            stop_fleet(proc)
+            with open(log_path) as f:
+                pytest.skip("emulated fleet did not start:\n" + f.read()[-2000:])
+        time.sleep(0.1)
+
+
+def stop_fleet(proc: subprocess.Popen) -> None:
+    proc.send_signal(signal.SIGTERM)
+    try:
+        proc.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+@pytest.fixture(scope="session")
+def fleet(tmp_path_factory):
+    """Directory of a running 3-device fleet: pairing.json and inventory.json, usable as --cache-dir."""
+    pytest.importorskip("pyhap")
+    fleet_dir = str(tmp_path_factory.mktemp("fleet"))
+    proc = start_fleet(fleet_dir, 3)
+    yield fleet_dir
+    stop_fleet(proc)
+
+
+def run_cli(fleet_dir: str, *args, cache_dir: str = None, timeout: float = 120) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, CLI, '--cache-dir', cache_dir or fleet_dir,
+                           '-f', os.path.join(fleet_dir, "pairing.json")] + list(args),
+                          capture_output=True, text=True, timeout=timeout, cwd=REPO)
@@ -0,0 +1,53 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import pytest
+
+from conftest import CLI, REPO, run_cli
+import haa_manager_cli as cli
+
+FROM_CACHE = "accessory database from cache"
+ACCESSORIES = [{'aid': 1, 'services': []}]
+
+
+def test_entry_waits_for_its_config_number(tmp_path):
+    cache = cli._AccessoryCache(str(tmp_path / "accessories.json"))
+    cache.put('0A:AA:00:00:00:01', None, ACCESSORIES)
+    assert not cache.has('0a:aa:00:00:00:01')
+    cache.confirm('0a:aa:00:00:00:01', 7)
+    cache.save()
+    cache = cli._AccessoryCache(str(tmp_path / "accessories.json"))
+    assert cache.get('0a:aa:00:00:00:01', 7) == ACCESSORIES
+    assert cache.get('0a:aa:00:00:00:01', 8) is None
+
+
+def test_serve_fills_the_cache(fleet, tmp_path):
+    # the daemon learns the c# of the devices from its own mDNS listener
+    cache_dir = str(tmp_path / "cache")
+    os.makedirs(cache_dir)
+    shutil.copy(os.path.join(fleet, "inventory.json"), cache_dir)
+    sock = str(tmp_path / "haa.sock")
+    pairing = os.path.join(fleet, "pairing.json")
+    proc = subprocess.Popen([sys.executable, CLI, '--offline', '--cache-dir', cache_dir, '-f', pairing,
+                             'serve', '--socket', sock], cwd=REPO, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 60
+        while not os.path.exists(sock):
+            if proc.poll() is not None or time.monotonic() > deadline:
+                pytest.fail("serve did not start")
+            time.sleep(0.2)
+        time.sleep(1)  # the initial discovery
+        subprocess.run([sys.executable, CLI, '--cache-dir', cache_dir, '-f', pairing, '--daemon', sock,
+                        '-i', '*', 'get', 'CurrentTemperature'], capture_output=True, timeout=120, cwd=REPO)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+    with open(os.path.join(cache_dir, "accessories.json")) as f:
+        entries = json.load(f)
+    assert len(entries) == 3 and all(e['c#'] is not None for e in entries.values())
+    out = run_cli(fleet, '--offline', '-d', '-i', '*', 'get', 'CurrentTemperature', cache_dir=cache_dir)
+    assert out.stderr.count(FROM_CACHE) == 3
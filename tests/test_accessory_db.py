@@ -0,0 +1,77 @@
+import json
+import os
+
+import pytest
+from aiohomekit.model import Accessories
+
+from conftest import run_cli
+import haa_manager_cli as cli
+
+
+@pytest.fixture(scope="module")
+def databases(fleet, tmp_path_factory):
+    """The accessory JSON of every emulated device, as read by dump."""
+    path = str(tmp_path_factory.mktemp("dump") / "dump.json")
+    proc = run_cli(fleet, '--offline', 'dump', '--out', path)
+    assert proc.returncode == 0, proc.stderr
+    with open(path) as f:
+        dump = json.load(f)
+    assert len(dump) == 3
+    return [entry['accessories'] for entry in dump.values()]
+
+
+def _model_chars(accessories):
+    """(aid, service, characteristic) of aiohomekit's model, in database order."""
+    return [(acc.aid, srv, ch) for acc in accessories for srv in acc.services for ch in srv.characteristics]
+
+
+def test_characteristics_match_aiohomekit(databases):
+    for data in databases:
+        db = cli._AccessoryDB(data)
+        accessories = Accessories.from_list(data)
+        assert db.aids == [acc.aid for acc in accessories]
+        assert [(s.aid, s.iid, s.type) for s in db.services] == \
+            [(acc.aid, srv.iid, srv.type) for acc in accessories for srv in acc.services]
+        ours = [ch for srv in db.services for ch in srv.characteristics]
+        model = _model_chars(accessories)
+        assert len(ours) == len(model)
+        for ch, (aid, srv, expected) in zip(ours, model):
+            assert accessories.aid(aid).characteristics.iid(ch.iid) is expected
+            assert (ch.aid, ch.iid, ch.type) == (aid, expected.iid, expected.type)
+            assert (ch.format, list(ch.perms)) == (expected.format, expected.perms)
+            # a characteristic without a value (write only) reads as '' like the dict lookups it replaced
+            assert ch.value == ('' if expected.value is None else expected.value)
+
+
+def test_lookup_by_type_matches_aiohomekit(databases):
+    for data in databases:
+        db = cli._AccessoryDB(data)
+        accessories = Accessories.from_list(data)
+        for aid, srv, expected in _model_chars(accessories):
+            first = next(ch for a, s, ch in _model_chars(accessories) if s.type == srv.type and ch.type == expected.type)
+            found = db.find(srv.type.lower(), expected.type.lower())
+            assert (found.aid, found.iid) == (first.service.accessory.aid, first.iid)
+        assert db.find(cli.HAA_CUSTOM_SERVICE, '00000000-0000-1000-8000-0026BB765291') is None
+
+
+def test_device_fields_match_aiohomekit(databases):
+    for data in databases:
+        hd = cli.HAADevice(None, data, None)
+        info = Accessories.from_list(data).aid(1)
+        # SERVICE_INFO_CHAR_MANUF is the Model characteristic, where HAA names itself
+        assert (hd.name, hd.fwversion, hd.manufacturer) == (info.name, info.firmware_revision, info.model)
+        setup = info.services.first(service_type=cli.HAA_CUSTOM_SERVICE)[cli.HAA_CUSTOM_CONFIG_CHAR]
+        assert hd.setupChar == [1, setup.iid]
+
+
+def test_get_and_dump_see_the_values_of_aiohomekit(databases):
+    for data in databases:
+        hd = cli.HAADevice(None, data, None)
+        accessories = Accessories.from_list(data)
+        temperature = accessories.aid(1).services.first(service_type='8A')['11']
+        assert [(ch.aid, ch.iid, ch.value) for ch in cli._CharSelector('CurrentTemperature').select(hd.data)] == \
+            [(1, temperature.iid, temperature.value)]
+        dumped = [(s['aid'], s['iid'], c['iid'], c['type'], c['perms'], c['value'])
+                  for s in hd.homekitData() for c in s['characteristics']]
+        assert dumped == [(aid, srv.iid, ch.iid, ch.type, ch.perms, '' if ch.value is None else ch.value)
+                          for aid, srv, ch in _model_chars(accessories)]
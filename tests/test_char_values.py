@@ -0,0 +1,31 @@
+import pytest
+
+import haa_manager_cli as cli
+
+
+def _char(format_):
+    return cli._Characteristic(1, 10, 'Brightness', 0, format_, ['pr', 'pw'], None)
+
+
+@pytest.mark.parametrize("format_, text, value", [
+    ('uint8', '08', 8),
+    ('uint8', '09', 9),
+    ('int', '-5', -5),
+    ('float', '21.5', 21.5),
+    ('float', '08', 8.0),
+    ('bool', 'on', True),
+    ('string', '0x10', '0x10'),
+])
+def test_char_value(format_, text, value):
+    assert cli._char_value(_char(format_), text) == value
+
+
+@pytest.mark.parametrize("format_, text", [
+    ('uint8', '0x10'),
+    ('uint8', '0o7'),
+    ('uint8', '1.5'),
+    ('bool', 'maybe'),
+])
+def test_char_value_rejected(format_, text):
+    with pytest.raises(ValueError):
+        cli._char_value(_char(format_), text)
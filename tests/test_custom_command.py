@@ -0,0 +1,44 @@
+import time
+
+import pytest
+
+import haa_manager_cli as cli
+
+VERSION = '12.0.1'
+
+
+@pytest.fixture
+def github(monkeypatch, tmp_path):
+    """The header files published on GitHub: tag -> setup word."""
+    published = {'master': 'master-word'}
+    cache = cli._CustomCommandCache(str(tmp_path / "custom_commands.json"))
+    monkeypatch.setattr(cli.Context.get(), 'customCommandCache', cache)
+    monkeypatch.setattr(cli.HAADevice, '_customCommandMemo', {})
+    monkeypatch.setattr(cli, 'get_custom_haa_command', lambda tag, verbose: published.get(tag))
+    return published
+
+
+def _age(cache, seconds):
+    for entry in cache._load().values():
+        entry['ts'] -= seconds
+
+
+def test_master_fallback_expires_early(github):
+    cache = cli.Context.get().get_custom_command_cache()
+    assert cli.HAADevice.getCustomCommand(VERSION) == 'master-word'
+    github['HAA_' + VERSION] = 'tag-word'
+    _age(cache, cli.CUSTOM_COMMAND_FALLBACK_TTL + 1)
+    cli.HAADevice._customCommandMemo.clear()
+    assert cli.HAADevice.getCustomCommand(VERSION) == 'tag-word'
+    _age(cache, cli.CUSTOM_COMMAND_FALLBACK_TTL + 1)  # a tag entry lasts CUSTOM_COMMAND_CACHE_TTL
+    assert cache.get(VERSION) == 'tag-word'
+
+
+def test_memo_expires_with_the_cache_entry(github, monkeypatch):
+    assert cli.HAADevice.getCustomCommand(VERSION) == 'master-word'
+    github['HAA_' + VERSION] = 'tag-word'
+    assert cli.HAADevice.getCustomCommand(VERSION) == 'master-word'  # memo
+    now = time.monotonic()
+    monkeypatch.setattr(cli.time, 'monotonic', lambda: now + cli.CUSTOM_COMMAND_FALLBACK_TTL + 1)
+    _age(cli.Context.get().get_custom_command_cache(), cli.CUSTOM_COMMAND_FALLBACK_TTL + 1)
+    assert cli.HAADevice.getCustomCommand(VERSION) == 'tag-word'
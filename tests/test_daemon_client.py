@@ -0,0 +1,53 @@
+import json
+import socket
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from conftest import CLI, REPO
+import haa_manager_cli as cli
+
+
+def test_every_subcommand_is_known_to_the_client():
+    commands = cli.DAEMON_COMMANDS + cli.LOCAL_COMMANDS
+    assert sorted(commands) == sorted(cli.subparsers.choices)
+
+
+@pytest.mark.parametrize("argv", [
+    ['-f', 'p.json', 'version'],
+    ['--daemon', 's.sock', 'scan'],
+    ['--daemon', 's.sock', '-h', 'version'],
+])
+def test_not_a_daemon_request(argv):
+    assert cli._daemon_client(argv) is None
+
+
+@pytest.fixture
+def fake_daemon(tmp_path):
+    """A Unix socket answering every request with the argv it received."""
+    path = str(tmp_path / "haa.sock")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+
+    def answer():
+        conn, _ = server.accept()
+        with conn:
+            request = json.loads(conn.makefile().readline())
+            conn.sendall((" ".join(request['argv']) + "\n").encode())
+
+    thread = threading.Thread(target=answer, daemon=True)
+    thread.start()
+    yield path
+    server.close()
+
+
+def test_client_skips_the_heavy_imports(fake_daemon):
+    out = subprocess.run([sys.executable, '-X', 'importtime', CLI, '-f', 'p.json', '--daemon', fake_daemon,
+                          '-i', '*', 'get', 'On'], capture_output=True, text=True, timeout=60, cwd=REPO)
+    assert out.returncode == 0
+    assert out.stdout == "-f p.json -i * get On\n"
+    imported = {line.split('|')[-1].strip() for line in out.stderr.splitlines() if line.startswith('import time:')}
+    assert not imported & {'asyncio', 'configargparse', 'aiohomekit', 'zeroconf', 'requests'}
@@ -0,0 +1,62 @@
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from conftest import CLI, REPO
+import haa_manager_cli as cli
+
+HTTP_PORT = 22980
+LOCAL = {'host': '127.0.0.1:8080'}
+
+
+@pytest.mark.parametrize("method, headers, command, params, refused", [
+    ('GET', LOCAL, 'version', [], None),
+    ('GET', {'host': 'localhost'}, 'get', ['On'], None),
+    ('POST', LOCAL, 'reboot', [], None),
+    ('GET', LOCAL, 'reboot', [], "405 Method Not Allowed"),
+    ('GET', LOCAL, 'update', [], "405 Method Not Allowed"),
+    ('GET', LOCAL, 'set', ['On=false'], "405 Method Not Allowed"),
+    ('GET', LOCAL, 'pipeline', ['version,reboot'], "405 Method Not Allowed"),
+    ('GET', LOCAL, 'pipeline', ['version,dump'], None),
+    ('DELETE', LOCAL, 'version', [], "405 Method Not Allowed"),
+    ('GET', dict(LOCAL, origin='http://evil.example'), 'version', [], "403 Forbidden"),
+    ('POST', dict(LOCAL, origin='http://127.0.0.1:8080'), 'reboot', [], "403 Forbidden"),
+    ('GET', {'host': 'evil.example:8080'}, 'version', [], "403 Forbidden"),
+    ('GET', {}, 'version', [], "403 Forbidden"),
+])
+def test_http_refusal(method, headers, command, params, refused):
+    assert cli._DeviceServer._http_refusal(method, headers, command, params) == refused
+
+
+def _request(raw: bytes) -> str:
+    with socket.create_connection(('127.0.0.1', HTTP_PORT), timeout=60) as s:
+        s.sendall(raw)
+        return s.makefile('rb').readline().decode()
+
+
+def test_serve_refuses_foreign_origin(fleet, tmp_path):
+    proc = subprocess.Popen([sys.executable, CLI, '--offline', '--cache-dir', fleet, '-f',
+                             os.path.join(fleet, "pairing.json"), 'serve', '--socket', str(tmp_path / "haa.sock"),
+                             '--http', str(HTTP_PORT)], cwd=REPO, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', HTTP_PORT), timeout=1).close()
+                break
+            except OSError:
+                if proc.poll() is not None or time.monotonic() > deadline:
+                    pytest.fail("serve did not start")
+                time.sleep(0.2)
+        host = b"Host: 127.0.0.1:%d\r\n" % HTTP_PORT
+        assert " 403 " in _request(b"GET /version HTTP/1.1\r\n" + host + b"Origin: http://evil.example\r\n\r\n")
+        assert " 403 " in _request(b"GET /version HTTP/1.1\r\nHost: evil.example\r\n\r\n")
+        assert " 405 " in _request(b"GET /reboot HTTP/1.1\r\n" + host + b"\r\n")
+        assert " 200 " in _request(b"GET /version HTTP/1.1\r\n" + host + b"\r\n")
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
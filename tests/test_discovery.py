@@ -0,0 +1,36 @@
+import json
+import os
+import subprocess
+import sys
+
+from conftest import REPO
+
+TIMEOUT_SEC = 30
+
+# a fresh process per discovery: Context is a singleton
+DISCOVER = """
+import asyncio, json, sys, time
+import haa_manager_cli as cli
+
+async def main(fleet_dir, pairing_file, timeout):
+    cli.parseArguments(cli.parser.parse_args(['--offline', '--cache-dir', fleet_dir, '-f', pairing_file,
+                                              '-t', timeout, 'version']))
+    ctx = cli.Context.get()
+    store = ctx.get_pairing_store()
+    expected = [store.pairing_id(data) for data in store.entries().values()] + ['0a:aa:ff:ff:ff:ff']
+    async with ctx.get_controller():
+        start = time.monotonic()
+        await ctx.discoverHAA(expected_ids=expected)
+        found = [d for d in ctx.getDiscoveredHAADevices() if d.description.id in expected]
+        print(json.dumps({'elapsed': time.monotonic() - start, 'found': len(found)}))
+
+asyncio.run(main(*sys.argv[1:]))
+"""
+
+
+def test_discovery_does_not_wait_for_an_offline_device(fleet):
+    out = subprocess.run([sys.executable, '-c', DISCOVER, fleet, os.path.join(fleet, "pairing.json"), str(TIMEOUT_SEC)],
+                         capture_output=True, text=True, timeout=TIMEOUT_SEC * 2, cwd=REPO)
+    result = json.loads(out.stdout.splitlines()[-1])
+    assert result['found'] == 3
+    assert result['elapsed'] < TIMEOUT_SEC / 3
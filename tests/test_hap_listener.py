@@ -0,0 +1,21 @@
+import haa_manager_cli as cli
+
+HAP = "_hap._tcp.local."
+
+
+def test_overlapping_waiters_all_notified():
+    listener = cli._RawHAPListener()
+    discovery, watcher = [], []
+    on_discovery = lambda type_, name: discovery.append(name)
+    listener.add_listener(on_discovery)
+    listener.add_listener(lambda type_, name: watcher.append(name))
+    listener.add_service(None, HAP, "A." + HAP)
+    listener.remove_listener(on_discovery)  # discovery ends, the watcher keeps listening
+    listener.update_service(None, HAP, "B." + HAP)
+    assert discovery == ["A." + HAP]
+    assert watcher == ["A." + HAP, "B." + HAP]
+    assert listener.pending == [(HAP, "A." + HAP), (HAP, "B." + HAP)]
+
+
+def test_remove_unknown_listener():
+    cli._RawHAPListener().remove_listener(print)
@@ -0,0 +1,46 @@
+import os
+
+import haa_manager_cli as cli
+
+PID = '0a:aa:00:00:00:01'
+DAY = 86400
+
+
+def _segments(store):
+    series_dir = store._series_dir(PID, 1, 9)
+    return sorted(os.listdir(series_dir))
+
+
+def test_stale_series_is_downsampled_then_deleted(tmp_path):
+    store = cli._SeriesStore(str(tmp_path))
+    day = 20000
+    start = day * DAY + 3600
+    store.describe(PID, 'HAA-000001', 1, 9, '00000011-0000-1000-8000-0026BB765291', 'CurrentTemperature')
+    for n, value in enumerate((20.0, 22.0, 24.0)):
+        store.append(PID, 1, 9, start + n, value)
+    store.close()  # the series is never appended to again
+    assert _segments(store) == ["{}.raw".format(day)]
+
+    store = cli._SeriesStore(str(tmp_path))
+    store.compact(now=(day + cli.HISTORY_RAW_DAYS) * DAY)
+    assert _segments(store) == ["{}.agg".format(day)]
+    [(_, agg)] = store.query(PID, 1, 9, start, start + DAY)
+    assert (agg.min, agg.max, agg.mean, agg.count) == (20.0, 24.0, 22.0, 3)
+
+    store.compact(now=(day + cli.HISTORY_DAYS) * DAY)
+    assert _segments(store) == []
+
+
+def test_compact_runs_once_a_day(tmp_path):
+    store = cli._SeriesStore(str(tmp_path))
+    day = 20000
+    store.append(PID, 1, 9, day * DAY, 1.0)
+    store.close()
+    store.compact(now=(day + cli.HISTORY_RAW_DAYS) * DAY)
+    assert _segments(store) == ["{}.agg".format(day)]
+    store.append(PID, 1, 9, (day + 1) * DAY, 1.0)
+    store.close()
+    store.compact(now=(day + cli.HISTORY_RAW_DAYS + 1) * DAY - 1)  # same day: nothing to do
+    assert _segments(store) == ["{}.agg".format(day), "{}.raw".format(day + 1)]
+    store.compact(now=(day + cli.HISTORY_RAW_DAYS + 1) * DAY)
+    assert _segments(store) == ["{}.agg".format(day), "{}.agg".format(day + 1)]
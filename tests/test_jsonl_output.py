@@ -0,0 +1,44 @@
+import json
+import os
+import shutil
+
+from conftest import run_cli
+
+
+def _assert_json_lines(stdout: str) -> list:
+    records = []
+    for line in stdout.splitlines():
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            raise AssertionError("stdout line is not JSON: {!r}".format(line))
+    return records
+
+
+def test_reboot_jsonl_with_cold_header_cache(fleet, tmp_path):
+    # a fresh cache dir: no setup word cached, the header file is looked up on GitHub (and may fail)
+    cache_dir = str(tmp_path)
+    shutil.copy(os.path.join(fleet, "inventory.json"), cache_dir)
+    out = run_cli(fleet, '--output', 'jsonl', '-i', '*', 'reboot', cache_dir=cache_dir)
+    records = _assert_json_lines(out.stdout)
+    assert {r['event'] for r in records} >= {'connect', 'command'}
+
+
+def test_get_jsonl(fleet):
+    out = run_cli(fleet, '--offline', '--output', 'jsonl', '-i', '*', 'get', 'CurrentTemperature')
+    records = _assert_json_lines(out.stdout)
+    assert len([r for r in records if r['event'] == 'get']) == 3
+
+
+def test_get_jsonl_no_matching_characteristic(fleet):
+    out = run_cli(fleet, '--offline', '--output', 'jsonl', '-i', '*', 'get', 'Brightness')
+    records = [r for r in _assert_json_lines(out.stdout) if r['event'] == 'get']
+    assert len(records) == 3
+    assert all(not r['ok'] and r['error'] == "no matching characteristic" for r in records)
+
+
+def test_set_jsonl_no_matching_characteristic(fleet):
+    out = run_cli(fleet, '--offline', '--output', 'jsonl', '-i', '*', 'set', 'Brightness=50')
+    records = [r for r in _assert_json_lines(out.stdout) if r['event'] == 'set']
+    assert len(records) == 3
+    assert all(not r['ok'] and r['error'] == "no matching characteristic" for r in records)
@@ -0,0 +1,11 @@
+from conftest import run_cli
+
+
+def test_get_does_not_look_up_the_release(fleet):
+    out = run_cli(fleet, '-d', '-i', '*', 'get', 'CurrentTemperature')
+    assert 'release' not in out.stderr.lower()
+
+
+def test_version_looks_up_the_release(fleet):
+    out = run_cli(fleet, '-i', '*', 'version')
+    assert 'Last release' in out.stderr
@@ -0,0 +1,49 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from conftest import CLI, REPO
+import haa_manager_cli as cli
+
+TIMEOUT_SEC = 30
+SETUP_HOST = '127.0.0.3'
+
+
+@pytest.fixture
+def setup_mode_device():
+    """A listener on the setup port of SETUP_HOST, as a device in setup mode."""
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        server.bind((SETUP_HOST, cli.SETUP_PORT))
+    except OSError as e:
+        pytest.skip("cannot listen on {}:{}: {}".format(SETUP_HOST, cli.SETUP_PORT, e))
+    server.listen(16)
+    yield SETUP_HOST
+    server.close()
+
+
+def test_scan_does_not_wait_for_an_offline_device(fleet, setup_mode_device, tmp_path):
+    with open(os.path.join(fleet, "pairing.json")) as f:
+        pairings = json.load(f)
+    offline = dict(next(iter(pairings.values())), AccessoryPairingID='0A:AA:FF:FF:FF:FF')
+    pairings['HAA-FFFFFF'] = offline
+    pairing_file = str(tmp_path / "pairing.json")
+    with open(pairing_file, 'w') as f:
+        json.dump(pairings, f)
+
+    start = time.monotonic()
+    out = subprocess.run([sys.executable, CLI, '--cache-dir', str(tmp_path), '-f', pairing_file, '-t', str(TIMEOUT_SEC),
+                          '--subnet', '127.0.0.0/29', '--output', 'jsonl', 'scan'],
+                         capture_output=True, text=True, timeout=TIMEOUT_SEC * 2, cwd=REPO)
+    elapsed = time.monotonic() - start
+    records = [json.loads(line) for line in out.stdout.splitlines()]
+    assert {r['ip'] for r in records if r['event'] == 'setup_mode'} == {setup_mode_device}
+    assert len({r['id'] for r in records if r['event'] == 'discovery'} & {p['AccessoryPairingID'].lower()
+                                                                          for p in pairings.values()}) == 3
+    assert elapsed < TIMEOUT_SEC / 3
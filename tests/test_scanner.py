@@ -0,0 +1,114 @@
+import asyncio
+import contextlib
+import ipaddress
+import logging
+import socket
+
+import pytest
+
+import haa_manager_cli as cli
+
+LOG = logging.getLogger()
+HOSTS = ('127.0.0.2', '127.0.0.3')
+PROBE_LATENCY = 0.01
+
+
+@pytest.fixture
+def hap_port():
+    """A port with a listener on every address of HOSTS, as HAP servers."""
+    servers = []
+    port = None
+    try:
+        for host in HOSTS:
+            server = socket.socket()
+            server.bind((host, port or 0))
+            server.listen(16)
+            servers.append(server)
+            port = server.getsockname()[1]
+    except OSError as e:
+        pytest.skip("cannot listen on {}: {}".format(host, e))
+    yield port
+    for server in servers:
+        server.close()
+
+
+@pytest.fixture
+def probes(monkeypatch):
+    """Every (ip, port) probed by the scanner, in order. A probe takes PROBE_LATENCY at least, as on a LAN."""
+    probed = []
+    probe = cli._probe_tcp_port
+
+    async def counting_probe(ip, port, timeout=cli.INVENTORY_PROBE_TIMEOUT):
+        probed.append((ip, port))
+        await asyncio.sleep(PROBE_LATENCY)  # loopback refuses a closed port at once
+        return await probe(ip, port, timeout)
+
+    monkeypatch.setattr(cli, '_probe_tcp_port', counting_probe)
+    return probed
+
+
+def _scanner(cidr: str, concurrency: int = 4, rate: float = 0) -> cli._TCPScanner:
+    return cli._TCPScanner([ipaddress.ip_network(cidr)], concurrency, rate, timeout=0.2)
+
+
+def _other_tasks() -> set:
+    return {t for t in asyncio.all_tasks() if t is not asyncio.current_task()}
+
+
+def test_scanner_yields_open_ports_and_stops_its_workers(hap_port):
+    async def scan():
+        found = [item async for item in _scanner('127.0.0.0/29').scan([hap_port])]
+        return found, _other_tasks()
+
+    found, left = asyncio.run(scan())
+    assert sorted(found) == [(host, hap_port) for host in HOSTS]
+    assert not left
+
+
+def test_scanner_closed_early_cancels_its_workers(hap_port, probes):
+    async def scan():
+        async with contextlib.aclosing(_scanner('127.0.0.0/24').scan([hap_port])) as stream:
+            async for item in stream:
+                break
+        return item, _other_tasks()
+
+    item, left = asyncio.run(scan())
+    assert item == (HOSTS[0], hap_port)
+    assert not left
+    assert len(probes) < 254
+
+
+def test_scan_locate_matches_while_streaming_and_stops_early(hap_port, probes, monkeypatch):
+    arp = {'02:00:00:aa:bb:02': HOSTS[0], '02:00:00:aa:bb:03': HOSTS[1]}
+    arp_reads = []
+
+    def read_arp_cache(log):
+        arp_reads.append(len(probes))
+        return dict(arp)
+
+    monkeypatch.setattr(cli, '_read_arp_cache', read_arp_cache)
+    raw = {'HAA-AABB02': {'AccessoryPairingID': '0A:AA:00:00:00:02', 'AccessoryPort': hap_port},
+           'HAA-AABB03': {'AccessoryPairingID': '0A:AA:00:00:00:03', 'AccessoryPort': hap_port}}
+    found = asyncio.run(cli._scan_locate(raw, list(raw), _scanner('127.0.0.0/24'), LOG))
+    assert {k: (v['ip'], v['mac']) for k, v in found.items()} == {
+        'HAA-AABB02': (HOSTS[0], '02:00:00:aa:bb:02'), 'HAA-AABB03': (HOSTS[1], '02:00:00:aa:bb:03')}
+    assert arp_reads and arp_reads[0] < 254  # the ARP cache is read while the sweep runs
+    assert len(probes) < 254  # and the sweep stops once both are located
+
+
+def test_rate_limiter_spacing():
+    async def stamps(rate, n):
+        limiter = cli._RateLimiter(rate)
+        loop = asyncio.get_running_loop()
+        result = []
+        for _ in range(n):
+            await limiter.wait()
+            result.append(loop.time())
+        return result
+
+    spaced = asyncio.run(stamps(20, 5))
+    gaps = [b - a for a, b in zip(spaced, spaced[1:])]
+    assert all(gap >= 0.05 - 0.005 for gap in gaps)
+    assert spaced[-1] - spaced[0] < 4 * 0.05 + 0.1
+    unlimited = asyncio.run(stamps(0, 5))
+    assert unlimited[-1] - unlimited[0] < 0.05